@@ -14,7 +14,7 @@ import traceback
 
 from .compatibility_utils import PY2, binary_type, utf8_str, unicode_str
 from .compatibility_utils import unicode_argv, add_cp65001_codec
-from .compatibility_utils import hexlify
+from .compatibility_utils import hexlify, bstr
 
 add_cp65001_codec()
 
@@ -155,6 +155,27 @@ WRITE_RAW_DATA = False
 SPLIT_COMBO_MOBIS = False
 """ Set to True to split combination mobis into mobi7 and mobi8 pieces. """
 
+USE_MMAP = False
+""" Set to True to memory map the input file instead of reading it all into memory. """
+
+USE_LAZY = False
+""" Set to True to read the records of the input file when they are needed instead of all at once. """
+
+DECOMPRESS_PROCESSES = 1
+""" Number of processes used to decompress the text, decode dictionary indexes and rewrite the KF8 parts of large books, 0 for one per cpu. """
+
+CACHE_DIR = None
+""" Folder for the optional cache of decompressed text and parsed indexes, None to disable. """
+
+DICT_DATABASE = None
+""" Path of an SQLite database to export the entries of dictionaries to, None to disable. """
+
+RAWML_CHUNK_SIZE = 64*1024
+""" Size of the chunks the raw markup language of older mobis is read back in. """
+
+RAWML_SPOOL_SIZE = 64*1024*1024
+""" Raw markup language of older mobis up to this size is kept in memory between its two passes, larger is written to a temporary file. """
+
 CREATE_COVER_PAGE = True  # XXX experimental
 """ Create and insert a cover xhtml page. """
 
@@ -179,6 +200,7 @@ import struct
 import re
 import zlib
 import getopt
+import tempfile
 
 class unpackException(Exception):
     pass
@@ -186,11 +208,12 @@ class unpackException(Exception):
 
 # import the kindleunpack support libraries
 from .unpack_structure import fileNames
-from .mobi_sectioner import Sectionizer, describe
+from .mobi_sectioner import Sectionizer, LazySectionizer, describe
 from .mobi_header import MobiHeader, dump_contexth
 from .mobi_utils import toBase32
 from .mobi_opf import OPFProcessor
 from .mobi_html import HTMLProcessor, XHTMLK8Processor
+from .mobi_posmap import PositionMap
 from .mobi_ncx import ncxExtract
 from .mobi_k8proc import K8Processor
 from .mobi_split import mobi_split
@@ -199,6 +222,8 @@ from .mobi_nav import NAVProcessor
 from .mobi_cover import CoverProcessor, get_image_type
 from .mobi_pagemap import PageMapProcessor
 from .mobi_dict import dictSupport
+from .mobi_dictdb import DictionaryDatabase
+from .mobi_cache import UnpackCache, DEFAULT_CACHE_SIZE
 
 
 def processSRCS(i, files, rscnames, sect, data):
@@ -305,11 +330,11 @@ def processFONT(i, files, rscnames, sect, data, obfuscate_data, beg, rsc_ptr):
     return rscnames, obfuscate_data, rsc_ptr
 
 
-def processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd):
+def processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd, rsctypes=None):
     # extract an HDImage
     global DUMP
     data = data[12:]
-    imgtype = get_image_type(None, data)
+    imgtype = getResourceType(i, data, rsctypes)
 
     if imgtype is None:
         print("Warning: CRES Section %s does not contain a recognised resource" % i)
@@ -396,10 +421,20 @@ def processRESC(i, files, rscnames, sect, data, k8resc):
     return rscnames, k8resc
 
 
-def processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset, thumb_offset):
+def getResourceType(i, data, rsctypes):
+    # image type of resource section i, rsctypes remembers the types found
+    # so far and may have been filled in from the unpack cache
+    if rsctypes is None:
+        return get_image_type(None, data)
+    if i not in rsctypes:
+        rsctypes[i] = get_image_type(None, data)
+    return rsctypes[i]
+
+
+def processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset, thumb_offset, rsctypes=None):
     global DUMP
     # Extract an Image
-    imgtype = get_image_type(None, data)
+    imgtype = getResourceType(i, data, rsctypes)
     if imgtype is None:
         print("Warning: Section %s does not contain a recognised resource" % i)
         rscnames.append(None)
@@ -431,32 +466,92 @@ def processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset, thu
 def processPrintReplica(metadata, files, rscnames, mh):
     global DUMP
     global WRITE_RAW_DATA
-    rawML = mh.getRawML()
+    # the raw data is streamed a text record at a time, only the table index at
+    # the start is buffered and every embedded file is written as its bytes arrive
+    rawstream = mh.iterRawML(DECOMPRESS_PROCESSES)
+    rawout = None
     if DUMP or WRITE_RAW_DATA:
         outraw = os.path.join(files.outdir,files.getInputFileBasename() + '.rawpr')
-        with open(pathof(outraw),'wb') as f:
-            f.write(rawML)
+        rawout = open(pathof(outraw),'wb')
+
+    def readChunk():
+        for offset, chunk in rawstream:
+            if rawout is not None:
+                rawout.write(chunk)
+            return chunk
+        return None
 
     fileinfo = []
     print("Print Replica ebook detected")
     try:
-        numTables, = struct.unpack_from(b'>L', rawML, 0x04)
+        # buffer the start of the raw data until the whole table index is available
+        head = bytearray()
+        def readHead(size):
+            while len(head) < size:
+                chunk = readChunk()
+                if chunk is None:
+                    raise unpackException('Print Replica table index is truncated')
+                head.extend(chunk)
+        readHead(8)
+        numTables, = struct.unpack_from(b'>L', head, 0x04)
+        readHead(8 + 4*numTables)
+        tableCounts = struct.unpack_from(bstr('>%dL' % numTables), head, 0x08)
         tableIndexOffset = 8 + 4*numTables
+        readHead(tableIndexOffset + 8*sum(tableCounts))
         # for each table, read in count of sections, assume first section is a PDF
         # and output other sections as binary files
+        entries = []
         for i in range(numTables):
-            sectionCount, = struct.unpack_from(b'>L', rawML, 0x08 + 4*i)
+            sectionCount = tableCounts[i]
             for j in range(sectionCount):
-                sectionOffset, sectionLength, = struct.unpack_from(b'>LL', rawML, tableIndexOffset)
+                sectionOffset, sectionLength, = struct.unpack_from(b'>LL', head, tableIndexOffset)
                 tableIndexOffset += 8
                 if j == 0:
                     entryName = os.path.join(files.outdir, files.getInputFileBasename() + ('.%03d.pdf' % (i+1)))
                 else:
                     entryName = os.path.join(files.outdir, files.getInputFileBasename() + ('.%03d.%03d.data' % ((i+1),j)))
-                with open(pathof(entryName), 'wb') as f:
-                    f.write(rawML[sectionOffset:(sectionOffset+sectionLength)])
+                entries.append((sectionOffset, sectionOffset + sectionLength, entryName))
+        # each file is opened when the stream reaches its start and closed at its
+        # end, so only the files of the sections being streamed are open at a time
+        entries.sort(key=lambda entry: entry[0])
+        k = 0
+        active = []
+        try:
+            chunk = bytes(head)
+            chunkstart = 0
+            while (k < len(entries) or active) and chunk is not None:
+                chunkend = chunkstart + len(chunk)
+                while k < len(entries) and entries[k][0] <= chunkend:
+                    start, end, entryName = entries[k]
+                    active.append((start, end, open(pathof(entryName), 'wb')))
+                    k += 1
+                remaining = []
+                for entry in active:
+                    start, end, f = entry
+                    if start < chunkend and end > chunkstart:
+                        f.write(chunk[max(start - chunkstart, 0):min(end, chunkend) - chunkstart])
+                    if end <= chunkend:
+                        f.close()
+                    else:
+                        remaining.append(entry)
+                active = remaining
+                chunkstart = chunkend
+                chunk = readChunk()
+            # sections that start past the end of the data still get their (empty) file
+            for start, end, entryName in entries[k:]:
+                open(pathof(entryName), 'wb').close()
+        finally:
+            for start, end, f in active:
+                f.close()
     except Exception as e:
         print('Error processing Print Replica: ' + str(e))
+    if rawout is not None:
+        # finish the raw dump even if the tables did not need all of the data
+        while readChunk() is not None:
+            pass
+        rawout.close()
+    # stop decompressing the data the tables did not need (and any worker processes)
+    rawstream.close()
 
     fileinfo.append([None,'', files.getInputFileBasename() + '.pdf'])
     usedmap = {}
@@ -472,7 +567,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
     global WRITE_RAW_DATA
 
     # extract raw markup langauge
-    rawML = mh.getRawML()
+    rawML = mh.getRawML(DECOMPRESS_PROCESSES)
     if DUMP or WRITE_RAW_DATA:
         outraw = os.path.join(files.k8dir,files.getInputFileBasename() + '.rawml')
         with open(pathof(outraw),'wb') as f:
@@ -530,10 +625,15 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
     ncx = ncxExtract(mh, files)
     ncx_data = ncx.parseNCX()
     # extend the ncx data with filenames and proper internal idtags
+    # (all entries are resolved together)
+    posfids = []
+    for ncxmap in ncx_data:
+        [junk1, junk2, junk3, fid, junk4, off] = ncxmap['pos_fid'].split(':')
+        posfids.append((fid, off))
+    targets = k8proc.getIDTagsByPosFid(posfids)
     for i in range(len(ncx_data)):
         ncxmap = ncx_data[i]
-        [junk1, junk2, junk3, fid, junk4, off] = ncxmap['pos_fid'].split(':')
-        filename, idtag = k8proc.getIDTagByPosFid(fid, off)
+        filename, idtag = targets[i]
         ncxmap['filename'] = filename
         ncxmap['idtag'] = unicode_str(idtag)
         ncx_data[i] = ncxmap
@@ -553,10 +653,11 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
 
     # convert the rawML to a set of xhtml files
     print("Building an epub-like structure")
+    # (the xhtml files are written as their parts are done)
     htmlproc = XHTMLK8Processor(rscnames, k8proc, viewport)
-    usedmap = htmlproc.buildXHTML()
+    usedmap = htmlproc.buildXHTML(DECOMPRESS_PROCESSES, files.k8oebps)
 
-    # write out the xhtml svg, and css files
+    # write out the svg and css files
     # fileinfo = [skelid|coverpage, dir, name]
     fileinfo = []
     # first create a cover page if none exists
@@ -584,12 +685,8 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
                 
     n =  k8proc.getNumberOfParts()
     for i in range(n):
-        part = k8proc.getPart(i)
         [skelnum, dir, filename, beg, end, aidtext] = k8proc.getPartInfo(i)
         fileinfo.append([str(skelnum), dir, filename])
-        fname = os.path.join(files.k8oebps,dir,filename)
-        with open(pathof(fname),'wb') as f:
-            f.write(part)
     n = k8proc.getNumberOfFlows()
     for i in range(1, n):
         [ptype, pformat, pdir, filename] = k8proc.getFlowInfo(i)
@@ -622,49 +719,72 @@ def processMobi7(mh, metadata, sect, files, rscnames):
     global DUMP
     global WRITE_RAW_DATA
     # An original Mobi
-    rawML = mh.getRawML()
+    # the raw markup language is streamed twice, the first pass finds the filepos
+    # links and keeps a copy of the text in the .rawml file, in memory or, for
+    # large books, in a temporary file for the second pass that writes the html
+    proc = HTMLProcessor(files, metadata, rscnames)
     if DUMP or WRITE_RAW_DATA:
         outraw = os.path.join(files.mobi7dir,files.getInputFileBasename() + '.rawml')
-        with open(pathof(outraw),'wb') as f:
-            f.write(rawML)
-
-    # process the toc ncx
-    # ncx map keys: name, pos, len, noffs, text, hlvl, kind, pos_fid, parent, child1, childn, num
-    ncx = ncxExtract(mh, files)
-    ncx_data = ncx.parseNCX()
-    ncx.writeNCX(metadata)
-
-    positionMap = {}
-
-    # if Dictionary build up the positionMap
-    if mh.isDictionary():
-        if mh.DictInLanguage():
-            metadata['DictInLanguage'] = [mh.DictInLanguage()]
-        if mh.DictOutLanguage():
-            metadata['DictOutLanguage'] = [mh.DictOutLanguage()]
-        positionMap = dictSupport(mh, sect).getPositionMap()
-
-    # convert the rawml back to Mobi ml
-    proc = HTMLProcessor(files, metadata, rscnames)
-    srctext = proc.findAnchors(rawML, ncx_data, positionMap)
-    srctext, usedmap = proc.insertHREFS()
-
-    # write the proper mobi html
+        rawfile = open(pathof(outraw),'w+b')
+    else:
+        rawfile = tempfile.SpooledTemporaryFile(RAWML_SPOOL_SIZE)
+    def copyRawML():
+        for offset, chunk in mh.iterRawML(DECOMPRESS_PROCESSES):
+            rawfile.write(chunk)
+            yield chunk
+    def readRawML():
+        rawfile.seek(0)
+        while True:
+            chunk = rawfile.read(RAWML_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
     fileinfo=[]
-    # fname = files.getInputFileBasename() + '.html'
-    fname = 'book.html'
-    fileinfo.append([None,'', fname])
-    outhtml = os.path.join(files.mobi7dir, fname)
-    with open(pathof(outhtml), 'wb') as f:
-        f.write(srctext)
+    with rawfile:
+        rawsize = proc.findLinks(copyRawML())
+
+        # process the toc ncx
+        # ncx map keys: name, pos, len, noffs, text, hlvl, kind, pos_fid, parent, child1, childn, num
+        ncx = ncxExtract(mh, files)
+        ncx_data = ncx.parseNCX()
+        ncx.writeNCX(metadata)
+
+        positionMap = PositionMap()
+
+        # if Dictionary build up the positionMap
+        if mh.isDictionary():
+            if mh.DictInLanguage():
+                metadata['DictInLanguage'] = [mh.DictInLanguage()]
+            if mh.DictOutLanguage():
+                metadata['DictOutLanguage'] = [mh.DictOutLanguage()]
+            database = None
+            if DICT_DATABASE is not None:
+                database = DictionaryDatabase(unicode_str(DICT_DATABASE), mh.codec)
+            try:
+                positionMap = dictSupport(mh, sect).getPositionMap(DECOMPRESS_PROCESSES, database)
+            except:
+                # do not leave a half written database without its indexes behind
+                if database is not None:
+                    database.abort()
+                raise
+            if database is not None:
+                database.close()
+
+        # convert the rawml back to Mobi ml and write the proper mobi html
+        # fname = files.getInputFileBasename() + '.html'
+        fname = 'book.html'
+        fileinfo.append([None,'', fname])
+        outhtml = os.path.join(files.mobi7dir, fname)
+        with open(pathof(outhtml), 'w+b') as f:
+            srcguide, usedmap = proc.writeHTML(readRawML(), rawsize, ncx_data, positionMap, f)
 
     # extract guidetext from srctext
+    # (writeHTML found what <guide>(.*)</guide> matches in it)
     guidetext =b''
     # no pagemap support for older mobis
     # pagemapxml = None
-    guidematch = re.search(br'''<guide>(.*)</guide>''',srctext,re.IGNORECASE+re.DOTALL)
-    if guidematch:
-        guidetext = guidematch.group(1)
+    if srcguide is not None:
+        guidetext = srcguide
         # sometimes old mobi guide from srctext horribly written so need to clean up
         guidetext = guidetext.replace(b"\r", b"")
         guidetext = guidetext.replace(b'<REFERENCE', b'<reference')
@@ -720,7 +840,7 @@ def processUnknownSections(mh, sect, files, K8Boundary):
     for i in range(beg, end):
         if sect.sectiondescriptions[i] == "":
             data = sect.loadSection(i)
-            type = data[0:4]
+            type = bytes(data[0:4])
             if type == TERMINATION_INDICATOR3:
                 description = "Termination Marker 3 Nulls"
             elif type == TERMINATION_INDICATOR2:
@@ -806,9 +926,20 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
         if not CREATE_COVER_PAGE:
             cover_offset = None
 
+        # the image type of each resource, remembered by the unpack cache if there is one
+        rsctypes = {}
+        if mh.cache is not None:
+            rsctypes = mh.cache.loadObject('resources-%d' % mh.start)
+            cachedtypes = rsctypes is not None
+            if not cachedtypes:
+                rsctypes = {}
+
         for i in range(beg, end):
+            # data may be a zero-copy view of the book, images and other large
+            # resources are written straight from it, small structured records
+            # are converted to bytes by the handlers that parse them
             data = sect.loadSection(i)
-            type = data[0:4]
+            type = bytes(data[0:4])
 
             # handle the basics first
             if type in [b"FLIS", b"FCIS", b"FDST", b"DATP"]:
@@ -826,23 +957,23 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
             elif type == b"SRCS":
                 rscnames = processSRCS(i, files, rscnames, sect, data)
             elif type == b"PAGE":
-                rscnames, pagemapproc = processPAGE(i, files, rscnames, sect, data, mh, pagemapproc)
+                rscnames, pagemapproc = processPAGE(i, files, rscnames, sect, bytes(data), mh, pagemapproc)
             elif type == b"CMET":
                 rscnames = processCMET(i, files, rscnames, sect, data)
             elif type == b"FONT":
                 rscnames, obfuscate_data, rsc_ptr = processFONT(i, files, rscnames, sect, data, obfuscate_data, beg, rsc_ptr)
             elif type == b"CRES":
-                rscnames, rsc_ptr = processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd)
+                rscnames, rsc_ptr = processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd, rsctypes)
             elif type == b"CONT":
-                rscnames = processCONT(i, files, rscnames, sect, data)
+                rscnames = processCONT(i, files, rscnames, sect, bytes(data))
             elif type == b"kind":
-                rscnames = processkind(i, files, rscnames, sect, data)
+                rscnames = processkind(i, files, rscnames, sect, bytes(data))
             elif type == b'\xa0\xa0\xa0\xa0':
                 sect.setsectiondescription(i,"Empty_HD_Image/Resource_Placeholder")
                 rscnames.append(None)
                 rsc_ptr += 1
             elif type == b"RESC":
-                rscnames, k8resc = processRESC(i, files, rscnames, sect, data, k8resc)
+                rscnames, k8resc = processRESC(i, files, rscnames, sect, bytes(data), k8resc)
             elif data == EOF_RECORD:
                 sect.setsectiondescription(i,"End Of File")
                 rscnames.append(None)
@@ -851,8 +982,10 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
                 rscnames.append(None)
             else:
                 # if reached here should be an image ow treat as unknown
-                rscnames, rsc_ptr  = processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset, thumb_offset)
+                rscnames, rsc_ptr  = processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset, thumb_offset, rsctypes)
         # done unpacking resources
+        if mh.cache is not None and not cachedtypes:
+            mh.cache.saveObject('resources-%d' % mh.start, rsctypes)
 
         # Print Replica
         if mh.isPrintReplica() and not k8only:
@@ -873,16 +1006,31 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
     return
 
 
-def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=False, dowriteraw=False, dosplitcombos=False):
+def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=False, dowriteraw=False, dosplitcombos=False, usemmap=False, uselazy=False, processes=None, cachedir=None, dictdb=None):
     global DUMP
     global WRITE_RAW_DATA
     global SPLIT_COMBO_MOBIS
+    global USE_MMAP
+    global USE_LAZY
+    global DECOMPRESS_PROCESSES
+    global CACHE_DIR
+    global DICT_DATABASE
     if DUMP or dodump:
         DUMP = True
     if WRITE_RAW_DATA or dowriteraw:
         WRITE_RAW_DATA = True
     if SPLIT_COMBO_MOBIS or dosplitcombos:
         SPLIT_COMBO_MOBIS = True
+    if USE_MMAP or usemmap:
+        USE_MMAP = True
+    if USE_LAZY or uselazy:
+        USE_LAZY = True
+    if processes is not None:
+        DECOMPRESS_PROCESSES = processes
+    if cachedir is not None:
+        CACHE_DIR = cachedir
+    if dictdb is not None:
+        DICT_DATABASE = dictdb
 
     infile = unicode_str(infile)
     outdir = unicode_str(outdir)
@@ -892,62 +1040,82 @@ def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=
     files = fileNames(infile, outdir)
 
     # process the PalmDoc database header and verify it is a mobi
-    sect = Sectionizer(infile)
-    if sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd':
-        raise unpackException('Invalid file format')
-    if DUMP:
-        sect.dumppalmheader()
+    # (with -m the file stays mapped and with -l open until the book is unpacked)
+    if USE_LAZY:
+        sect = LazySectionizer(infile)
     else:
-        print("Palm DB type: %s, %d sections." % (sect.ident.decode('utf-8'),sect.num_sections))
+        sect = Sectionizer(infile, USE_MMAP)
+    with sect:
+        if sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd':
+            raise unpackException('Invalid file format')
+        if DUMP:
+            sect.dumppalmheader()
+        else:
+            print("Palm DB type: %s, %d sections." % (sect.ident.decode('utf-8'),sect.num_sections))
 
-    # scan sections to see if this is a compound mobi file (K8 format)
-    # and build a list of all mobi headers to process.
-    mhlst = []
-    mh = MobiHeader(sect,0)
-    # if this is a mobi8-only file hasK8 here will be true
-    mhlst.append(mh)
-    K8Boundary = -1
+        # scan sections to see if this is a compound mobi file (K8 format)
+        # and build a list of all mobi headers to process.
+        mhlst = []
+        mh = MobiHeader(sect,0)
+        # if this is a mobi8-only file hasK8 here will be true
+        mhlst.append(mh)
+        K8Boundary = -1
 
-    if mh.isK8():
-        print("Unpacking a KF8 book...")
-        hasK8 = True
-    else:
-        # This is either a Mobipocket 7 or earlier, or a combi M7/KF8
-        # Find out which
-        hasK8 = False
-        for i in range(len(sect.sectionoffsets)-1):
-            before, after = sect.sectionoffsets[i:i+2]
-            if (after - before) == 8:
-                data = sect.loadSection(i)
-                if data == K8_BOUNDARY:
-                    sect.setsectiondescription(i,"Mobi/KF8 Boundary Section")
-                    mh = MobiHeader(sect,i+1)
-                    hasK8 = True
-                    mhlst.append(mh)
-                    K8Boundary = i
-                    break
-        if hasK8:
-            print("Unpacking a Combination M{0:d}/KF8 book...".format(mh.version))
-            if SPLIT_COMBO_MOBIS:
-                # if this is a combination mobi7-mobi8 file split them up
-                mobisplit = mobi_split(infile)
-                if mobisplit.combo:
-                    outmobi7 = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.mobi')
-                    outmobi8 = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.azw3')
-                    with open(pathof(outmobi7), 'wb') as f:
-                        f.write(mobisplit.getResult7())
-                    with open(pathof(outmobi8), 'wb') as f:
-                        f.write(mobisplit.getResult8())
+        if mh.isK8():
+            print("Unpacking a KF8 book...")
+            hasK8 = True
         else:
-            print("Unpacking a Mobipocket {0:d} book...".format(mh.version))
+            # This is either a Mobipocket 7 or earlier, or a combi M7/KF8
+            # Find out which
+            hasK8 = False
+            for i in range(len(sect.sectionoffsets)-1):
+                before, after = sect.sectionoffsets[i:i+2]
+                if (after - before) == 8:
+                    if sect.loadSection(i) == K8_BOUNDARY:
+                        sect.setsectiondescription(i,"Mobi/KF8 Boundary Section")
+                        mh = MobiHeader(sect,i+1)
+                        hasK8 = True
+                        mhlst.append(mh)
+                        K8Boundary = i
+                        break
+            if hasK8:
+                print("Unpacking a Combination M{0:d}/KF8 book...".format(mh.version))
+                if SPLIT_COMBO_MOBIS:
+                    # if this is a combination mobi7-mobi8 file split them up
+                    mobisplit = mobi_split(infile, USE_MMAP)
+                    if mobisplit.combo:
+                        outmobi7 = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.mobi')
+                        outmobi8 = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.azw3')
+                        with open(pathof(outmobi7), 'wb') as f:
+                            f.write(mobisplit.getResult7())
+                        with open(pathof(outmobi8), 'wb') as f:
+                            f.write(mobisplit.getResult8())
+            else:
+                print("Unpacking a Mobipocket {0:d} book...".format(mh.version))
+
+        if hasK8:
+            files.makeK8Struct()
 
-    if hasK8:
-        files.makeK8Struct()
+        # optionally reuse (or remember) the decompressed text, parsed indexes and
+        # resource types of this book from earlier runs
+        cache = None
+        if CACHE_DIR is not None:
+            cache = UnpackCache(unicode_str(CACHE_DIR), DEFAULT_CACHE_SIZE)
+            cache.openBook(infile)
+            for mh in mhlst:
+                mh.cache = cache
 
-    process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, False, epubver, use_hd)
+        # only the Mobi7 part of a book carries a dictionary index that can be exported
+        if DICT_DATABASE is not None and not [mh for mh in mhlst if not mh.isK8() and mh.isDictionary()]:
+            print("Warning: not writing the dictionary database %s, the book has no Mobi7 dictionary index" % DICT_DATABASE)
 
-    if DUMP:
-        sect.dumpsectionsinfo()
+        process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, False, epubver, use_hd)
+
+        if cache is not None:
+            cache.evict()
+
+        if DUMP:
+            sect.dumpsectionsinfo()
     return
 
 
@@ -958,14 +1126,25 @@ def usage(progname):
     print("  or an unencrypted Kindle/Print Replica ebook to PDF and images")
     print("  into the specified output folder.")
     print("Usage:")
-    print("  %s -r -s -p apnxfile -d -h --epub_version= infile [outdir]" % progname)
+    print("  %s -r -s -m -l -p apnxfile -d -h --epub_version= --jobs= --cache= --dictdb= infile [outdir]" % progname)
     print("Options:")
     print("    -h                 print this help message")
     print("    -i                 use HD Images, if present, to overwrite reduced resolution images")
     print("    -s                 split combination mobis into mobi7 and mobi8 ebooks")
+    print("    -m                 memory map the input file instead of reading it into memory")
+    print("    -l                 read the records of the input file when they are needed instead")
+    print("                         of all at once (overrides -m)")
     print("    -p APNXFILE        path to an .apnx file associated with the azw3 input (optional)")
     print("    --epub_version=    specify epub version to unpack to: 2, 3, A (for automatic) or ")
     print("                         F (force to fit to epub2 definitions), default is 2")
+    print("    --jobs=            number of processes used to decompress the text, decode dictionary")
+    print("                         indexes and rewrite the KF8 parts of large books, 0 for one per")
+    print("                         cpu, default is 1")
+    print("    --cache=DIR        keep decompressed text and parsed indexes in DIR to speed up")
+    print("                         unpacking the same book again, the indexes are stored as")
+    print("                         python pickles so DIR must not be writable by other users")
+    print("    --dictdb=FILE      also write the headwords, inflected forms and text positions of")
+    print("                         the entries of a dictionary to the SQLite database FILE")
     print("    -d                 dump headers and other info to output and extra files")
     print("    -r                 write raw data to the output folder")
 
@@ -974,6 +1153,11 @@ def main(argv=unicode_argv()):
     global DUMP
     global WRITE_RAW_DATA
     global SPLIT_COMBO_MOBIS
+    global USE_MMAP
+    global USE_LAZY
+    global DECOMPRESS_PROCESSES
+    global CACHE_DIR
+    global DICT_DATABASE
 
     print("KindleUnpack v0.83")
     print("   Based on initial mobipocket version Copyright © 2009 Charles M. Hannum <root@ihack.net>")
@@ -985,7 +1169,7 @@ def main(argv=unicode_argv()):
 
     progname = os.path.basename(argv[0])
     try:
-        opts, args = getopt.getopt(argv[1:], "dhirsp:", ['epub_version='])
+        opts, args = getopt.getopt(argv[1:], "dhirsmlp:", ['epub_version=', 'jobs=', 'cache=', 'dictdb='])
     except getopt.GetoptError as err:
         print(str(err))
         usage(progname)
@@ -1011,10 +1195,25 @@ def main(argv=unicode_argv()):
             WRITE_RAW_DATA = True
         if o == "-s":
             SPLIT_COMBO_MOBIS = True
+        if o == "-m":
+            USE_MMAP = True
+        if o == "-l":
+            USE_LAZY = True
         if o == "-p":
             apnxfile = a
         if o == "--epub_version":
             epubver = a
+        if o == "--jobs":
+            try:
+                DECOMPRESS_PROCESSES = int(a)
+            except ValueError:
+                print("Error: --jobs needs a number")
+                usage(progname)
+                sys.exit(2)
+        if o == "--cache":
+            CACHE_DIR = a
+        if o == "--dictdb":
+            DICT_DATABASE = a
 
     if len(args) > 1:
         infile, outdir = args
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+
+__path__ = ["lib", os.path.dirname(os.path.realpath(__file__)), "kindleunpack"]
+
+import sys
+import getopt
+import json
+import platform
+import re
+import shutil
+import tempfile
+import time
+
+from .compatibility_utils import PY2, unicode_str, unicode_argv
+
+if PY2:
+    range = xrange
+
+from .unipath import pathof
+
+from .mobi_sectioner import Sectionizer
+from .mobi_header import MobiHeader, getUnpacker
+from .mobi_index import MobiIndex
+from .mobi_k8proc import K8Processor
+from .mobi_html import HTMLProcessor, XHTMLK8Processor
+from .mobi_posmap import PositionMap
+from .mobi_ncx import ncxExtract
+from .mobi_opf import OPFProcessor
+from .mobi_dict import dictSupport
+from .mobi_synth import generateBook, parseSize, FORMATS, COMPRESSIONS
+from .mobi_utils import fromBase32
+from .unpack_structure import fileNames
+
+from . import kindleunpack
+
+# Benchmark harness for the unpacking stages.
+#
+# Each book (generated by mobi_synth or given on the command line) is unpacked
+# stage by stage, the same way kindleunpack does it, and every stage is timed
+# on its own:
+#
+#   sectionizer     - Sectionizer reading the palm database
+#   decompress      - PalmdocReader / HuffcdicReader unpacking every text record
+#   index           - MobiIndex.getIndexData for each index of the part
+#   resources       - classifying and writing the image, font and RESC sections
+#   buildParts      - K8Processor.buildParts
+#   lookups         - K8Processor position lookups for every kindle:pos:fid link
+#   buildXHTML      - XHTMLK8Processor.buildXHTML
+#   getPositionMap  - dictSupport.getPositionMap (dictionaries only)
+#   findLinks       - HTMLProcessor.findLinks
+#   writeHTML       - HTMLProcessor.writeHTML
+#   opf             - OPFProcessor building and writing content.opf
+#   makeEPUB        - fileNames.makeEPUB
+#
+# The whole sequence is run REPEAT times with fresh objects and the best and
+# median time of every stage are written as JSON, so the results of two
+# revisions can be compared with --compare.  A few counts are recorded with
+# them, like the size of the text and the number of passes buildXHTML made
+# over the text of the parts.
+
+BENCH_VERSION = 3
+""" Bump whenever the meaning of the stages or the layout of the results changes. """
+
+REPEAT = 3
+""" Number of times each book is unpacked. """
+
+
+_posfid_pattern = re.compile(br'''kindle:pos:fid:([0-9|A-V]+):off:([0-9|A-V]+)''')
+
+
+class unpackException(Exception):
+    pass
+
+
+class NullWriter(object):
+    # swallows the progress output of the stages while they are timed
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    def run(self, stage, func, *args):
+        saved = sys.stdout
+        sys.stdout = NullWriter()
+        try:
+            start = time.time()
+            result = func(*args)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = saved
+        self.times[stage] = self.times.get(stage, 0.0) + elapsed
+        return result
+
+
+def findHeaders(sect):
+    # returns the list of mobi headers in the book and the K8 boundary section
+    mh = MobiHeader(sect, 0)
+    mhlst = [mh]
+    boundary = -1
+    if not mh.isK8():
+        for i in range(len(sect.sectionoffsets) - 1):
+            before, after = sect.sectionoffsets[i:i+2]
+            if (after - before) == 8 and bytes(sect.loadSection(i)) == kindleunpack.K8_BOUNDARY:
+                mhlst.append(MobiHeader(sect, i + 1))
+                boundary = i
+                break
+    return mhlst, boundary
+
+
+def decompress(mh):
+    unpack = getUnpacker(mh.compression, mh.huffdata)
+    return b''.join([unpack(mh.loadTextRecord(i)) for i in range(1, mh.records + 1)])
+
+
+def readIndexes(sect, indexes):
+    for label, idx in indexes:
+        if idx != 0xffffffff:
+            MobiIndex(sect).getIndexData(idx, label)
+
+
+class ResourceState(object):
+    # the resource names and related state shared by all parts of a book
+
+    def __init__(self):
+        self.rscnames = []
+        self.obfuscate_data = []
+        self.k8resc = None
+        self.rsc_ptr = -1
+
+
+def unpackResources(state, mh, sect, files, boundary):
+    # a cut down version of the resource loop of process_all_mobi_headers
+    rscnames = state.rscnames
+    obfuscate_data = state.obfuscate_data
+    k8resc = state.k8resc
+    rsc_ptr = state.rsc_ptr
+    beg = mh.firstresource
+    end = sect.num_sections
+    if beg < boundary:
+        end = boundary
+    for i in range(beg, end):
+        data = sect.loadSection(i)
+        type = bytes(data[0:4])
+        if type == b"FONT":
+            rscnames, obfuscate_data, rsc_ptr = kindleunpack.processFONT(i, files, rscnames, sect, data, obfuscate_data, beg, rsc_ptr)
+        elif type == b"RESC":
+            rscnames, k8resc = kindleunpack.processRESC(i, files, rscnames, sect, bytes(data), k8resc)
+        elif type == b"CRES":
+            rscnames, rsc_ptr = kindleunpack.processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, False)
+        elif type in [b"FLIS", b"FCIS", b"FDST", b"DATP", b"PAGE", b"CONT", b"kind", b"SRCS", b"CMET",
+                      b"\xa0\xa0\xa0\xa0", b"BOUN"] or data == kindleunpack.EOF_RECORD:
+            rscnames.append(None)
+        else:
+            rscnames, rsc_ptr = kindleunpack.processImage(i, files, rscnames, sect, data, beg, rsc_ptr, None, None)
+    state.rscnames = rscnames
+    state.obfuscate_data = obfuscate_data
+    state.k8resc = k8resc
+    state.rsc_ptr = rsc_ptr
+
+
+def writeParts(files, k8proc):
+    # write the xhtml, svg and css files as processMobi8 does
+    fileinfo = []
+    for i in range(k8proc.getNumberOfParts()):
+        part = k8proc.getPart(i)
+        [skelnum, dir, filename, beg, end, aidtext] = k8proc.getPartInfo(i)
+        fileinfo.append([str(skelnum), dir, filename])
+        with open(pathof(os.path.join(files.k8oebps, dir, filename)), 'wb') as f:
+            f.write(part)
+    for i in range(1, k8proc.getNumberOfFlows()):
+        [ptype, pformat, pdir, filename] = k8proc.getFlowInfo(i)
+        if pformat == b'file':
+            fileinfo.append([None, pdir, filename])
+            with open(pathof(os.path.join(files.k8oebps, pdir, filename)), 'wb') as f:
+                f.write(k8proc.getFlow(i))
+    return fileinfo
+
+
+def resolveLinks(k8proc):
+    # look up the target of every kindle:pos:fid link in the parts with each of
+    # the position lookups used for links, the NCX, the guide and the page map
+    count = 0
+    for part in k8proc.parts:
+        for m in _posfid_pattern.finditer(part):
+            posfid, offset = m.group(1), m.group(2)
+            k8proc.getIDTagByPosFid(posfid, offset)
+            pos = k8proc.fragtbl.insertpos[fromBase32(posfid)] + fromBase32(offset)
+            k8proc.getFragTblInfo(pos)
+            k8proc.getSkelInfo(pos)
+            count += 1
+    return count
+
+
+def writeOPF(files, metadata, fileinfo, rscnames, hasNCX, mh, usedmap, k8resc, obfuscate_data):
+    if mh.isK8():
+        opf = OPFProcessor(files, metadata, fileinfo, rscnames, hasNCX, mh, usedmap, k8resc=k8resc)
+        return opf.writeOPF(bool(obfuscate_data))
+    opf = OPFProcessor(files, metadata, fileinfo, rscnames, hasNCX, mh, usedmap)
+    return opf.writeOPF()
+
+
+def benchMobi8(timer, state, mh, sect, files, boundary, processes=1):
+    files.makeK8Struct()
+    rawML = timer.run('decompress', decompress, mh)
+    timer.run('index', readIndexes, sect, [('NCX', mh.ncxidx), ('skeleton', mh.skelidx),
+                                           ('fragment', mh.fragidx), ('guide', mh.guideidx)])
+    timer.run('resources', unpackResources, state, mh, sect, files, boundary)
+    rscnames, obfuscate_data, k8resc = state.rscnames, state.obfuscate_data, state.k8resc
+    k8proc = timer.run('setup', K8Processor, mh, sect, files)
+    timer.run('buildParts', k8proc.buildParts, rawML)
+    timer.run('lookups', resolveLinks, k8proc)
+    htmlproc = XHTMLK8Processor(rscnames, k8proc)
+    usedmap = timer.run('buildXHTML', htmlproc.buildXHTML, processes)
+    timer.counts['textBytes'] = len(rawML)
+    timer.counts['xhtmlPasses'] = getattr(htmlproc, 'passes', None)
+    timer.counts['parts'] = k8proc.getNumberOfParts()
+    fileinfo = timer.run('setup', writeParts, files, k8proc)
+    uuid = timer.run('opf', writeOPF, files, mh.getMetaData().copy(), fileinfo, rscnames, False, mh, usedmap,
+                     k8resc, obfuscate_data)
+    timer.run('makeEPUB', files.makeEPUB, usedmap, obfuscate_data, uuid)
+
+
+def benchMobi7(timer, state, mh, sect, files, boundary, processes=1):
+    rawML = timer.run('decompress', decompress, mh)
+    timer.counts['textBytes'] = len(rawML)
+    indexes = [('NCX', mh.ncxidx)]
+    if mh.isDictionary():
+        indexes.append(('orth', mh.metaOrthIndex))
+    timer.run('index', readIndexes, sect, indexes)
+    timer.run('resources', unpackResources, state, mh, sect, files, boundary)
+    rscnames, obfuscate_data, k8resc = state.rscnames, state.obfuscate_data, state.k8resc
+    metadata = mh.getMetaData()
+    ncx = ncxExtract(mh, files)
+    ncx_data = timer.run('setup', ncx.parseNCX)
+    positionMap = PositionMap()
+    if mh.isDictionary():
+        positionMap = timer.run('getPositionMap', dictSupport(mh, sect).getPositionMap, processes)
+    proc = HTMLProcessor(files, metadata, rscnames)
+    rawsize = timer.run('findLinks', proc.findLinks, [rawML])
+    fileinfo = [[None, '', 'book.html']]
+    with open(pathof(os.path.join(files.mobi7dir, 'book.html')), 'w+b') as f:
+        srcguide, usedmap = timer.run('writeHTML', proc.writeHTML, [rawML], rawsize, ncx_data, positionMap, f)
+    timer.run('opf', writeOPF, files, metadata, fileinfo, rscnames, ncx.isNCX, mh, usedmap, k8resc, obfuscate_data)
+
+
+def benchOnce(infile, outdir, processes=1):
+    # unpack the book once and return {part: ({stage: seconds}, {name: count})}
+    results = {}
+    timer = StageTimer()
+    sect = timer.run('sectionizer', Sectionizer, infile)
+    mhlst, boundary = timer.run('setup', findHeaders, sect)
+    files = fileNames(infile, outdir)
+    state = ResourceState()
+    for mh in mhlst:
+        if mh.isEncrypted():
+            raise unpackException('Book is encrypted')
+        if mh.isK8():
+            part = 'kf8'
+            benchMobi8(timer, state, mh, sect, files, boundary, processes)
+        else:
+            part = 'mobi7'
+            benchMobi7(timer, state, mh, sect, files, boundary, processes)
+        timer.times.pop('setup', None)
+        results[part] = (timer.times, timer.counts)
+        timer = StageTimer()
+    return results
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2
+
+
+def benchBook(infile, repeat=REPEAT, info=None, processes=1):
+    # returns the result entries of one book, one per mobi header
+    runs = {}
+    counts = {}
+    for r in range(repeat):
+        outdir = tempfile.mkdtemp(prefix='kubench')
+        try:
+            for part, (times, partcounts) in benchOnce(infile, outdir, processes).items():
+                for stage, elapsed in times.items():
+                    runs.setdefault(part, {}).setdefault(stage, []).append(elapsed)
+                counts[part] = partcounts
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+    entries = []
+    for part in sorted(runs):
+        entry = {
+            'book': os.path.basename(infile),
+            'part': part,
+            'filesize': os.path.getsize(pathof(infile)),
+            'stages': {},
+            'counts': counts[part],
+            'processes': processes,
+        }
+        if info:
+            entry.update(info)
+        for stage, times in runs[part].items():
+            entry['stages'][stage] = {'best': min(times), 'median': median(times)}
+        entries.append(entry)
+    return entries
+
+
+def benchGenerated(formats, textsize, parts, images, entries, compression, seed, repeat=REPEAT, fragments=0, processes=1):
+    # generate one book for each format and benchmark it
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='kubench')
+    try:
+        for fmt in formats:
+            if fmt == 'palmdoc':
+                print("Skipping palmdoc, it has no stages beyond decompression worth timing")
+                continue
+            ext = '.azw3' if fmt == 'kf8' else '.mobi'
+            infile = os.path.join(tmpdir, 'synth-%s-%s-%d%s' % (fmt, compression, textsize, ext))
+            print("Generating %s book with %d bytes of %s compressed text" % (fmt, textsize, compression))
+            generateBook(infile, fmt, textsize=textsize, parts=parts, images=images, entries=entries,
+                         compression=compression, seed=seed, fragments=fragments)
+            print("Benchmarking %s" % os.path.basename(infile))
+            info = {'format': fmt, 'compression': compression, 'textsize': textsize,
+                    'parts': parts, 'images': images, 'entries': entries, 'seed': seed,
+                    'fragments': fragments}
+            results.extend(benchBook(infile, repeat, info, processes))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def makeReport(results, repeat):
+    return {
+        'version': BENCH_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def printResults(results):
+    for entry in results:
+        print("%s (%s)" % (entry['book'], entry['part']))
+        counts = entry.get('counts', {})
+        mbytes = counts.get('textBytes', 0) / (1024 * 1024)
+        for stage in sorted(entry['stages']):
+            times = entry['stages'][stage]
+            line = "    %-16s best %9.4fs   median %9.4fs" % (stage, times['best'], times['median'])
+            if mbytes > 0:
+                line += "   %9.4fs/MB" % (times['best'] / mbytes)
+            print(line)
+        for name in sorted(counts):
+            print("    %-16s %s" % (name, counts[name]))
+
+
+def compareReports(base, new):
+    # print the change of the best time of every stage present in both reports
+    basetimes = {}
+    for entry in base['results']:
+        for stage, times in entry['stages'].items():
+            basetimes[(entry['book'], entry['part'], stage)] = times['best']
+    print("%-32s %-6s %-16s %10s %10s %8s" % ('book', 'part', 'stage', 'base', 'new', 'ratio'))
+    for entry in new['results']:
+        for stage in sorted(entry['stages']):
+            key = (entry['book'], entry['part'], stage)
+            if key not in basetimes:
+                continue
+            old = basetimes[key]
+            now = entry['stages'][stage]['best']
+            ratio = now / old if old > 0 else 0.0
+            print("%-32s %-6s %-16s %9.4fs %9.4fs %7.2fx" % (entry['book'], entry['part'], stage, old, now, ratio))
+
+
+def usage(progname):
+    print("")
+    print("Description:")
+    print("  Times the stages of unpacking generated or given ebooks and writes the")
+    print("  results as JSON that can be compared between revisions.")
+    print("Usage:")
+    print("  %s -h -o outfile -r repeat --formats= --size= --parts= --fragments= --images= --entries= --compression= --seed= --compare= --jobs= [infile ...]" % progname)
+    print("Options:")
+    print("    -h                 print this help message")
+    print("    -o OUTFILE         write the results as JSON to OUTFILE")
+    print("    -r REPEAT          number of times each book is unpacked, default is %d" % REPEAT)
+    print("    --formats=         comma separated formats to generate: %s," % ', '.join(FORMATS))
+    print("                         default is mobi7,kf8,dict (ignored when books are given)")
+    print("    --size=            bytes of text in each generated book (K, M and G suffixes allowed),")
+    print("                         default is 1000000")
+    print("    --parts=           number of KF8 parts, default is 50")
+    print("    --fragments=       total number of KF8 fragments, default depends on the size")
+    print("    --images=          number of images, default is 20")
+    print("    --entries=         number of dictionary entries, default is 5000")
+    print("    --compression=     text compression: %s, default is palmdoc" % ', '.join(sorted(COMPRESSIONS)))
+    print("    --seed=            seed for the generated text, default is 0")
+    print("    --compare=BASE     print the change against the results in the JSON file BASE")
+    print("    --jobs=            number of processes buildXHTML rewrites the KF8 parts and")
+    print("                         getPositionMap decodes the orth index in, default is 1")
+
+
+def main(argv=unicode_argv()):
+    progname = os.path.basename(argv[0])
+    try:
+        opts, args = getopt.getopt(argv[1:], "ho:r:", ['formats=', 'size=', 'parts=', 'fragments=', 'images=', 'entries=',
+                                                      'compression=', 'seed=', 'compare=', 'jobs='])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(progname)
+        return 2
+
+    outfile = None
+    comparefile = None
+    repeat = REPEAT
+    formats = ['mobi7', 'kf8', 'dict']
+    textsize = 1000000
+    parts = 50
+    fragments = 0
+    images = 20
+    entries = 5000
+    compression = 'palmdoc'
+    seed = 0
+    processes = 1
+    try:
+        for o, a in opts:
+            if o == "-h":
+                usage(progname)
+                return 0
+            if o == "-o":
+                outfile = a
+            if o == "-r":
+                repeat = int(a)
+            if o == "--formats":
+                formats = a.split(',')
+            if o == "--size":
+                textsize = parseSize(a)
+            if o == "--parts":
+                parts = int(a)
+            if o == "--fragments":
+                fragments = int(a)
+            if o == "--images":
+                images = int(a)
+            if o == "--entries":
+                entries = int(a)
+            if o == "--compression":
+                compression = a
+            if o == "--seed":
+                seed = int(a)
+            if o == "--compare":
+                comparefile = a
+            if o == "--jobs":
+                processes = int(a)
+    except ValueError:
+        print("Error: option needs a number")
+        usage(progname)
+        return 2
+    for fmt in formats:
+        if fmt not in FORMATS:
+            print("Error: unknown format %s" % fmt)
+            return 2
+    if compression not in COMPRESSIONS:
+        print("Error: unknown compression %s" % compression)
+        return 2
+
+    if args:
+        results = []
+        for infile in args:
+            print("Benchmarking %s" % infile)
+            results.extend(benchBook(unicode_str(infile), repeat, processes=processes))
+    else:
+        results = benchGenerated(formats, textsize, parts, images, entries, compression, seed, repeat, fragments, processes)
+    report = makeReport(results, repeat)
+    printResults(results)
+
+    if outfile is not None:
+        with open(pathof(outfile), 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print("Results written to %s" % outfile)
+    if comparefile is not None:
+        with open(pathof(comparefile), 'r') as f:
+            base = json.load(f)
+        compareReports(base, report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
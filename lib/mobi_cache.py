@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+from .compatibility_utils import PY2
+
+if PY2:
+    import cPickle as pickle
+else:
+    import pickle
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from .unipath import pathof
+
+# An optional on disk cache of the expensive intermediate results of unpacking
+# a book: the decompressed raw markup language, the parsed skeleton, fragment,
+# guide and NCX tables and the resource classification.  Everything for one book
+# lives in its own folder named after a hash of the book's content, so a changed
+# book never sees stale data.  Folders are touched whenever they are used and the
+# least recently used ones are removed once the cache grows past its size limit.
+#
+# The parsed tables are stored as pickles and loading a pickle can run code, so
+# the cache folder must not be writable by anyone who should not run code as the
+# user unpacking.  Folders the cache creates are only accessible to their owner.
+
+CACHE_VERSION = 2
+""" Bump whenever the layout or meaning of the cached data changes. """
+
+DEFAULT_CACHE_SIZE = 1024*1024*1024
+""" Default upper bound in bytes for the size of the cache folder. """
+
+HASH_BLOCK_SIZE = 1024*1024
+
+
+def getContentHash(infile):
+    h = hashlib.sha1()
+    h.update(('kindleunpack-cache-%d' % CACHE_VERSION).encode('ascii'))
+    with open(pathof(infile), 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def getDirSize(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except EnvironmentError:
+                pass
+    return size
+
+
+def replaceFile(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # os.rename will not overwrite an existing file on Windows
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class CacheWriter:
+    # Collects a large cached value (like the rawML) as it is produced, nothing
+    # becomes visible in the cache until commit is called
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        fd, self.tmpname = tempfile.mkstemp(dir=cache.bookdir, suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.f.write(data)
+
+    def commit(self, info=None):
+        self.f.close()
+        replaceFile(self.tmpname, self.cache.getPath(self.name + '.dat'))
+        self.cache.saveObject(self.name, info)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmpname)
+        except EnvironmentError:
+            pass
+
+
+class UnpackCache:
+
+    def __init__(self, cachedir, maxsize=DEFAULT_CACHE_SIZE):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.bookdir = None
+        self.key = None
+
+    def openBook(self, infile):
+        self.key = getContentHash(infile)
+        self.bookdir = os.path.join(self.cachedir, self.key)
+        if os.path.isdir(pathof(self.bookdir)):
+            print("Using cached data from %s" % self.bookdir)
+            # mark as most recently used
+            os.utime(pathof(self.bookdir), None)
+        else:
+            os.makedirs(pathof(self.bookdir), 0o700)
+
+    def getPath(self, name):
+        return pathof(os.path.join(self.bookdir, name))
+
+    def loadObject(self, name):
+        # returns the cached python object or None if there is none (or it is unusable)
+        path = self.getPath(name + '.pickle')
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print("Warning: ignoring unreadable cache entry %s: %s" % (name, e))
+            return None
+
+    def saveObject(self, name, value):
+        fd, tmpname = tempfile.mkstemp(dir=self.bookdir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, 2)
+        replaceFile(tmpname, self.getPath(name + '.pickle'))
+
+    def getObject(self, name, sect, compute):
+        # return the cached result of compute() or call it and cache its result.
+        # The section descriptions set while computing it are cached alongside
+        # and reapplied on later hits so dumps and unknown section handling
+        # behave the same either way.
+        cached = self.loadObject(name)
+        if cached is not None:
+            value, descriptions = cached
+            restoreDescriptions(sect, descriptions)
+            return value
+        before = list(sect.sectiondescriptions)
+        value = compute()
+        self.saveObject(name, (value, changedDescriptions(sect, before)))
+        return value
+
+    def openData(self, name):
+        # open file of a cached large value or None, its info object is returned with it
+        path = self.getPath(name + '.dat')
+        info = self.loadObject(name)
+        if info is None or not os.path.exists(path):
+            return None, None
+        return open(path, 'rb'), info
+
+    def createData(self, name):
+        return CacheWriter(self, name)
+
+    def evict(self):
+        # remove the least recently used books until the cache fits in maxsize,
+        # the book in use is never removed
+        books = []
+        total = 0
+        for key in os.listdir(pathof(self.cachedir)):
+            path = os.path.join(self.cachedir, key)
+            if not os.path.isdir(pathof(path)):
+                continue
+            size = getDirSize(pathof(path))
+            total += size
+            books.append((os.path.getmtime(pathof(path)), size, key, path))
+        books.sort()
+        for mtime, size, key, path in books:
+            if total <= self.maxsize:
+                break
+            if key == self.key:
+                continue
+            print("Removing cached data %s" % path)
+            shutil.rmtree(pathof(path), ignore_errors=True)
+            total -= size
+
+
+def changedDescriptions(sect, before):
+    changes = {}
+    for i, description in enumerate(sect.sectiondescriptions):
+        if before[i] != description:
+            changes[i] = description
+    return changes
+
+
+def restoreDescriptions(sect, descriptions):
+    for i in descriptions:
+        sect.setsectiondescription(i, descriptions[i])
@@ -34,7 +34,12 @@ MAX_HEIGHT = 4096
 
 
 def get_image_type(imgname, imgdata=None):
-    imgtype = unicode_str(imghdr.what(pathof(imgname), imgdata))
+    imghead = None
+    if imgdata is not None:
+        # imghdr only ever looks at the first 32 bytes, so there is no need
+        # to copy a whole image that may be a view into a memory mapped book
+        imghead = bytes(imgdata[:32])
+    imgtype = unicode_str(imghdr.what(pathof(imgname), imghead))
 
     # imghdr only checks for JFIF or Exif JPEG files. Apparently, there are some
     # with only the magic JPEG bytes out there...
@@ -14,13 +14,17 @@ if PY3:
     array_format = "B"
 
 import array
+import sys
+import multiprocessing
+from bisect import bisect_right
 
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
 
-from .mobi_index import getVariableWidthValue, readTagSection, getTagMap
-from .mobi_utils import toHex
+from .mobi_index import getVariableWidthValue, readTagSection, getTagMap, getTagDecoder
+from .mobi_utils import toHex, startWorkerPool
+from .mobi_posmap import PositionMap
 
 #python 3.9 dropped support for array tostring()
 def convert_to_bytes(ar):
@@ -30,29 +34,58 @@ def convert_to_bytes(ar):
 
 DEBUG_DICT = False
 
+PARALLEL_MIN_SIZE = 1024*1024
+""" Dictionaries with less orth index data than this are always decoded in a single process. """
+
+PARALLEL_BATCHES_PER_PROCESS = 4
+""" Number of batches of orth index records handed to each worker process. """
+
 class InflectionData(object):
 
     def __init__(self, infldatas):
         self.infldatas = infldatas
         self.starts = []
         self.counts = []
+        # ends[i] is the number of values in the sections up to and including i
+        self.ends = []
+        total = 0
         for idata in self.infldatas:
             start, = struct.unpack_from(b'>L', idata, 0x14)
             count, = struct.unpack_from(b'>L', idata, 0x18)
             self.starts.append(start)
             self.counts.append(count)
+            total += count
+            self.ends.append(total)
+        self.total = total
+        # compiled inflection rules by value, see rule()
+        self.rules = {}
 
     def lookup(self, lookupvalue):
-        i = 0
+        i = bisect_right(self.ends, lookupvalue)
+        if i == len(self.ends):
+            print("Error: Problem with multiple inflections data sections")
+            return lookupvalue, self.starts[0], self.counts[0], self.infldatas[0]
         rvalue = lookupvalue
-        while rvalue >= self.counts[i]:
-            rvalue = rvalue - self.counts[i]
-            i += 1
-            if i == len(self.counts):
-                print("Error: Problem with multiple inflections data sections")
-                return lookupvalue, self.starts[0], self.counts[0], self.infldatas[0]
+        if i > 0:
+            rvalue -= self.ends[i-1]
         return rvalue, self.starts[i], self.counts[i], self.infldatas[i]
 
+    def rule(self, value):
+        # returns (ops, data, start, end) for the inflection rule with this value:
+        # the rule is data[start:end] and ops its compiled form (None if it can
+        # only be interpreted).  Rules are shared by many words so each is looked
+        # up and compiled once.
+        rule = self.rules.get(value)
+        if rule is None:
+            rvalue, start, count, data = self.lookup(value)
+            offset, = struct.unpack_from(b'>H', data, start + 4 + (2 * rvalue))
+            textLength = ord(data[offset:offset+1])
+            rule = (compileInflectionRule(data, offset+1, offset+1+textLength), data, offset+1, offset+1+textLength)
+            # values outside of the sections report an error on every lookup
+            if value < self.total:
+                self.rules[value] = rule
+        return rule
+
     def offsets(self, value):
         rvalue, start, count, data = self.lookup(value)
         offset, = struct.unpack_from(b'>H', data, start + 4 + (2 * rvalue))
@@ -63,14 +96,167 @@ class InflectionData(object):
         return offset, nextOffset, data
 
 
+# An inflection rule is a series of bytes: 0x01 to 0x04 select inserting at the
+# word start, inserting at the word end, deleting at the word end and deleting at
+# the word start, 0x0a to 0x13 move the cursor back from the word end and any
+# byte above 0x13 is a character to insert or delete (see applyInflectionRule).
+# compileInflectionRule turns the runs of characters into operations that are
+# made on the word with slicing:
+#   (0x01, pos, chars)  insert chars at pos from the word start
+#   (0x02, pos, chars)  insert chars at pos from the word end
+#   (0x03, pos, chars)  delete chars ending at pos from the word end
+#   (0x04, pos, chars)  delete chars at pos from the word start
+# Characters inserted at the word end go in front of each other and those
+# deleted there are taken from the back, so their runs are kept reversed.
+
+def compileInflectionRule(data, start, end):
+    # returns the list of operations of the rule data[start:end] or None if the
+    # rule has bytes that are errors, which are left for applyInflectionRule to
+    # report
+    ops = []
+    mode = -1
+    # from the word start for modes 0x01 and 0x04, from the end for 0x02 and 0x03
+    position = 0
+    for charOffset in range(start, end):
+        char = data[charOffset:charOffset+1]
+        abyte = ord(char)
+        if abyte >= 0x0a and abyte <= 0x13:
+            # Move cursor backwards
+            if mode not in [0x02, 0x03]:
+                mode = 0x02
+                position = 0
+            position += abyte - 0x0a
+        elif abyte > 0x13:
+            if mode == -1:
+                return None
+            op = ops[-1] if ops else (None, None, b'')
+            if mode == 0x01:
+                if op[0] == mode and op[1] + len(op[2]) == position:
+                    ops[-1] = (mode, op[1], op[2] + char)
+                else:
+                    ops.append((mode, position, char))
+                position += 1
+            elif mode == 0x02:
+                if op[0] == mode and op[1] + len(op[2]) == position:
+                    ops[-1] = (mode, op[1], char + op[2])
+                else:
+                    ops.append((mode, position, char))
+                position += 1
+            elif mode == 0x03:
+                if op[0] == mode and op[1] == position:
+                    ops[-1] = (mode, position, char + op[2])
+                else:
+                    ops.append((mode, position, char))
+            else:
+                if op[0] == mode and op[1] == position:
+                    ops[-1] = (mode, position, op[2] + char)
+                else:
+                    ops.append((mode, position, char))
+        elif abyte == 0x01 or abyte == 0x04:
+            if mode not in [0x01, 0x04]:
+                position = 0
+            mode = abyte
+        elif abyte == 0x02 or abyte == 0x03:
+            if mode not in [0x02, 0x03]:
+                position = 0
+            mode = abyte
+        else:
+            return None
+    return ops
+
+def applyCompiledRule(word, ops):
+    # returns the inflected word or None if the rule does not fit the word (a
+    # position outside of it or a failed delete), applyInflectionRule then gives
+    # the same result as it always did and reports any error
+    for mode, position, chars in ops:
+        size = len(word)
+        if mode == 0x01:
+            if position > size:
+                return None
+            word = word[:position] + chars + word[position:]
+        elif mode == 0x02:
+            position = size - position
+            if position < 0:
+                return None
+            word = word[:position] + chars + word[position:]
+        elif mode == 0x03:
+            position = size - position
+            if position < len(chars) or word[position-len(chars):position] != chars:
+                return None
+            word = word[:position-len(chars)] + word[position:]
+        else:
+            if word[position:position+len(chars)] != chars:
+                return None
+            word = word[:position] + word[position+len(chars):]
+    return word
+
+
+class OrthTables(object):
+    # what decoding the records of the orth index needs besides their data: the
+    # tag table of the index, its ORDT table and the inflection data
+    def __init__(self, controlByteCount, tagTable, hordt2, otype, hasEntryLength):
+        self.controlByteCount = controlByteCount
+        self.tagTable = tagTable
+        self.hordt2 = hordt2
+        self.otype = otype
+        self.hasEntryLength = hasEntryLength
+        self.decodeInflection = False
+        self.inflectionControlByteCount = None
+        self.inflectionTagTable = None
+        self.dinfl = None
+        self.inflNameData = None
+
+
+class _OutputCollector(object):
+    # stands in for stdout in a worker process, the parent prints what was written
+    def __init__(self):
+        self.texts = []
+
+    def write(self, text):
+        self.texts.append(text)
+
+    def flush(self):
+        pass
+
+
+# the orth index records can be decoded in worker processes, each worker gets the
+# tables once when it starts and then handles batches of records
+_worker_dict = None
+_worker_tables = None
+_worker_decoder = None
+
+def _initOrthWorker(tables):
+    global _worker_dict, _worker_tables, _worker_decoder
+    _worker_dict = dictSupport(None, None)
+    _worker_tables = tables
+    _worker_decoder = getTagDecoder(tables.controlByteCount, tables.tagTable)
+
+def _decodeOrthBatch(batch):
+    records, collect = batch
+    positionMap = PositionMap()
+    entries = [] if collect else None
+    stdout = sys.stdout
+    sys.stdout = output = _OutputCollector()
+    try:
+        _worker_dict.decodeOrthRecords(records, _worker_tables, _worker_decoder, positionMap, entries)
+    finally:
+        sys.stdout = stdout
+    return positionMap, entries, "".join(output.texts)
+
+
 class dictSupport(object):
 
     def __init__(self, mh, sect):
         self.mh = mh
-        self.header = mh.header
         self.sect = sect
-        self.metaOrthIndex = mh.metaOrthIndex
-        self.metaInflIndex = mh.metaInflIndex
+        # the tag maps of the inflection groups and the inflection names by value
+        self.inflectionTagMaps = {}
+        self.inflectionNameCache = {}
+        # worker processes only decode records and have no header
+        if mh is not None:
+            self.header = mh.header
+            self.metaOrthIndex = mh.metaOrthIndex
+            self.metaInflIndex = mh.metaInflIndex
 
     def parseHeader(self, data):
         "read INDX header"
@@ -119,10 +305,15 @@ class dictSupport(object):
             print("\n")
         return header, ordt1, ordt2
 
-    def getPositionMap(self):
+    def getPositionMap(self, processes=1, database=None):
+        # processes > 1 allows the orth index records to be decoded by a pool of
+        # that many worker processes, 0 or None uses one per cpu.  Dictionaries
+        # with less than PARALLEL_MIN_SIZE bytes of orth index records are always
+        # done in this process.  The entries are also added to database if one
+        # is given (see mobi_dictdb), the caller closes it.
         sect = self.sect
 
-        positionMap = {}
+        positionMap = PositionMap()
 
         metaOrthIndex = self.metaOrthIndex
         metaInflIndex = self.metaInflIndex
@@ -133,7 +324,7 @@ class dictSupport(object):
             if metaInflIndex == 0xFFFFFFFF:
                 decodeInflection = False
             else:
-                metaInflIndexData = sect.loadSection(metaInflIndex)
+                metaInflIndexData = bytes(sect.loadSection(metaInflIndex))
 
                 print("\nParsing metaInflIndexData")
                 midxhdr, mhordt1, mhordt2 = self.parseHeader(metaInflIndexData)
@@ -141,10 +332,10 @@ class dictSupport(object):
                 metaIndexCount = midxhdr['count']
                 idatas = []
                 for j in range(metaIndexCount):
-                    idatas.append(sect.loadSection(metaInflIndex + 1 + j))
+                    idatas.append(bytes(sect.loadSection(metaInflIndex + 1 + j)))
                 dinfl = InflectionData(idatas)
 
-                inflNameData = sect.loadSection(metaInflIndex + 1 + metaIndexCount)
+                inflNameData = bytes(sect.loadSection(metaInflIndex + 1 + metaIndexCount))
                 tagSectionStart = midxhdr['len']
                 inflectionControlByteCount, inflectionTagTable = readTagSection(tagSectionStart, metaInflIndexData)
                 if DEBUG_DICT:
@@ -153,7 +344,7 @@ class dictSupport(object):
                     print("Error: Dictionary uses obsolete inflection rule scheme which is not yet supported")
                     decodeInflection = False
 
-            data = sect.loadSection(metaOrthIndex)
+            data = bytes(sect.loadSection(metaOrthIndex))
 
             print("\nParsing metaOrthIndex")
             idxhdr, hordt1, hordt2 = self.parseHeader(data)
@@ -170,71 +361,114 @@ class dictSupport(object):
             if not hasEntryLength:
                 print("Info: Index doesn't contain entry length tags")
 
+            tables = OrthTables(controlByteCount, tagTable, hordt2, idxhdr['otype'], hasEntryLength)
+            if decodeInflection:
+                tables.decodeInflection = True
+                tables.inflectionControlByteCount = inflectionControlByteCount
+                tables.inflectionTagTable = inflectionTagTable
+                tables.dinfl = dinfl
+                tables.inflNameData = inflNameData
+
             print("Read dictionary index data")
-            for i in range(metaOrthIndex + 1, metaOrthIndex + 1 + orthIndexCount):
-                data = sect.loadSection(i)
-                hdrinfo, ordt1, ordt2 = self.parseHeader(data)
-                idxtPos = hdrinfo['start']
-                entryCount = hdrinfo['count']
-                idxPositions = []
-                for j in range(entryCount):
-                    pos, = struct.unpack_from(b'>H', data, idxtPos + 4 + (2 * j))
-                    idxPositions.append(pos)
-                # The last entry ends before the IDXT tag (but there might be zero fill bytes we need to ignore!)
-                idxPositions.append(idxtPos)
-                for j in range(entryCount):
-                    startPos = idxPositions[j]
-                    endPos = idxPositions[j+1]
-                    textLength = ord(data[startPos:startPos+1])
-                    text = data[startPos+1:startPos+1+textLength]
-                    if hordt2 is not None:
-                        utext = u""
-                        if idxhdr['otype'] == 0:
-                            pattern = b'>H'
-                            inc = 2
-                        else:
-                            pattern = b'>B'
-                            inc = 1
-                        pos = 0
-                        while pos < textLength:
-                            off, = struct.unpack_from(pattern, text, pos)
-                            if off < len(hordt2):
-                                utext += unichr(hordt2[off])
-                            else:
-                                utext += unichr(off)
-                            pos += inc
-                        text = utext.encode('utf-8')
-
-                    tagMap = getTagMap(controlByteCount, tagTable, data, startPos+1+textLength, endPos)
-                    if 0x01 in tagMap:
-                        if decodeInflection and 0x2a in tagMap:
-                            inflectionGroups = self.getInflectionGroups(text, inflectionControlByteCount, inflectionTagTable,
-                                                                        dinfl, inflNameData, tagMap[0x2a])
-                        else:
-                            inflectionGroups = b''
-                        assert len(tagMap[0x01]) == 1
-                        entryStartPosition = tagMap[0x01][0]
-                        if hasEntryLength:
-                            # The idx:entry attribute "scriptable" must be present to create entry length tags.
-                            ml = b'<idx:entry scriptable="yes"><idx:orth value="' + text + b'">' + inflectionGroups + b'</idx:orth>'
-                            if entryStartPosition in positionMap:
-                                positionMap[entryStartPosition] = positionMap[entryStartPosition] + ml
-                            else:
-                                positionMap[entryStartPosition] = ml
-                            assert len(tagMap[0x02]) == 1
-                            entryEndPosition = entryStartPosition + tagMap[0x02][0]
-                            if entryEndPosition in positionMap:
-                                positionMap[entryEndPosition] = b"</idx:entry>" + positionMap[entryEndPosition]
-                            else:
-                                positionMap[entryEndPosition] = b"</idx:entry>"
+            records = [bytes(sect.loadSection(i)) for i in range(metaOrthIndex + 1, metaOrthIndex + 1 + orthIndexCount)]
+            # the ORDT lookup gives utf-8 encoded words
+            codec = 'utf-8' if hordt2 is not None else self.mh.codec
+            workers = None
+            if not processes:
+                try:
+                    processes = multiprocessing.cpu_count()
+                except NotImplementedError:
+                    processes = 1
+            if processes > 1 and len(records) > 1 and sum(len(data) for data in records) >= PARALLEL_MIN_SIZE:
+                batches = self.getOrthBatches(records, processes, database is not None)
+                workers = startWorkerPool(min(processes, len(batches)), _initOrthWorker, (tables,), "decoding the index")
+            if workers is None:
+                decoder = getTagDecoder(controlByteCount, tagTable)
+                for data in records:
+                    entries = [] if database is not None else None
+                    self.decodeOrthRecords([data], tables, decoder, positionMap, entries)
+                    if database is not None:
+                        database.addEntries(entries, codec)
+            else:
+                # decode the batches in the worker processes and merge their
+                # partial maps in record order
+                with workers as pool:
+                    for partialMap, entries, output in pool.imap(_decodeOrthBatch, batches):
+                        if output:
+                            sys.stdout.write(output)
+                        positionMap.extend(partialMap)
+                        if database is not None:
+                            database.addEntries(entries, codec)
+        return positionMap
 
+    def getOrthBatches(self, records, processes, collect=False):
+        # split the records for the worker processes.  Batches are runs of records
+        # of about the same total size, a few per worker so the work stays
+        # balanced.  With collect the workers also return the entries for the
+        # database.
+        batchsize = sum(len(data) for data in records) // (processes * PARALLEL_BATCHES_PER_PROCESS) + 1
+        batches = []
+        start = 0
+        size = 0
+        for i in range(len(records)):
+            size += len(records[i])
+            if size >= batchsize or i == len(records) - 1:
+                batches.append((records[start:i+1], collect))
+                start = i + 1
+                size = 0
+        return batches
+
+    def decodeOrthRecords(self, records, tables, decoder, positionMap, entries=None):
+        # decode a run of orth index records into positionMap, the markup ending
+        # entries is prepended at its position and the markup starting them
+        # appended.  If entries is a list the (headword, start, length, forms)
+        # of every entry are added to it.
+        hordt2 = tables.hordt2
+        if tables.otype == 0:
+            pattern = b'>H'
+            inc = 2
+        else:
+            pattern = b'>B'
+            inc = 1
+        for data in records:
+            hdrinfo, ordt1, ordt2 = self.parseHeader(data)
+            for text, tagMap in decoder.decodeRecord(data, hdrinfo['start'], hdrinfo['count']):
+                if hordt2 is not None:
+                    textLength = len(text)
+                    utext = u""
+                    pos = 0
+                    while pos < textLength:
+                        off, = struct.unpack_from(pattern, text, pos)
+                        if off < len(hordt2):
+                            utext += unichr(hordt2[off])
                         else:
-                            indexTags = b'<idx:entry>\n<idx:orth value="' + text + b'">\n' + inflectionGroups + b'</idx:entry>\n'
-                            if entryStartPosition in positionMap:
-                                positionMap[entryStartPosition] = positionMap[entryStartPosition] + indexTags
-                            else:
-                                positionMap[entryStartPosition] = indexTags
-        return positionMap
+                            utext += unichr(off)
+                        pos += inc
+                    text = utext.encode('utf-8')
+
+                if 0x01 in tagMap:
+                    forms = [] if entries is not None else None
+                    if tables.decodeInflection and 0x2a in tagMap:
+                        inflectionGroups = self.getInflectionGroups(text, tables.inflectionControlByteCount, tables.inflectionTagTable,
+                                                                    tables.dinfl, tables.inflNameData, tagMap[0x2a], forms)
+                    else:
+                        inflectionGroups = b''
+                    assert len(tagMap[0x01]) == 1
+                    entryStartPosition = tagMap[0x01][0]
+                    if entries is not None:
+                        entryLength = tagMap[0x02][0] if tables.hasEntryLength else None
+                        entries.append((text, entryStartPosition, entryLength, forms))
+                    if tables.hasEntryLength:
+                        # The idx:entry attribute "scriptable" must be present to create entry length tags.
+                        ml = b'<idx:entry scriptable="yes"><idx:orth value="' + text + b'">' + inflectionGroups + b'</idx:orth>'
+                        positionMap.append(entryStartPosition, ml)
+                        assert len(tagMap[0x02]) == 1
+                        entryEndPosition = entryStartPosition + tagMap[0x02][0]
+                        positionMap.prepend(entryEndPosition, b"</idx:entry>")
+
+                    else:
+                        indexTags = b'<idx:entry>\n<idx:orth value="' + text + b'">\n' + inflectionGroups + b'</idx:entry>\n'
+                        positionMap.append(entryStartPosition, indexTags)
 
     def hasTag(self, tagTable, tag):
         '''
@@ -249,7 +483,7 @@ class dictSupport(object):
                 return True
         return False
 
-    def getInflectionGroups(self, mainEntry, controlByteCount, tagTable, dinfl, inflectionNames, groupList):
+    def getInflectionGroups(self, mainEntry, controlByteCount, tagTable, dinfl, inflectionNames, groupList, forms=None):
         '''
         Create string which contains the inflection groups with inflection rules as mobipocket tags.
 
@@ -259,15 +493,21 @@ class dictSupport(object):
         @param data: The Inflection data object to properly select the right inflection data section to use
         @param inflectionNames: The inflection rule name data.
         @param groupList: The list of inflection groups to process.
+        @param forms: Optional list the (name, inflected word) of the inflections are added to.
         @return: String with inflection groups and rules or empty string if required tags are not available.
         '''
-        result = b""
+        result = []
+        groupforms = []
         for value in groupList:
-            offset, nextOffset, data = dinfl.offsets(value)
+            tagMap = self.inflectionTagMaps.get(value)
+            if tagMap is None:
+                offset, nextOffset, data = dinfl.offsets(value)
 
-            # First byte seems to be always 0x00 and must be skipped.
-            assert ord(data[offset:offset+1]) == 0x00
-            tagMap = getTagMap(controlByteCount, tagTable, data, offset + 1, nextOffset)
+                # First byte seems to be always 0x00 and must be skipped.
+                assert ord(data[offset:offset+1]) == 0x00
+                tagMap = getTagMap(controlByteCount, tagTable, data, offset + 1, nextOffset)
+                if value < dinfl.total:
+                    self.inflectionTagMaps[value] = tagMap
 
             # Make sure that the required tags are available.
             if 0x05 not in tagMap:
@@ -277,26 +517,33 @@ class dictSupport(object):
                 print("Error: Required tag 0x1a not found in tagMap")
                 return b''
 
-            result += b'<idx:infl>'
+            result.append(b'<idx:infl>')
 
             for i in range(len(tagMap[0x05])):
 
                 # Get name of inflection rule.
                 value = tagMap[0x05][i]
-                consumed, textLength = getVariableWidthValue(inflectionNames, value)
-                inflectionName = inflectionNames[value+consumed:value+consumed+textLength]
+                inflectionName = self.inflectionNameCache.get(value)
+                if inflectionName is None:
+                    consumed, textLength = getVariableWidthValue(inflectionNames, value)
+                    inflectionName = inflectionNames[value+consumed:value+consumed+textLength]
+                    self.inflectionNameCache[value] = inflectionName
 
                 # Get and apply inflection rule across possibly multiple inflection data sections
-                value = tagMap[0x1a][i]
-                rvalue, start, count, data = dinfl.lookup(value)
-                offset, = struct.unpack_from(b'>H', data, start + 4 + (2 * rvalue))
-                textLength = ord(data[offset:offset+1])
-                inflection = self.applyInflectionRule(mainEntry, data, offset+1, offset+1+textLength)
+                ops, data, start, end = dinfl.rule(tagMap[0x1a][i])
+                inflection = None
+                if ops is not None:
+                    inflection = applyCompiledRule(mainEntry, ops)
+                if inflection is None:
+                    inflection = self.applyInflectionRule(mainEntry, data, start, end)
                 if inflection is not None:
-                    result += b'  <idx:iform name="' + inflectionName + b'" value="' + inflection + b'"/>'
+                    result.append(b'  <idx:iform name="' + inflectionName + b'" value="' + inflection + b'"/>')
+                    groupforms.append((inflectionName, inflection))
 
-            result += b'</idx:infl>'
-        return result
+            result.append(b'</idx:infl>')
+        if forms is not None:
+            forms.extend(groupforms)
+        return b"".join(result)
 
     def applyInflectionRule(self, mainEntry, inflectionRuleData, start, end):
         '''
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+from .compatibility_utils import PY2
+
+if PY2:
+    range = xrange
+
+import os
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from .unipath import pathof
+from .unpack_structure import unpackException
+
+# An optional export of the entries of a dictionary to an SQLite database, so a
+# lookup service can find a word without parsing the index or the html again.
+# Every entry of the orth index is a row of the headwords table with the start
+# and length of the entry in the raw markup language (tags 0x01 and 0x02 of the
+# index, the length is NULL when the index has no length tags).  The inflected
+# forms of an entry are rows of the forms table that point back to it.  Both
+# tables get an index on the word once all rows are in.
+#
+#   CREATE TABLE headwords (id INTEGER PRIMARY KEY, headword TEXT, start INTEGER, length INTEGER)
+#   CREATE TABLE forms (headword_id INTEGER, name TEXT, form TEXT)
+#
+# A word is then looked up with
+#
+#   SELECT id, start, length FROM headwords WHERE headword = ?
+#   SELECT headword_id FROM forms WHERE form = ?
+
+DB_BATCH_SIZE = 10000
+""" Number of rows inserted into the database at a time. """
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+class DictionaryDatabase(object):
+
+    def __init__(self, path, codec):
+        # codec is the text encoding of the book, the inflection names are in it
+        if sqlite3 is None:
+            raise unpackException('the sqlite3 module is not available to write %s' % path)
+        self.path = path
+        self.codec = codec
+        if os.path.exists(pathof(path)):
+            # only ever replace an earlier export, never some other file given by mistake
+            with open(pathof(path), 'rb') as f:
+                magic = f.read(len(SQLITE_MAGIC))
+            if magic != SQLITE_MAGIC:
+                raise unpackException('%s exists and is not an SQLite database, not replacing it' % path)
+            print("Warning: replacing the existing database %s" % path)
+            os.remove(pathof(path))
+        self.db = sqlite3.connect(pathof(path))
+        # the database is written once from scratch, nothing to recover if that fails
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE headwords (id INTEGER PRIMARY KEY, headword TEXT NOT NULL, start INTEGER NOT NULL, length INTEGER)')
+        self.db.execute('CREATE TABLE forms (headword_id INTEGER NOT NULL, name TEXT, form TEXT NOT NULL)')
+        self.count = 0
+        self.headwords = []
+        self.forms = []
+
+    def addEntries(self, entries, codec):
+        # entries is a list of (headword, start, length, [(name, form), ...]) in
+        # index order with the headword and forms in the text encoding codec
+        for headword, start, length, forms in entries:
+            self.count += 1
+            self.headwords.append((self.count, headword.decode(codec, 'replace'), start, length))
+            for name, form in forms:
+                self.forms.append((self.count, name.decode(self.codec, 'replace'), form.decode(codec, 'replace')))
+            if len(self.headwords) + len(self.forms) >= DB_BATCH_SIZE:
+                self.flush()
+
+    def flush(self):
+        if self.headwords:
+            self.db.executemany('INSERT INTO headwords VALUES (?, ?, ?, ?)', self.headwords)
+            self.headwords = []
+        if self.forms:
+            self.db.executemany('INSERT INTO forms VALUES (?, ?, ?)', self.forms)
+            self.forms = []
+
+    def close(self):
+        self.flush()
+        self.db.execute('CREATE INDEX headwords_headword ON headwords (headword)')
+        self.db.execute('CREATE INDEX forms_form ON forms (form)')
+        self.db.commit()
+        self.db.close()
+        print("Wrote %d dictionary entries to %s" % (self.count, self.path))
+
+    def abort(self):
+        # close and remove a database that could not be completed
+        self.db.close()
+        if os.path.exists(pathof(self.path)):
+            os.remove(pathof(self.path))
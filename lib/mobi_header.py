@@ -19,15 +19,78 @@ if PY2:
 
 import struct
 import uuid
+import multiprocessing
+from bisect import bisect_right
+from collections import OrderedDict
 
 # import the mobiunpack support libraries
-from .mobi_utils import getLanguage
+from .mobi_utils import getLanguage, startWorkerPool
 from .mobi_uncompress import HuffcdicReader, PalmdocReader, UncompressedReader
+from .mobi_cache import changedDescriptions, restoreDescriptions
+
+PARALLEL_MIN_SIZE = 4*1024*1024
+""" Books with less compressed text than this are always decompressed in a single process. """
+
+PARALLEL_BATCH_RECORDS = 64
+""" Number of text records sent to a worker process at a time. """
+
+RECORD_CACHE_SIZE = 64
+""" Number of decompressed text records kept for getRawMLRange. """
+
+CACHE_CHUNK_SIZE = 64*1024
+""" Size of the chunks the raw markup language is read back from the unpack cache in. """
 
 class unpackException(Exception):
     pass
 
 
+def getUnpacker(compression, huffdata=None):
+    # return the unpack function for the given compression type,
+    # huffdata holds the HUFF record followed by the CDIC records
+    if compression == 0x4448:
+        reader = HuffcdicReader()
+        reader.loadHuff(huffdata[0])
+        for cdic in huffdata[1:]:
+            reader.loadCdic(cdic)
+        return reader.unpack
+    elif compression == 2:
+        return PalmdocReader().unpack
+    elif compression == 1:
+        return UncompressedReader().unpack
+    raise unpackException('invalid compression type: 0x%4x' % compression)
+
+
+def getSizeOfTrailingDataEntry(data):
+    num = 0
+    for v in data[-4:]:
+        if bord(v) & 0x80:
+            num = 0
+        num = (num << 7) | (bord(v) & 0x7f)
+    return num
+
+
+def trimTrailingDataEntries(data, trailers, multibyte):
+    for _ in range(trailers):
+        num = getSizeOfTrailingDataEntry(data)
+        data = data[:-num]
+    if multibyte:
+        num = (bord(data[-1]) & 3) + 1
+        data = data[:-num]
+    return data
+
+
+# text records can be decompressed in worker processes, each worker builds its
+# own unpacker (and huffman tables) once when it starts and then handles batches
+_worker_unpack = None
+
+def _initUnpackWorker(compression, huffdata):
+    global _worker_unpack
+    _worker_unpack = getUnpacker(compression, huffdata)
+
+def _unpackBatch(batch):
+    return [_worker_unpack(data) for data in batch]
+
+
 def sortedHeaderKeys(mheader):
     hdrkeys = sorted(list(mheader.keys()), key=lambda akey: mheader[akey][0])
     return hdrkeys
@@ -500,7 +563,9 @@ class MobiHeader:
     def __init__(self, sect, sectNumber):
         self.sect = sect
         self.start = sectNumber
-        self.header = self.sect.loadSection(self.start)
+        # record 0 is small and sliced all over, so keep a private bytes copy
+        # even when the sectionizer hands out memory mapped views
+        self.header = bytes(self.sect.loadSection(self.start))
         if len(self.header)>20 and self.header[16:20] == b'MOBI':
             self.sect.setsectiondescription(0,"Mobipocket Header")
             self.palm = False
@@ -534,30 +599,32 @@ class MobiHeader:
         self.fragidx = 0xffffffff
         self.guideidx = 0xffffffff
         self.fdst = 0xffffffff
-        self.mlstart = self.sect.loadSection(self.start+1)[:4]
+        self.mlstart = bytes(self.sect.loadSection(self.start+1)[:4])
         self.rawSize = 0
         self.metadata = dict_()
+        self.recordcache = OrderedDict()
+        self.recordoffsets = None
+        self.textrecordsize = None
+        # optional mobi_cache.UnpackCache shared by everything working on this header
+        self.cache = None
 
         # set up for decompression/unpacking
         self.compression, = struct.unpack_from(b'>H', self.header, 0x0)
+        self.huffdata = None
         if self.compression == 0x4448:
-            reader = HuffcdicReader()
             huffoff, huffnum = struct.unpack_from(b'>LL', self.header, 0x70)
             huffoff = huffoff + self.start
             self.sect.setsectiondescription(huffoff,"Huffman Compression Seed")
-            reader.loadHuff(self.sect.loadSection(huffoff))
+            self.huffdata = [bytes(self.sect.loadSection(huffoff))]
             for i in range(1, huffnum):
                 self.sect.setsectiondescription(huffoff+i,"Huffman CDIC Compression Seed %d" % i)
-                reader.loadCdic(self.sect.loadSection(huffoff+i))
-            self.unpack = reader.unpack
-        elif self.compression == 2:
-            self.unpack = PalmdocReader().unpack
-        elif self.compression == 1:
-            self.unpack = UncompressedReader().unpack
-        else:
-            raise unpackException('invalid compression type: 0x%4x' % self.compression)
+                self.huffdata.append(bytes(self.sect.loadSection(huffoff+i)))
+        self.unpack = getUnpacker(self.compression, self.huffdata)
 
         if self.palm:
+            # no EXTH, only the database name as title
+            self.title = self.title.rstrip('\x00')
+            self.addBasicMetaData()
             return
 
         self.length, self.type, self.codepage, self.unique_id, self.version = struct.unpack(b'>LLLLL', self.header[20:40])
@@ -789,6 +856,8 @@ class MobiHeader:
         return self.unpack(data)
 
     def Language(self):
+        if self.palm:
+            return getLanguage(0, 0)
         langcode = struct.unpack(b'!L', self.header[0x5c:0x60])[0]
         langid = langcode & 0xFF
         sublangid = (langcode >> 10) & 0xFF
@@ -812,22 +881,9 @@ class MobiHeader:
                 return getLanguage(langid, sublangid)
         return False
 
-    def getRawML(self):
-        def getSizeOfTrailingDataEntry(data):
-            num = 0
-            for v in data[-4:]:
-                if bord(v) & 0x80:
-                    num = 0
-                num = (num << 7) | (bord(v) & 0x7f)
-            return num
-        def trimTrailingDataEntries(data):
-            for _ in range(trailers):
-                num = getSizeOfTrailingDataEntry(data)
-                data = data[:-num]
-            if multibyte:
-                num = (ord(data[-1:]) & 3) + 1
-                data = data[:-num]
-            return data
+    def getTrailingEntryInfo(self):
+        # returns the number of trailing data entries and whether a multibyte
+        # entry follows them at the end of each text record
         multibyte = 0
         trailers = 0
         if self.sect.ident == b'BOOKMOBI':
@@ -840,22 +896,187 @@ class MobiHeader:
                     if flags & 2:
                         trailers += 1
                     flags = flags >> 1
+        return trailers, multibyte
+
+    def loadTextRecord(self, i):
+        # load text record i (1 based) with its trailing entries removed
+        trailers, multibyte = self.getTrailingEntryInfo()
+        if self.isK8():
+            self.sect.setsectiondescription(self.start + i,"KF8 Text Section {0:d}".format(i))
+        elif self.version == 0:
+            self.sect.setsectiondescription(self.start + i,"PalmDOC Text Section {0:d}".format(i))
+        else:
+            self.sect.setsectiondescription(self.start + i,"Mobipocket Text Section {0:d}".format(i))
+        return trimTrailingDataEntries(self.sect.loadSection(self.start + i), trailers, multibyte)
+
+    def getRawML(self, processes=1):
+        # processes > 1 allows the text records to be decompressed by a pool of that
+        # many worker processes, 0 or None uses one per cpu.  Books with less than
+        # PARALLEL_MIN_SIZE bytes of compressed text are always done in this process.
+        rawML = b''.join([chunk for offset, chunk in self.iterRawML(processes)])
+        self.rawSize = len(rawML)
+        return rawML
+
+    def iterRawML(self, processes=1):
+        # generator of (offset, chunk) pairs, one per text record, that lets callers
+        # work through the raw markup language without holding all of it at once,
+        # self.rawSize is set once the last chunk has been produced
+        if self.cache is not None:
+            cachename = 'rawml-%d' % self.start
+            f, info = self.cache.openData(cachename)
+            if f is not None:
+                # chunks come straight from the cached copy
+                print("Reading cached raw markup language")
+                restoreDescriptions(self.sect, info)
+                with f:
+                    offset = 0
+                    while True:
+                        chunk = f.read(CACHE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield offset, chunk
+                        offset += len(chunk)
+                self.rawSize = offset
+                return
+            before = list(self.sect.sectiondescriptions)
+            writer = self.cache.createData(cachename)
+            completed = False
+            try:
+                for offset, chunk in self.iterUnpackedRawML(processes):
+                    writer.write(chunk)
+                    yield offset, chunk
+                completed = True
+            finally:
+                if completed:
+                    writer.commit(changedDescriptions(self.sect, before))
+                else:
+                    writer.abort()
+            return
+        for offset, chunk in self.iterUnpackedRawML(processes):
+            yield offset, chunk
+
+    def iterUnpackedRawML(self, processes=1):
         # get raw mobi markup languge
         print("Unpacking raw markup language")
-        dataList = []
-        # offset = 0
-        for i in range(1, self.records+1):
-            data = trimTrailingDataEntries(self.sect.loadSection(self.start + i))
-            dataList.append(self.unpack(data))
-            if self.isK8():
-                self.sect.setsectiondescription(self.start + i,"KF8 Text Section {0:d}".format(i))
-            elif self.version == 0:
-                self.sect.setsectiondescription(self.start + i,"PalmDOC Text Section {0:d}".format(i))
+        if not processes:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        offset = 0
+        if processes > 1 and self.compression != 1:
+            records = [self.loadTextRecord(i) for i in range(1, self.records+1)]
+            workers = None
+            if sum(len(data) for data in records) >= PARALLEL_MIN_SIZE:
+                processes = min(processes, (len(records) + PARALLEL_BATCH_RECORDS - 1) // PARALLEL_BATCH_RECORDS)
+                workers = startWorkerPool(processes, _initUnpackWorker, (self.compression, self.huffdata), "decompressing")
+            if workers is not None:
+                # decompress batches of records in the worker processes, the
+                # results come back in record order
+                with workers as pool:
+                    for result in pool.imap(_unpackBatch, self.unpackBatches(records)):
+                        for chunk in result:
+                            yield offset, chunk
+                            offset += len(chunk)
             else:
-                self.sect.setsectiondescription(self.start + i,"Mobipocket Text Section {0:d}".format(i))
-        rawML = b''.join(dataList)
-        self.rawSize = len(rawML)
-        return rawML
+                for data in records:
+                    chunk = self.unpack(data)
+                    yield offset, chunk
+                    offset += len(chunk)
+        else:
+            for i in range(1, self.records+1):
+                chunk = self.unpack(self.loadTextRecord(i))
+                yield offset, chunk
+                offset += len(chunk)
+        self.rawSize = offset
+
+    def getTextRecord(self, i):
+        # decompressed text record i (1 based), recently used records are cached
+        data = self.recordcache.get(i)
+        if data is not None:
+            del self.recordcache[i]
+        else:
+            data = self.unpack(self.loadTextRecord(i))
+        self.recordcache[i] = data
+        while len(self.recordcache) > RECORD_CACHE_SIZE:
+            self.recordcache.popitem(last=False)
+        return data
+
+    def getRawMLRange(self, start, end):
+        # return rawML[start:end] decompressing only the text records that cover it.
+        # Every text record but the last normally holds text_record_size bytes, so
+        # while the header agrees the records of the range follow from start and
+        # end.  The records decompressed for the range confirm their sizes, once
+        # one of them does not the offsets of the records are found by
+        # decompressing them in order instead (and kept in the cache if there is one).
+        if start < 0:
+            raise unpackException('rawML range can not start at negative offset %d' % start)
+        if self.recordoffsets is None and self.cache is not None:
+            self.recordoffsets = self.cache.loadObject('rawml-offsets-%d' % self.start)
+        if self.recordoffsets is None and self.getTextRecordSize() > 0:
+            data = self.getFixedSizeRange(start, end)
+            if data is not None:
+                return data
+        offsets = self.findRecordOffsets(end)
+        end = min(end, offsets[-1])
+        if end <= start:
+            return b''
+        first = bisect_right(offsets, start)
+        last = bisect_right(offsets, end - 1)
+        dataList = [self.getTextRecord(i) for i in range(first, last + 1)]
+        base = offsets[first - 1]
+        return b''.join(dataList)[start - base:end - base]
+
+    def getTextRecordSize(self):
+        # the size of the text records (header 0x0A) if the text length (header
+        # 0x04) says that all but the last one are full, else 0
+        if self.textrecordsize is None:
+            textlength, records, recsize = struct.unpack_from(b'>LHH', self.header, 0x4)
+            self.textrecordsize = 0
+            if recsize > 0 and records > 0 and (records - 1) * recsize < textlength <= records * recsize:
+                self.textrecordsize = recsize
+        return self.textrecordsize
+
+    def getFixedSizeRange(self, start, end):
+        # rawML[start:end] from the records at the offsets the text record size
+        # gives, or None when one of those records turns out to have another size
+        recsize = self.getTextRecordSize()
+        textlength, = struct.unpack_from(b'>L', self.header, 0x4)
+        end = min(end, textlength)
+        if end <= start:
+            return b''
+        first = start // recsize + 1
+        last = (end - 1) // recsize + 1
+        dataList = []
+        for i in range(first, last + 1):
+            data = self.getTextRecord(i)
+            if len(data) != (recsize if i < self.records else textlength - (i - 1) * recsize):
+                print("Warning: text record %d does not hold the text record size, finding the offsets of the records" % i)
+                self.textrecordsize = 0
+                return None
+            dataList.append(data)
+        base = (first - 1) * recsize
+        return b''.join(dataList)[start - base:end - base]
+
+    def findRecordOffsets(self, end=None):
+        # rawML offsets of the start of the text records plus, once the last one
+        # was reached, the total length.  They are found by decompressing each
+        # record once, only as far as needed to get past end (None for all).
+        if self.recordoffsets is None:
+            self.recordoffsets = [0]
+        offsets = self.recordoffsets
+        known = len(offsets)
+        while len(offsets) <= self.records and (end is None or offsets[-1] < end):
+            offsets.append(offsets[-1] + len(self.getTextRecord(len(offsets))))
+        if self.cache is not None and len(offsets) > known:
+            self.cache.saveObject('rawml-offsets-%d' % self.start, offsets)
+        return offsets
+
+    def unpackBatches(self, records):
+        # generator of the batches of records handed to the worker processes
+        for j in range(0, len(records), PARALLEL_BATCH_RECORDS):
+            # views of a memory mapped file can not be pickled
+            yield [bytes(data) for data in records[j:j+PARALLEL_BATCH_RECORDS]]
 
     # all metadata is stored in a dictionary with key and returns a *list* of values
     # a list is used to allow for multiple creators, multiple contributors, etc
@@ -905,6 +1126,9 @@ class MobiHeader:
                     addValue(name, hexlify(content))
                 pos += size
 
+        self.addBasicMetaData()
+
+    def addBasicMetaData(self):
         # add the basics to the metadata each as a list element
         self.metadata['Language'] = [self.Language()]
         self.metadata['Title'] = [unicode_str(self.title,self.codec)]
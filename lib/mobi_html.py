@@ -9,11 +9,31 @@ from .compatibility_utils import PY2, utf8_str
 if PY2:
     range = xrange
 
+import os
 import re
+import multiprocessing
 # note: re requites the pattern to be the exact same type as the data to be searched in python3
 # but u"" is not allowed for the pattern itself only b""
 
-from .mobi_utils import fromBase32
+from .mobi_utils import fromBase32, toBase32, startWorkerPool
+from .unipath import pathof
+
+# Patterns of the rewrites made to the html of older mobis
+_filepos_pattern = re.compile(br'''<[^<>]+filepos=['"]{0,1}(\d+)[^<>]*>''', re.IGNORECASE)
+_filepos_link_pattern = re.compile(br'''<a([^>]*?)filepos=['"]{0,1}0*(\d+)['"]{0,1}([^>]*?)>''', re.IGNORECASE)
+_empty_anchor_pattern = re.compile(br"<a\s*/>")
+_empty_link_pattern = re.compile(br"<a\s*>\s*</a>")
+# the rewrites of all those patterns in one pass, see HTMLProcessor.rewriteHTML
+_html_rewrite_pattern = re.compile(br'''<(?:a\s*>(?:\s|<a\s*/>)*</a>|a\s*/>'''
+                                   br'''|([aA][^>]*[fF][iI][lL][eE][pP][oO][sS]=[^>]*>)'''
+                                   br'''|([iI][mM][gG][^>\n]*>))''')
+_not_angle_brackets = bytes(bytearray([c for c in range(256) if c not in (0x3c, 0x3e)]))
+_image_pattern = re.compile(br'''(<img.*?>)''', re.IGNORECASE)
+_image_index_pattern = re.compile(br'''recindex=['"]{0,1}([0-9]+)['"]{0,1}''', re.IGNORECASE)
+
+HTML_BLOCK_SIZE = 1024*1024
+""" Approximate size of the blocks of text writeHTML rewrites at a time. """
+
 
 class HTMLProcessor:
 
@@ -25,86 +45,276 @@ class HTMLProcessor:
         self.used = {}
         for name in rscnames:
             self.used[name] = 'used'
+        self.pos_links = None
 
-    def findAnchors(self, rawtext, indx_data, positionMap):
-        # process the raw text
-        # find anchors...
-        print("Find link anchors")
-        link_pattern = re.compile(br'''<[^<>]+filepos=['"]{0,1}(\d+)[^<>]*>''', re.IGNORECASE)
+    def addAnchors(self, pos_links, indx_data, positionMap):
         # TEST NCX: merge in filepos from indx
-        pos_links = [int(m.group(1)) for m in link_pattern.finditer(rawtext)]
         if indx_data:
             pos_indx = [e['pos'] for e in indx_data if e['pos']>0]
             pos_links = list(set(pos_links + pos_indx))
 
         for position in pos_links:
-            if position in positionMap:
-                positionMap[position] = positionMap[position] + utf8_str('<a id="filepos%d" />' % position)
-            else:
-                positionMap[position] = utf8_str('<a id="filepos%d" />' % position)
-
-        # apply dictionary metadata and anchors
-        print("Insert data into html")
-        pos = 0
-        lastPos = len(rawtext)
-        dataList = []
-        for end in sorted(positionMap.keys()):
-            if end == 0 or end > lastPos:
-                continue  # something's up - can't put a tag in outside <html>...</html>
-            dataList.append(rawtext[pos:end])
-            dataList.append(positionMap[end])
-            pos = end
-        dataList.append(rawtext[pos:])
-        srctext = b"".join(dataList)
-        rawtext = None
-        dataList = None
-        self.srctext = srctext
-        self.indx_data = indx_data
-        return srctext
-
-    def insertHREFS(self):
-        srctext = self.srctext
-        rscnames = self.rscnames
-        metadata = self.metadata
+            positionMap.append(position, utf8_str('<a id="filepos%d" />' % position))
+
+    def rewriteHTML(self, text):
+        # the link, empty anchor and image rewrites made in one pass over text.
+        # When every '<' starts a tag that ends at the next '>' no pattern can
+        # match across a tag and the rewrites are a choice between the tags that
+        # the combined pattern finds, else they are left to the separate passes.
+        brackets = text.translate(None, _not_angle_brackets)
+        if b'<<' in brackets or brackets.endswith(b'<'):
+            return self.rewriteHTMLPasses(text)
+        return _html_rewrite_pattern.sub(self.rewriteTag, text)
+
+    def rewriteTag(self, m):
+        if m.group(1) is not None:
+            return _filepos_link_pattern.sub(br'''<a\1href="#filepos\2"\3>''', b'<' + m.group(1))
+        if m.group(2) is not None:
+            return self.rewriteImageTag(b'<' + m.group(2))
+        # an empty anchor or a link with nothing but those and whitespace in it
+        return b''
+
+    def rewriteHTMLPasses(self, srctext):
+        # the link, empty anchor and image rewrites, applied one after another
+        srctext = _filepos_link_pattern.sub(br'''<a\1href="#filepos\2"\3>''', srctext)
+        srctext = _empty_anchor_pattern.sub(br"", srctext)
+        srctext = _empty_link_pattern.sub(br"", srctext)
 
-        # put in the hrefs
-        print("Insert hrefs into html")
-        # There doesn't seem to be a standard, so search as best as we can
-
-        link_pattern = re.compile(br'''<a([^>]*?)filepos=['"]{0,1}0*(\d+)['"]{0,1}([^>]*?)>''', re.IGNORECASE)
-        srctext = link_pattern.sub(br'''<a\1href="#filepos\2"\3>''', srctext)
-
-        # remove empty anchors
-        print("Remove empty anchors from html")
-        srctext = re.sub(br"<a\s*/>",br"", srctext)
-        srctext = re.sub(br"<a\s*>\s*</a>",br"", srctext)
-
-        # convert image references
-        print("Insert image references into html")
         # split string into image tag pieces and other pieces
-        image_pattern = re.compile(br'''(<img.*?>)''', re.IGNORECASE)
-        image_index_pattern = re.compile(br'''recindex=['"]{0,1}([0-9]+)['"]{0,1}''', re.IGNORECASE)
-        srcpieces = image_pattern.split(srctext)
-        srctext = self.srctext = None
+        srcpieces = _image_pattern.split(srctext)
+        srctext = None
 
         # all odd pieces are image tags (nulls string on even pieces if no space between them in srctext)
         for i in range(1, len(srcpieces), 2):
-            tag = srcpieces[i]
-            for m in image_index_pattern.finditer(tag):
-                imageNumber = int(m.group(1))
-                imageName = rscnames[imageNumber-1]
-                if imageName is None:
-                    print("Error: Referenced image %s was not recognized as a valid image" % imageNumber)
-                else:
-                    replacement = b'src="Images/' + utf8_str(imageName) + b'"'
-                    tag = image_index_pattern.sub(replacement, tag, 1)
-            srcpieces[i] = tag
-        srctext = b"".join(srcpieces)
+            srcpieces[i] = self.rewriteImageTag(srcpieces[i])
+        return b"".join(srcpieces)
 
-        # add in character set meta into the html header if needed
-        if 'Codec' in metadata:
-            srctext = srctext[0:12]+b'<meta http-equiv="content-type" content="text/html; charset='+utf8_str(metadata.get('Codec')[0])+b'" />'+srctext[12:]
-        return srctext, self.used
+    def rewriteImageTag(self, tag):
+        rscnames = self.rscnames
+        for m in _image_index_pattern.finditer(tag):
+            imageNumber = int(m.group(1))
+            imageName = rscnames[imageNumber-1]
+            if imageName is None:
+                print("Error: Referenced image %s was not recognized as a valid image" % imageNumber)
+            else:
+                replacement = b'src="Images/' + utf8_str(imageName) + b'"'
+                tag = _image_index_pattern.sub(replacement, tag, 1)
+        return tag
+
+    # The html is made in two passes over the raw text: findLinks finds the
+    # filepos links, writeHTML inserts the anchors and dictionary data and
+    # rewrites the text a block at a time straight into the html file.  Only a
+    # block and the anchors are held in memory.
+
+    def findLinks(self, rawchunks):
+        # first pass over the chunks of raw text, returns its length.  No filepos
+        # link can contain a '>' so the text is searched up to the last one and
+        # the rest is carried over to the next chunk.
+        pos_links = []
+        carry = b''
+        base = 0
+        for chunk in rawchunks:
+            text = carry + chunk
+            end = text.rfind(b'>') + 1
+            pos_links.extend([int(m.group(1)) for m in _filepos_pattern.finditer(text, 0, end)])
+            carry = text[end:]
+            base += end
+        pos_links.extend([int(m.group(1)) for m in _filepos_pattern.finditer(carry)])
+        self.pos_links = pos_links
+        return base + len(carry)
+
+    def writeHTML(self, rawchunks, rawsize, indx_data, positionMap, outfile):
+        # second pass, writes the html to the open file outfile and returns the
+        # contents of its guide (as the search on the whole text found it) or
+        # None and the map of used resources
+        print("Find link anchors")
+        self.addAnchors(self.pos_links, indx_data, positionMap)
+        self.pos_links = None
+        print("Insert data into html")
+        print("Insert hrefs into html")
+        print("Remove empty anchors from html")
+        print("Insert image references into html")
+        writer = HTMLWriter(outfile)
+        if 'Codec' in self.metadata:
+            writer.meta = b'<meta http-equiv="content-type" content="text/html; charset='+utf8_str(self.metadata.get('Codec')[0])+b'" />'
+        # the markup inserted into the text, in order
+        inserts = ((end, markup) for end, markup in positionMap.inserts() if end != 0 and end <= rawsize)
+        insert = next(inserts, None)
+        block = []
+        blocksize = 0
+        carry = b''
+        offset = 0
+        for chunk in rawchunks:
+            chunkend = offset + len(chunk)
+            pos = offset
+            while insert is not None and insert[0] <= chunkend:
+                end, markup = insert
+                block.append(chunk[pos-offset:end-offset])
+                block.append(markup)
+                blocksize += end - pos + len(markup)
+                pos = end
+                insert = next(inserts, None)
+            block.append(chunk[pos-offset:])
+            blocksize += chunkend - pos
+            offset = chunkend
+            if blocksize >= HTML_BLOCK_SIZE:
+                text = carry + b''.join(block)
+                cut = findBlockEnd(text)
+                writer.write(self.rewriteHTML(text[:cut]))
+                carry = text[cut:]
+                block = []
+                blocksize = 0
+        writer.write(self.rewriteHTML(carry + b''.join(block)))
+        return writer.close(), self.used
+
+
+def findBlockEnd(text):
+    # The rewrites of rewriteHTML can be made block by block when no match of any
+    # of their patterns crosses from one block into the next, even after the
+    # earlier rewrites changed the text.  That holds after a '>' followed by text
+    # that is neither whitespace nor a tag unless the '>' ends an <a or </a tag,
+    # which the empty anchor removals could take away.  Returns the end of the
+    # block of text that can be rewritten on its own (0 if there is none yet).
+    end = len(text)
+    while True:
+        end = text.rfind(b'>', 0, end)
+        if end < 0:
+            return 0
+        nextchar = text[end+1:end+2]
+        if nextchar != b'' and nextchar not in b' \t\n\r\f\v<':
+            start = text.rfind(b'<', 0, end)
+            if start < 0 or (text[start:start+2] != b'<a' and text[start:start+3] != b'</a'):
+                return end + 1
+
+
+class HTMLWriter(object):
+    # writes the html of writeHTML to a file, puts the character set meta after
+    # the first 12 bytes and finds the <guide>(.*)</guide> match of the whole text
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.meta = None
+        self.head = b''
+        self.written = 0
+        self.tail = b''
+        self.guidestart = None
+        self.guideend = None
+
+    def write(self, data):
+        if self.meta is not None:
+            self.head += data
+            if len(self.head) < 12:
+                return
+            data = self.head[0:12] + self.meta + self.head[12:]
+            self.meta = None
+            self.head = b''
+        if not data:
+            return
+        # look for the guide tags in the text written so far
+        window = (self.tail + data).lower()
+        base = self.written - len(self.tail)
+        if self.guidestart is None:
+            pos = window.find(b'<guide>')
+            if pos >= 0:
+                self.guidestart = base + pos + len(b'<guide>')
+        pos = window.rfind(b'</guide>')
+        if pos >= 0:
+            self.guideend = base + pos
+        self.tail = window[-7:]
+        self.outfile.write(data)
+        self.written += len(data)
+
+    def close(self):
+        # returns the text between the first <guide> and the last </guide> or None
+        if self.meta is not None:
+            data = self.head + self.meta
+            self.meta = None
+            self.write(data)
+        if self.guidestart is None or self.guideend is None or self.guideend < self.guidestart:
+            return None
+        self.outfile.flush()
+        self.outfile.seek(self.guidestart)
+        guidetext = self.outfile.read(self.guideend - self.guidestart)
+        self.outfile.seek(0, 2)
+        return guidetext
+
+
+# Patterns of the rewrites made to the xhtml parts of KF8 books.  Each used to be
+# a separate pass over the text of every part (split into pieces, rewrite and
+# join), now XHTMLK8Processor.rewritePart makes them all on one walk over the
+# tags of a part.  The split patterns still pick the tags each rewrite applies to.
+
+# kindlegen generated aid attributes
+_aid_tag_pattern = re.compile(br'''(<[^>]*\said\s*=[^>]*>)''', re.IGNORECASE)
+_aid_attribute_pattern = re.compile(br'''\said\s*=['"]([^'"]*)['"]''')
+_has_aid_pattern = re.compile(br'''\said\s*=''', re.IGNORECASE)
+
+# kindlegen generated data-AmznPageBreak attributes
+_pagebreak_tag_pattern = re.compile(br'''(<[^>]*\sdata-AmznPageBreak=[^>]*>)''', re.IGNORECASE)
+_pagebreak_attribute_pattern = re.compile(br'''\sdata-AmznPageBreak=['"]([^'"]*)['"]''')
+_has_pagebreak_pattern = re.compile(br'''\sdata-AmznPageBreak=''', re.IGNORECASE)
+
+# kindle:flow:XXXX?mime=YYYY/ZZZ (used for style sheets, svg images, etc)
+_tag_pattern = re.compile(br'''(<[^>]*>)''')
+_flow_pattern = re.compile(br'''['"]kindle:flow:([0-9|A-V]+)\?mime=([^'"]+)['"]''', re.IGNORECASE)
+
+# kindle:embed:XXXX in url()s of style attributes
+_style_pattern = re.compile(br'''(<[a-zA-Z0-9]+\s[^>]*style\s*=\s*[^>]*>)''', re.IGNORECASE)
+_style_img_index_pattern = re.compile(br'''[('"]kindle:embed:([0-9|A-V]+)[^'"]*['")]''', re.IGNORECASE)
+
+# kindle:embed:XXXX?mime=image/gif (png, jpeg, etc) (used for images)
+_img_pattern = re.compile(br'''(<[img\s|image\s][^>]*>)''', re.IGNORECASE)
+_img_index_pattern = re.compile(br'''['"]kindle:embed:([0-9|A-V]+)[^'"]*['"]''')
+
+# <li> value="XX" attributes are illegal in xhtml
+_li_value_pattern = re.compile(br'''\svalue\s*=\s*['"][^'"]*['"]''', re.IGNORECASE)
+
+# The aid and page break passes also rewrote such attributes found in the text
+# between the tags, the single pass leaves parts that have any of those to the
+# separate passes.
+_text_attribute_pattern = re.compile(br'''\s(?:aid\s*=|data-AmznPageBreak=)''', re.IGNORECASE)
+
+# fixed layout books get a viewport meta tag in every part that has none
+_viewport_pattern = re.compile(br'''<meta\s[^>]*name\s*=\s*["'][^"'>]*viewport["'][^>]*>''', re.IGNORECASE)
+
+PARALLEL_MIN_SIZE = 4*1024*1024
+""" Parts of books with less xhtml text than this are always rewritten in a single process. """
+
+PARALLEL_BATCHES_PER_PROCESS = 4
+""" Number of batches of parts handed to each worker process. """
+
+
+class _PartTables(object):
+    # the tables of K8Processor the rewrites of the parts read, these are all
+    # a worker process needs of it
+    def __init__(self, k8proc):
+        self.flowinfo = k8proc.flowinfo
+        self.linked_aids = k8proc.linked_aids
+
+    def getFlowInfo(self,i):
+        if i > 0 and i < len(self.flowinfo):
+            return self.flowinfo[i]
+        return None
+
+
+# the parts can be rewritten in worker processes, each worker gets the resource
+# names, flows and K8Processor tables once when it starts and then handles batches
+_worker_htmlproc = None
+_worker_flows = None
+
+def _initPartWorker(rscnames, tables, flows, viewport):
+    global _worker_htmlproc, _worker_flows
+    _worker_htmlproc = XHTMLK8Processor(rscnames, tables, viewport)
+    _worker_flows = flows
+
+def _rewritePartBatch(batch):
+    parts, paths = batch
+    proc = _worker_htmlproc
+    proc.used = {}
+    proc.passes = 0
+    messages = ([], [], [])
+    parts = proc.rewriteParts(parts, paths, _worker_flows, messages)
+    return parts, proc.used, messages, proc.passes
 
 
 class XHTMLK8Processor:
@@ -114,8 +324,23 @@ class XHTMLK8Processor:
         self.k8proc = k8proc
         self.viewport = viewport
         self.used = {}
-
-    def buildXHTML(self):
+        # number of passes made over the whole text of a part
+        self.passes = 0
+        # resolution tables of the base32 numbers in kindle:embed and kindle:flow
+        # links, filled in for every resource and flow under the usual 4 digit
+        # form of their number, any other form is added when first seen
+        self.embeds = {}
+        for i in range(len(rscnames)):
+            name = rscnames[i]
+            self.embeds[toBase32(i+1)] = (name, utf8_str(name) if name is not None else None)
+        self.flowlinks = {}
+        for i in range(1, len(k8proc.flowinfo)):
+            self.flowlinks[toBase32(i)] = (i, k8proc.getFlowInfo(i))
+
+    def buildXHTML(self, processes=1, outdir=None):
+        # processes > 1 lets a pool of that many worker processes rewrite the
+        # parts of large books, 0 or None uses one per cpu.  With an outdir each
+        # part is also written to its file there as soon as it is done.
 
         # first need to update all links that are internal which
         # are based on positions within the xhtml files **BEFORE**
@@ -134,8 +359,14 @@ class XHTMLK8Processor:
         for i in range(self.k8proc.getNumberOfParts()):
             part = self.k8proc.getPart(i)
             [partnum, dir, filename, beg, end, aidtext] = self.k8proc.getPartInfo(i)
+            if b'kindle:pos:fid' not in part:
+                parts.append(part)
+                continue
 
             # internal links
+            # (the targets of all links must be known before the aid attributes
+            # of any part are rewritten so this stays a pass of its own)
+            self.passes += 1
             srcpieces = posfid_pattern.split(part)
             for j in range(1, len(srcpieces),2):
                 tag = srcpieces[j]
@@ -153,45 +384,6 @@ class XHTMLK8Processor:
             part = b"".join(srcpieces)
             parts.append(part)
 
-        # we are free to cut and paste as we see fit
-        # we can safely remove all of the Kindlegen generated aid tags
-        # change aid ids that are in k8proc.linked_aids to xhtml ids
-        find_tag_with_aid_pattern = re.compile(br'''(<[^>]*\said\s*=[^>]*>)''', re.IGNORECASE)
-        within_tag_aid_position_pattern = re.compile(br'''\said\s*=['"]([^'"]*)['"]''')
-        for i in range(len(parts)):
-            part = parts[i]
-            srcpieces = find_tag_with_aid_pattern.split(part)
-            for j in range(len(srcpieces)):
-                tag = srcpieces[j]
-                if tag.startswith(b'<'):
-                    for m in within_tag_aid_position_pattern.finditer(tag):
-                        try:
-                            aid = m.group(1)
-                        except IndexError:
-                            aid = None
-                        replacement = b''
-                        if aid in self.k8proc.linked_aids:
-                            replacement = b' id="aid-' + aid + b'"'
-                        tag = within_tag_aid_position_pattern.sub(replacement, tag, 1)
-                    srcpieces[j] = tag
-            part = b"".join(srcpieces)
-            parts[i] = part
-
-        # we can safely replace all of the Kindlegen generated data-AmznPageBreak tags
-        # with page-break-after style patterns
-        find_tag_with_AmznPageBreak_pattern = re.compile(br'''(<[^>]*\sdata-AmznPageBreak=[^>]*>)''', re.IGNORECASE)
-        within_tag_AmznPageBreak_position_pattern = re.compile(br'''\sdata-AmznPageBreak=['"]([^'"]*)['"]''')
-        for i in range(len(parts)):
-            part = parts[i]
-            srcpieces = find_tag_with_AmznPageBreak_pattern.split(part)
-            for j in range(len(srcpieces)):
-                tag = srcpieces[j]
-                if tag.startswith(b'<'):
-                    srcpieces[j] = within_tag_AmznPageBreak_position_pattern.sub(
-                        lambda m:b' style="page-break-after:' + m.group(1) + b'"', tag)
-            part = b"".join(srcpieces)
-            parts[i] = part
-
         # we have to handle substitutions for the flows  pieces first as they may
         # be inlined into the xhtml text
         #   kindle:embed:XXXX?mime=image/gif (png, jpeg, etc) (used for images)
@@ -226,16 +418,14 @@ class XHTMLK8Processor:
             for j in range(1, len(srcpieces),2):
                 tag = srcpieces[j]
                 if tag.startswith(b'<im'):
-                    for m in img_index_pattern.finditer(tag):
-                        imageNumber = fromBase32(m.group(1))
-                        imageName = self.rscnames[imageNumber-1]
-                        if imageName is not None:
-                            replacement = b'"../Images/' + utf8_str(imageName) + b'"'
-                            self.used[imageName] = 'used'
-                            tag = img_index_pattern.sub(replacement, tag, 1)
-                        else:
-                            print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
-                    srcpieces[j] = tag
+                    def replaceImage(m):
+                        imageName, imageBytes = self.resolveEmbed(m.group(1))
+                        if imageName is None:
+                            print("Error: Referenced image %s was not recognized as a valid image in %s" % (fromBase32(m.group(1)), tag))
+                            return m.group()
+                        self.used[imageName] = 'used'
+                        return b'"../Images/' + imageBytes + b'"'
+                    srcpieces[j] = img_index_pattern.sub(replaceImage, tag)
             flowpart = b"".join(srcpieces)
 
             # replacements inside css url():
@@ -244,46 +434,33 @@ class XHTMLK8Processor:
                 tag = srcpieces[j]
 
                 #  process links to raster image files
-                for m in url_img_index_pattern.finditer(tag):
-                    imageNumber = fromBase32(m.group(1))
-                    imageName = self.rscnames[imageNumber-1]
-                    osep = m.group()[0:1]
-                    csep = m.group()[-1:]
-                    if imageName is not None:
-                        replacement = osep +  b'../Images/' + utf8_str(imageName) +  csep
-                        self.used[imageName] = 'used'
-                        tag = url_img_index_pattern.sub(replacement, tag, 1)
-                    else:
-                        print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
+                def replaceImage(m):
+                    imageName, imageBytes = self.resolveEmbed(m.group(1))
+                    if imageName is None:
+                        print("Error: Referenced image %s was not recognized as a valid image in %s" % (fromBase32(m.group(1)), tag))
+                        return m.group()
+                    self.used[imageName] = 'used'
+                    return m.group()[0:1] + b'../Images/' + imageBytes + m.group()[-1:]
+                tag = url_img_index_pattern.sub(replaceImage, tag)
 
                 # process links to fonts
-                for m in font_index_pattern.finditer(tag):
-                    fontNumber = fromBase32(m.group(1))
-                    fontName = self.rscnames[fontNumber-1]
-                    osep = m.group()[0:1]
-                    csep = m.group()[-1:]
+                def replaceFont(m):
+                    fontName, fontBytes = self.resolveEmbed(m.group(1))
                     if fontName is None:
-                        print("Error: Referenced font %s was not recognized as a valid font in %s" % (fontNumber, tag))
-                    else:
-                        replacement = osep +  b'../Fonts/' + utf8_str(fontName) +  csep
-                        tag = font_index_pattern.sub(replacement, tag, 1)
-                        self.used[fontName] = 'used'
-
-                # process links to other css pieces
-                for m in url_css_index_pattern.finditer(tag):
-                    num = fromBase32(m.group(1))
-                    [typ, fmt, pdir, fnm] = self.k8proc.getFlowInfo(num)
-                    replacement = b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"'
-                    tag = url_css_index_pattern.sub(replacement, tag, 1)
-                    self.used[fnm] = 'used'
-
-                # process links to svg images
-                for m in url_svg_image_pattern.finditer(tag):
-                    num = fromBase32(m.group(1))
-                    [typ, fmt, pdir, fnm] = self.k8proc.getFlowInfo(num)
-                    replacement = b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"'
-                    tag = url_svg_image_pattern.sub(replacement, tag, 1)
+                        print("Error: Referenced font %s was not recognized as a valid font in %s" % (fromBase32(m.group(1)), tag))
+                        return m.group()
+                    self.used[fontName] = 'used'
+                    return m.group()[0:1] + b'../Fonts/' + fontBytes + m.group()[-1:]
+                tag = font_index_pattern.sub(replaceFont, tag)
+
+                # process links to other css pieces and to svg images
+                def replaceFlow(m):
+                    num, info = self.resolveFlow(m.group(1))
+                    [typ, fmt, pdir, fnm] = info
                     self.used[fnm] = 'used'
+                    return b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"'
+                tag = url_css_index_pattern.sub(replaceFlow, tag)
+                tag = url_svg_image_pattern.sub(replaceFlow, tag)
 
                 srcpieces[j] = tag
             flowpart = b"".join(srcpieces)
@@ -317,137 +494,328 @@ class XHTMLK8Processor:
 
         # now handle the main text xhtml parts
 
-        # Handle the flow items in the XHTML text pieces
-        # kindle:flow:XXXX?mime=YYYY/ZZZ (used for style sheets, svg images, etc)
-        tag_pattern = re.compile(br'''(<[^>]*>)''')
-        flow_pattern = re.compile(br'''['"]kindle:flow:([0-9|A-V]+)\?mime=([^'"]+)['"]''', re.IGNORECASE)
-        for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
-            # flow pattern
-            srcpieces = tag_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if tag.startswith(b'<'):
-                    for m in flow_pattern.finditer(tag):
-                        num = fromBase32(m.group(1))
-                        if num > 0 and num < len(self.k8proc.flowinfo):
-                            [typ, fmt, pdir, fnm] = self.k8proc.getFlowInfo(num)
-                            flowpart = flows[num]
-                            if fmt == b'inline':
-                                tag = flowpart
-                            else:
-                                replacement = b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"'
-                                tag = flow_pattern.sub(replacement, tag, 1)
-                                self.used[fnm] = 'used'
-                        else:
-                            print("warning: ignoring non-existent flow link", tag, " value 0x%x" % num)
-                    srcpieces[j] = tag
-            part = b''.join(srcpieces)
+        # all other rewrites of the xhtml text are made in one pass over the tags
+        # of each part, the messages of each rewrite are printed together
+        # afterwards to keep them in the order the separate passes gave them
+        paths = [None] * len(parts)
+        if outdir is not None:
+            for i in range(len(parts)):
+                [partnum, dir, filename, beg, end, aidtext] = self.k8proc.getPartInfo(i)
+                paths[i] = os.path.join(outdir, dir, filename)
+        messages = ([], [], [])
+        workers = None
+        if not processes:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        if processes > 1 and len(parts) > 1 and sum(len(part) for part in parts) >= PARALLEL_MIN_SIZE:
+            batches = self.getPartBatches(parts, paths, processes)
+            tables = _PartTables(self.k8proc)
+            workers = startWorkerPool(min(processes, len(batches)), _initPartWorker, (self.rscnames, tables, flows, self.viewport),
+                                      "rewriting the parts")
+        if workers is None:
+            parts = self.rewriteParts(parts, paths, flows, messages)
+        else:
+            # rewrite (and write) the batches in the worker processes, the
+            # results come back in part order
+            parts = []
+            with workers as pool:
+                for newparts, used, batchmessages, passes in pool.imap(_rewritePartBatch, batches):
+                    parts.extend(newparts)
+                    self.used.update(used)
+                    for msglist, batchmsglist in zip(messages, batchmessages):
+                        msglist.extend(batchmsglist)
+                    self.passes += passes
+        for msglist in messages:
+            for msg in msglist:
+                print(*msg)
 
-            # store away modified version
-            parts[i] = part
+        self.k8proc.setFlows(flows)
+        self.k8proc.setParts(parts)
 
-        # Handle any embedded raster images links in style= attributes urls
-        style_pattern = re.compile(br'''(<[a-zA-Z0-9]+\s[^>]*style\s*=\s*[^>]*>)''', re.IGNORECASE)
-        img_index_pattern = re.compile(br'''[('"]kindle:embed:([0-9|A-V]+)[^'"]*['")]''', re.IGNORECASE)
+        return self.used
 
+    def rewriteParts(self, parts, paths, flows, messages):
+        # rewrite a run of parts and write each to its path if it has one
+        newparts = []
+        for part, path in zip(parts, paths):
+            newpart = self.rewritePart(part, flows, messages)
+            if newpart is None:
+                newpart = self.rewritePartPasses(part, flows, messages)
+            part = newpart
+
+            # handle injection viewport meta data if needed in each xhtml file
+            if self.viewport:
+                injected_meta = b'<meta name="viewport" content="' + utf8_str(self.viewport) + b'"/>\n'
+                # only inject if a viewport meta item does not already exist in that part
+                if not _viewport_pattern.search(part):
+                    endheadpos = part.find(b'</head>')
+                    if endheadpos >= 0:
+                        part = part[0:endheadpos] + injected_meta + part[endheadpos:]
+
+            if path is not None:
+                with open(pathof(path),'wb') as f:
+                    f.write(part)
+            newparts.append(part)
+        return newparts
+
+    def getPartBatches(self, parts, paths, processes):
+        # split the parts for the worker processes.  Batches are runs of parts of
+        # about the same total size, a few per worker so the work stays balanced.
+        batchsize = sum(len(part) for part in parts) // (processes * PARALLEL_BATCHES_PER_PROCESS) + 1
+        batches = []
+        start = 0
+        size = 0
         for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
+            size += len(parts[i])
+            if size >= batchsize or i == len(parts) - 1:
+                batches.append((parts[start:i+1], paths[start:i+1]))
+                start = i + 1
+                size = 0
+        return batches
+
+    def rewritePart(self, part, flows, messages):
+        # make all rewrites of the xhtml text of one part in a single pass over
+        # its tags, returns None if the part needs the separate passes
+        pieces = []
+        last = 0
+        textstart = 0
+        # only keep the messages if the part is done here
+        partmessages = ([], [], [])
+        for m in _tag_pattern.finditer(part):
+            start = m.start()
+            if part.find(b'=', textstart, start) >= 0 and _text_attribute_pattern.search(part, textstart, start) is not None:
+                return None
+            textstart = m.end()
+            tag = m.group()
+            if b'=' not in tag and b':' not in tag and tag[1:2] not in b'sSlL':
+                # nothing to do for most closing tags (every kindle: link has a colon)
+                continue
+            newtag = self.rewriteTag(tag, flows, partmessages)
+            if newtag is None:
+                return None
+            if newtag != tag:
+                pieces.append(part[last:start])
+                pieces.append(newtag)
+                last = textstart
+        if _text_attribute_pattern.search(part, textstart) is not None:
+            return None
+        pieces.append(part[last:])
+        for msglist, partmsglist in zip(messages, partmessages):
+            msglist.extend(partmsglist)
+        self.passes += 1
+        return b''.join(pieces)
+
+    def rewriteTag(self, tag, flows, messages):
+        # apply the rewrites to one tag in the order the separate passes made them,
+        # cheap substring tests pick the rewrites that can apply before their patterns
+        # are tried (the lower case copy is kept up to date for the case
+        # insensitive ones)
+        if b'=' not in tag and b'kindle:embed' not in tag and b'kindle:flow' not in tag.lower():
+            return self.cleanupTag(tag)
+        if tag.startswith(b'<p aid="') and tag.find(b'"', 8) == len(tag) - 2:
+            # by far the most common tag in kindlegen output, the same as
+            # rewriteAidTag for values without quotes or backslashes
+            aid = tag[8:-2]
+            if b"'" not in aid and b'\\' not in aid:
+                if aid in self.k8proc.linked_aids:
+                    return b'<p id="aid-' + aid + b'">'
+                return b'<p>'
+        low = tag.lower()
+        if b'aid' in low and _has_aid_pattern.search(tag) is not None:
+            tag = self.rewriteAidTag(tag)
+            low = tag.lower()
+        if b'amznpagebreak' in low and _has_pagebreak_pattern.search(tag) is not None:
+            tag = self.rewritePageBreakTag(tag)
+            low = tag.lower()
+        if b'kindle:flow' in low:
+            tag, inlined = self.rewriteFlowTag(tag, flows, messages[0])
+            if inlined:
+                # the tag was replaced by an inlined flow, rewrite the tags in it
+                if tag.rfind(b'<') > tag.rfind(b'>'):
+                    # an unfinished tag at the end would run on into the text after it
+                    return None
+                return _tag_pattern.sub(lambda m: self.finishTag(m.group(), messages), tag)
+        return self.finishTag(tag, messages)
+
+    def finishTag(self, tag, messages):
+        # the rewrites that follow the flow links
+        if b'kindle:embed' in tag:
+            m = _style_pattern.search(tag)
+            if m is not None:
+                newtag = self.rewriteStyleTag(m.group(), messages[1])
+                tag = tag[:m.start()] + newtag + tag[m.end():]
+            m = _img_pattern.search(tag)
+            if m is not None:
+                newtag = self.rewriteImageTag(m.group(), messages[2])
+                tag = tag[:m.start()] + newtag + tag[m.end():]
+        return self.cleanupTag(tag)
+
+    def rewritePartPasses(self, part, flows, messages):
+        # the rewrites as separate passes over the part
 
-            # replace urls in style attributes
-            srcpieces = style_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if b'kindle:embed' in tag:
-                    for m in img_index_pattern.finditer(tag):
-                        imageNumber = fromBase32(m.group(1))
-                        imageName = self.rscnames[imageNumber-1]
-                        osep = m.group()[0:1]
-                        csep = m.group()[-1:]
-                        if imageName is not None:
-                            replacement = osep + b'../Images/'+ utf8_str(imageName) + csep
-                            self.used[imageName] = 'used'
-                            tag = img_index_pattern.sub(replacement, tag, 1)
-                        else:
-                            print("Error: Referenced image %s in style url was not recognized in %s" % (imageNumber, tag))
-                    srcpieces[j] = tag
-            part = b"".join(srcpieces)
+        # we are free to cut and paste as we see fit
+        # we can safely remove all of the Kindlegen generated aid tags
+        # change aid ids that are in k8proc.linked_aids to xhtml ids
+        srcpieces = _aid_tag_pattern.split(part)
+        for j in range(len(srcpieces)):
+            tag = srcpieces[j]
+            if tag.startswith(b'<'):
+                srcpieces[j] = self.rewriteAidTag(tag)
+        part = b"".join(srcpieces)
 
-            # store away modified version
-            parts[i] = part
+        # we can safely replace all of the Kindlegen generated data-AmznPageBreak tags
+        # with page-break-after style patterns
+        srcpieces = _pagebreak_tag_pattern.split(part)
+        for j in range(len(srcpieces)):
+            tag = srcpieces[j]
+            if tag.startswith(b'<'):
+                srcpieces[j] = self.rewritePageBreakTag(tag)
+        part = b"".join(srcpieces)
+
+        # flow pattern
+        srcpieces = _tag_pattern.split(part)
+        for j in range(1, len(srcpieces),2):
+            tag = srcpieces[j]
+            if tag.startswith(b'<'):
+                srcpieces[j] = self.rewriteFlowTag(tag, flows, messages[0])[0]
+        part = b''.join(srcpieces)
+
+        # replace urls in style attributes
+        srcpieces = _style_pattern.split(part)
+        for j in range(1, len(srcpieces),2):
+            srcpieces[j] = self.rewriteStyleTag(srcpieces[j], messages[1])
+        part = b"".join(srcpieces)
+
+        # links to raster image files
+        srcpieces = _img_pattern.split(part)
+        for j in range(1, len(srcpieces),2):
+            srcpieces[j] = self.rewriteImageTag(srcpieces[j], messages[2])
+        part = b"".join(srcpieces)
+
+        # general cleanups
+        srcpieces = _tag_pattern.split(part)
+        for j in range(1, len(srcpieces),2):
+            srcpieces[j] = self.cleanupTag(srcpieces[j])
+        part = b"".join(srcpieces)
+        self.passes += 6
+        return part
+
+    def rewriteAidTag(self, tag):
+        # remove the aid attributes, those that are link targets become ids
+        for m in _aid_attribute_pattern.finditer(tag):
+            try:
+                aid = m.group(1)
+            except IndexError:
+                aid = None
+            replacement = b''
+            if aid in self.k8proc.linked_aids:
+                replacement = b' id="aid-' + aid + b'"'
+            tag = _aid_attribute_pattern.sub(replacement, tag, 1)
+        return tag
+
+    def rewritePageBreakTag(self, tag):
+        return _pagebreak_attribute_pattern.sub(lambda m:b' style="page-break-after:' + m.group(1) + b'"', tag)
+
+    def resolveEmbed(self, token):
+        # the name of the resource of a kindle:embed link and its utf-8 form for
+        # the replacement, the name is None if it is not a valid resource
+        try:
+            return self.embeds[token]
+        except KeyError:
+            name = self.rscnames[fromBase32(token)-1]
+            embed = (name, utf8_str(name) if name is not None else None)
+            self.embeds[token] = embed
+            return embed
+
+    def resolveFlow(self, token):
+        # the number and flow info of the flow of a kindle:flow link, the info
+        # is None if there is no such flow
+        try:
+            return self.flowlinks[token]
+        except KeyError:
+            num = fromBase32(token)
+            link = (num, self.k8proc.getFlowInfo(num))
+            self.flowlinks[token] = link
+            return link
+
+    def rewriteFlowTag(self, tag, flows, warnings):
+        # returns the tag with its flow links replaced and whether it was
+        # replaced by an inlined flow
+        links = [(m, self.resolveFlow(m.group(1))) for m in _flow_pattern.finditer(tag)]
+        for m, (num, info) in links:
+            if info is not None and info[1] == b'inline':
+                return self.inlineFlowTag(tag, links, flows, warnings), True
+        pieces = []
+        last = 0
+        for m, (num, info) in links:
+            if info is None:
+                warnings.append(("warning: ignoring non-existent flow link", tag, " value 0x%x" % num))
+                continue
+            [typ, fmt, pdir, fnm] = info
+            pieces.append(tag[last:m.start()])
+            pieces.append(b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"')
+            self.used[fnm] = 'used'
+            last = m.end()
+        if not pieces:
+            return tag, False
+        pieces.append(tag[last:])
+        return b''.join(pieces), False
+
+    def inlineFlowTag(self, tag, links, flows, warnings):
+        # a tag with a link to an inlined flow is replaced by that flow, any links
+        # after it are applied to the flow text as they always were
+        for m, (num, info) in links:
+            if info is not None:
+                [typ, fmt, pdir, fnm] = info
+                flowpart = flows[num]
+                if fmt == b'inline':
+                    tag = flowpart
+                else:
+                    replacement = b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"'
+                    tag = _flow_pattern.sub(replacement, tag, 1)
+                    self.used[fnm] = 'used'
+            else:
+                warnings.append(("warning: ignoring non-existent flow link", tag, " value 0x%x" % num))
+        return tag
 
+    def rewriteStyleTag(self, tag, errors):
+        # Handle any embedded raster images links in style= attributes urls
+        if b'kindle:embed' in tag:
+            def replaceImage(m):
+                imageName, imageBytes = self.resolveEmbed(m.group(1))
+                if imageName is None:
+                    errors.append(("Error: Referenced image %s in style url was not recognized in %s" % (fromBase32(m.group(1)), tag),))
+                    return m.group()
+                self.used[imageName] = 'used'
+                return m.group()[0:1] + b'../Images/' + imageBytes + m.group()[-1:]
+            tag = _style_img_index_pattern.sub(replaceImage, tag)
+        return tag
+
+    def rewriteImageTag(self, tag, errors):
         # Handle any embedded raster images links in the xhtml text
-        # kindle:embed:XXXX?mime=image/gif (png, jpeg, etc) (used for images)
-        img_pattern = re.compile(br'''(<[img\s|image\s][^>]*>)''', re.IGNORECASE)
-        img_index_pattern = re.compile(br'''['"]kindle:embed:([0-9|A-V]+)[^'"]*['"]''')
-
-        for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
-
-            # links to raster image files
-            # image_pattern
-            srcpieces = img_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if tag.startswith(b'<im'):
-                    for m in img_index_pattern.finditer(tag):
-                        imageNumber = fromBase32(m.group(1))
-                        imageName = self.rscnames[imageNumber-1]
-                        if imageName is not None:
-                            replacement = b'"../Images/' + utf8_str(imageName) + b'"'
-                            self.used[imageName] = 'used'
-                            tag = img_index_pattern.sub(replacement, tag, 1)
-                        else:
-                            print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
-                    srcpieces[j] = tag
-            part = b"".join(srcpieces)
-            # store away modified version
-            parts[i] = part
-
-        # finally perform any general cleanups needed to make valid XHTML
+        if tag.startswith(b'<im'):
+            def replaceImage(m):
+                imageName, imageBytes = self.resolveEmbed(m.group(1))
+                if imageName is None:
+                    errors.append(("Error: Referenced image %s was not recognized as a valid image in %s" % (fromBase32(m.group(1)), tag),))
+                    return m.group()
+                self.used[imageName] = 'used'
+                return b'"../Images/' + imageBytes + b'"'
+            tag = _img_index_pattern.sub(replaceImage, tag)
+        return tag
+
+    def cleanupTag(self, tag):
+        # perform any general cleanups needed to make valid XHTML
         # these include:
         #   in svg tags replace "perserveaspectratio" attributes with "perserveAspectRatio"
         #   in svg tags replace "viewbox" attributes with "viewBox"
         #   in <li> remove value="XX" attributes since these are illegal
-        tag_pattern = re.compile(br'''(<[^>]*>)''')
-        li_value_pattern = re.compile(br'''\svalue\s*=\s*['"][^'"]*['"]''', re.IGNORECASE)
-
-        for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
-
-            # tag pattern
-            srcpieces = tag_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if tag.startswith(b'<svg') or tag.startswith(b'<SVG'):
-                    tag = tag.replace(b'preserveaspectratio',b'preserveAspectRatio')
-                    tag = tag.replace(b'viewbox',b'viewBox')
-                elif tag.startswith(b'<li ') or tag.startswith(b'<LI '):
-                    tagpieces = li_value_pattern.split(tag)
-                    tag = b"".join(tagpieces)
-                srcpieces[j] = tag
-            part = b"".join(srcpieces)
-            # store away modified version
-            parts[i] = part
-
-        # handle injection viewport meta data if needed in each xhtml file
-        if self.viewport:
-            injected_meta = b'<meta name="viewport" content="' + utf8_str(self.viewport) + b'"/>\n'
-            viewport_pattern = re.compile(br'''<meta\s[^>]*name\s*=\s*["'][^"'>]*viewport["'][^>]*>''', re.IGNORECASE)
-            for i in range(len(parts)):
-                part = parts[i]
-                # only inject if a viewport meta item does not already exist in that part
-                if not viewport_pattern.search(part):
-                    endheadpos = part.find(b'</head>')
-                    if endheadpos >= 0:
-                        part = part[0:endheadpos] + injected_meta + part[endheadpos:]
-                parts[i] = part
-
-        self.k8proc.setFlows(flows)
-        self.k8proc.setParts(parts)
-
-        return self.used
+        if tag.startswith(b'<svg') or tag.startswith(b'<SVG'):
+            tag = tag.replace(b'preserveaspectratio',b'preserveAspectRatio')
+            tag = tag.replace(b'viewbox',b'viewBox')
+        elif tag.startswith(b'<li ') or tag.startswith(b'<LI '):
+            tagpieces = _li_value_pattern.split(tag)
+            tag = b"".join(tagpieces)
+        return tag
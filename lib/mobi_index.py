@@ -7,7 +7,11 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 from .compatibility_utils import PY2, bchr, bstr, bord
 if PY2:
     range = xrange
+    array_format = b'L'
+else:
+    array_format = 'L'
 
+import array
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
@@ -21,59 +25,68 @@ class MobiIndex:
         self.DEBUG = DEBUG
 
     def getIndexData(self, idx, label="Unknown"):
+        entries, ctoc_text = self.iterIndexData(idx, label)
+        return list(entries), ctoc_text
+
+    def iterIndexData(self, idx, label="Unknown"):
+        # Reads the main INDX section and the CTOC text right away and returns
+        # them with a generator of the [text, tagMap] entries that decodes each
+        # INDX record only when the previous one has been used up.
         sect = self.sect
-        outtbl = []
         ctoc_text = {}
-        if idx != 0xffffffff:
-            sect.setsectiondescription(idx,"{0} Main INDX section".format(label))
-            data = sect.loadSection(idx)
-            idxhdr, hordt1, hordt2 = self.parseINDXHeader(data)
-            IndexCount = idxhdr['count']
-            # handle the case of multiple sections used for CTOC
-            rec_off = 0
-            off = idx + IndexCount + 1
-            for j in range(idxhdr['nctoc']):
-                cdata = sect.loadSection(off + j)
-                sect.setsectiondescription(off+j, label + ' CTOC Data ' + str(j))
-                ctocdict = self.readCTOC(cdata)
-                for k in ctocdict:
-                    ctoc_text[k + rec_off] = ctocdict[k]
-                rec_off += 0x10000
-            tagSectionStart = idxhdr['len']
-            controlByteCount, tagTable = readTagSection(tagSectionStart, data)
-            if self.DEBUG:
-                print("ControlByteCount is", controlByteCount)
-                print("IndexCount is", IndexCount)
-                print("TagTable: %s" % tagTable)
+        if idx == 0xffffffff:
+            return iter([]), ctoc_text
+        sect.setsectiondescription(idx,"{0} Main INDX section".format(label))
+        data = bytes(sect.loadSection(idx))
+        idxhdr, hordt1, hordt2 = self.parseINDXHeader(data)
+        IndexCount = idxhdr['count']
+        # handle the case of multiple sections used for CTOC
+        rec_off = 0
+        off = idx + IndexCount + 1
+        for j in range(idxhdr['nctoc']):
+            cdata = bytes(sect.loadSection(off + j))
+            sect.setsectiondescription(off+j, label + ' CTOC Data ' + str(j))
+            ctocdict = self.readCTOC(cdata)
+            for k in ctocdict:
+                ctoc_text[k + rec_off] = ctocdict[k]
+            rec_off += 0x10000
+        tagSectionStart = idxhdr['len']
+        controlByteCount, tagTable = readTagSection(tagSectionStart, data)
+        decoder = getTagDecoder(controlByteCount, tagTable)
+        if self.DEBUG:
+            print("ControlByteCount is", controlByteCount)
+            print("IndexCount is", IndexCount)
+            print("TagTable: %s" % tagTable)
+
+        def entries():
             for i in range(idx + 1, idx + 1 + IndexCount):
                 sect.setsectiondescription(i,"{0} Extra {1:d} INDX section".format(label,i-idx))
-                data = sect.loadSection(i)
-                hdrinfo, ordt1, ordt2 = self.parseINDXHeader(data)
-                idxtPos = hdrinfo['start']
-                entryCount = hdrinfo['count']
-                if self.DEBUG:
-                    print(idxtPos, entryCount)
-                # loop through to build up the IDXT position starts
-                idxPositions = []
-                for j in range(entryCount):
-                    pos, = struct.unpack_from(b'>H', data, idxtPos + 4 + (2 * j))
-                    idxPositions.append(pos)
-                # The last entry ends before the IDXT tag (but there might be zero fill bytes we need to ignore!)
-                idxPositions.append(idxtPos)
-                # for each entry in the IDXT build up the tagMap and any associated text
-                for j in range(entryCount):
-                    startPos = idxPositions[j]
-                    endPos = idxPositions[j+1]
-                    textLength = ord(data[startPos:startPos+1])
-                    text = data[startPos+1:startPos+1+textLength]
-                    if hordt2 is not None:
-                        text = b''.join(bchr(hordt2[bord(x)]) for x in text)
-                    tagMap = getTagMap(controlByteCount, tagTable, data, startPos+1+textLength, endPos)
-                    outtbl.append([text, tagMap])
+                for entry in self.readIndexRecord(bytes(sect.loadSection(i)), decoder, hordt2):
                     if self.DEBUG:
-                        print(tagMap)
-                        print(text)
-        return outtbl, ctoc_text
+                        print(entry[1])
+                        print(entry[0])
+                    yield entry
+        return entries(), ctoc_text
+
+    def getIndexColumns(self, idx, label="Unknown"):
+        # the index as an IndexColumns table, the tag maps of the entries are
+        # only ever held one record at a time
+        entries, ctoc_text = self.iterIndexData(idx, label)
+        columns = IndexColumns()
+        for text, tagMap in entries:
+            columns.append(text, tagMap)
+        return columns, ctoc_text
+
+    def readIndexRecord(self, data, decoder, hordt2=None):
+        # decode all entries of one INDX record into a list of [text, tagMap]
+        hdrinfo, ordt1, ordt2 = self.parseINDXHeader(data)
+        if self.DEBUG:
+            print(hdrinfo['start'], hdrinfo['count'])
+        entries = decoder.decodeRecord(data, hdrinfo['start'], hdrinfo['count'])
+        if hordt2 is not None:
+            for entry in entries:
+                entry[0] = b''.join(bchr(hordt2[bord(x)]) for x in entry[0])
+        return entries
 
     def parseINDXHeader(self, data):
         "read INDX header"
@@ -140,6 +153,63 @@ class MobiIndex:
         return ctoc_data
 
 
+NO_VALUE = 0xffffffff
+""" Stored in an IndexColumns column for entries that do not have that value. """
+
+class IndexColumns(object):
+    # Index entries stored column by column: the entry texts in a list and every
+    # value of every tag in its own array('L'), the k-th value of tag t in the
+    # column (t, k).  Entries without that value hold NO_VALUE.  For large
+    # indexes this needs a small fraction of the memory of a list and a dict of
+    # lists per entry.  Values that are CTOC offsets resolve to the one shared
+    # bytes object the CTOC text dictionary holds for that offset.
+
+    def __init__(self):
+        self.texts = []
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.texts)
+
+    def append(self, text, tagMap):
+        row = len(self.texts)
+        columns = self.columns
+        for tag in tagMap:
+            k = 0
+            for value in tagMap[tag]:
+                col = columns.get((tag, k))
+                if col is None:
+                    col = columns[(tag, k)] = array.array(array_format, [NO_VALUE]) * row
+                col.append(value)
+                k += 1
+        self.texts.append(text)
+        row += 1
+        for col in columns.values():
+            if len(col) < row:
+                col.append(NO_VALUE)
+
+    def hasColumn(self, tag, k=0):
+        return (tag, k) in self.columns
+
+    def column(self, tag, k=0):
+        # the k-th values of tag for all entries
+        col = self.columns.get((tag, k))
+        if col is None:
+            col = array.array(array_format, [NO_VALUE]) * len(self.texts)
+        return col
+
+    def ctocColumn(self, ctoc_text, tag, k=0):
+        # the CTOC texts the k-th values of tag refer to, None where there is none
+        return [ctoc_text.get(value) for value in self.column(tag, k)]
+
+
+def intView(data):
+    # a view of data whose items are integers (a copy under Python 2)
+    if PY2:
+        return bytearray(data)
+    return memoryview(data)
+
+
 def getVariableWidthValue(data, offset):
     '''
     Decode variable width value from given bytes.
@@ -208,69 +278,164 @@ def getTagMap(controlByteCount, tagTable, entryData, startPos, endPos):
     @param endPos: The end position in entryData or None if it is unknown.
     @return: Hashmap of tag and list of values.
     '''
-    tags = []
-    tagHashMap = {}
-    controlByteIndex = 0
-    dataStart = startPos + controlByteCount
-
-    for tag, valuesPerEntry, mask, endFlag in tagTable:
-        if endFlag == 0x01:
-            controlByteIndex += 1
-            continue
-        cbyte = ord(entryData[startPos + controlByteIndex:startPos + controlByteIndex+1])
-        if 0:
-            print("Control Byte Index %0x , Control Byte Value %0x" % (controlByteIndex, cbyte))
-
-        value = ord(entryData[startPos + controlByteIndex:startPos + controlByteIndex+1]) & mask
-        if value != 0:
-            if value == mask:
-                if countSetBits(mask) > 1:
-                    # If all bits of masked value are set and the mask has more than one bit, a variable width value
-                    # will follow after the control bytes which defines the length of bytes (NOT the value count!)
-                    # which will contain the corresponding variable width values.
-                    consumed, value = getVariableWidthValue(entryData, dataStart)
-                    dataStart += consumed
-                    tags.append((tag, None, value, valuesPerEntry))
-                else:
-                    tags.append((tag, 1, None, valuesPerEntry))
+    return getTagDecoder(controlByteCount, tagTable).decode(entryData, startPos, endPos)
+
+
+class TagDecoder:
+    # The tag table of an index compiled into a plan for decoding its entries.
+    # getTagMap works this out again for every entry, the decoder does it once per
+    # table: for each tag it records which control byte to look at, the mask and
+    # the shift that give the value count, whether a full multi bit mask means a
+    # byte length follows and how many values make up each entry.  The tags and
+    # value counts that a given set of control bytes selects are remembered too,
+    # so most entries only cost a dictionary lookup before their values are read.
+
+    def __init__(self, controlByteCount, tagTable):
+        self.controlByteCount = controlByteCount
+        self.tagTable = tagTable
+        plan = []
+        controlByteIndex = 0
+        for tag, valuesPerEntry, mask, endFlag in tagTable:
+            if endFlag == 0x01:
+                controlByteIndex += 1
+                continue
+            if mask == 0:
+                # can never have a value
+                continue
+            shift = 0
+            while (mask >> shift) & 0x01 == 0:
+                shift += 1
+            plan.append((tag, controlByteIndex, mask, shift, countSetBits(mask) > 1, valuesPerEntry))
+        self.plan = plan
+        # layouts already worked out, keyed by the control byte (or tuple of bytes)
+        self.layouts = {}
+        self.keyLength = 0
+        if plan:
+            self.keyLength = max(p[1] for p in plan) + 1
+
+    def decode(self, data, startPos, endPos):
+        # same result as getTagMap for the entry data starting at startPos
+        if PY2:
+            # index within a copy of just this entry
+            entry = data[startPos:endPos] if endPos is not None else data[startPos:]
+            return self.decodeEntry(bytearray(entry), entry, 0, len(entry) if endPos is not None else None)
+        return self.decodeEntry(intView(data), data, startPos, endPos)
+
+    def decodeRecord(self, data, idxtPos, entryCount):
+        # decode every entry of an INDX record whose IDXT starts at idxtPos,
+        # returns a list of [text, tagMap]
+        d = intView(data)
+        positions = list(struct.unpack_from(bstr('>%dH' % entryCount), data, idxtPos + 4))
+        # The last entry ends before the IDXT tag (but there might be zero fill bytes we need to ignore!)
+        positions.append(idxtPos)
+        decodeEntry = self.decodeEntry
+        entries = []
+        for j in range(entryCount):
+            startPos = positions[j]
+            textLength = d[startPos]
+            text = data[startPos+1:startPos+1+textLength]
+            entries.append([text, decodeEntry(d, data, startPos+1+textLength, positions[j+1])])
+        return entries
+
+    def getLayout(self, controlBytes):
+        # Work out from the control bytes which tags are present and how many
+        # values each has.  Returns the number of byte lengths that follow the
+        # control bytes and a list of (tag, value count) where a count of -1
+        # means the values fill the next of those byte lengths.
+        nlengths = 0
+        layout = []
+        for tag, controlByteIndex, mask, shift, multibit, valuesPerEntry in self.plan:
+            value = controlBytes[controlByteIndex] & mask
+            if value == 0:
+                continue
+            if multibit and value == mask:
+                # a variable width value after the control bytes gives the length in
+                # bytes (NOT the value count!) of the variable width values that follow
+                nlengths += 1
+                layout.append((tag, -1))
             else:
-                # Shift bits to get the masked value.
-                while mask & 0x01 == 0:
-                    mask = mask >> 1
-                    value = value >> 1
-                tags.append((tag, value, None, valuesPerEntry))
-    for tag, valueCount, valueBytes, valuesPerEntry in tags:
-        values = []
-        if valueCount is not None:
-            # Read valueCount * valuesPerEntry variable width values.
-            for _ in range(valueCount):
-                for _ in range(valuesPerEntry):
-                    consumed, data = getVariableWidthValue(entryData, dataStart)
-                    dataStart += consumed
-                    values.append(data)
+                layout.append((tag, (value >> shift) * valuesPerEntry))
+        return nlengths, layout
+
+    def decodeEntry(self, d, data, startPos, endPos):
+        # d is data as integers, data itself is only used for error messages
+        keyLength = self.keyLength
+        if keyLength == 1:
+            key = d[startPos]
         else:
-            # Convert valueBytes to variable width values.
-            totalConsumed = 0
-            while totalConsumed < valueBytes:
-                # Does this work for valuesPerEntry != 1?
-                consumed, data = getVariableWidthValue(entryData, dataStart)
-                dataStart += consumed
-                totalConsumed += consumed
-                values.append(data)
-            if totalConsumed != valueBytes:
-                print("Error: Should consume %s bytes, but consumed %s" % (valueBytes, totalConsumed))
-        tagHashMap[tag] = values
-    # Test that all bytes have been processed if endPos is given.
-    if endPos is not None and dataStart != endPos:
-        # The last entry might have some zero padding bytes, so complain only if non zero bytes are left.
-        for char in entryData[dataStart:endPos]:
-            if bord(char) != 0:
-                print("Warning: There are unprocessed index bytes left: %s" % toHex(entryData[dataStart:endPos]))
-                if 0:
-                    print("controlByteCount: %s" % controlByteCount)
-                    print("tagTable: %s" % tagTable)
-                    print("data: %s" % toHex(entryData[startPos:endPos]))
-                    print("tagHashMap: %s" % tagHashMap)
-                break
-
-    return tagHashMap
+            key = tuple(d[startPos:startPos + keyLength])
+        layout = self.layouts.get(key)
+        if layout is None:
+            if keyLength == 1:
+                layout = self.getLayout((key,))
+            elif len(key) != keyLength:
+                raise IndexError('index entry control bytes out of range')
+            else:
+                layout = self.getLayout(key)
+            self.layouts[key] = layout
+        nlengths, items = layout
+        dataStart = startPos + self.controlByteCount
+        lengths = []
+        for _ in range(nlengths):
+            v = d[dataStart]
+            dataStart += 1
+            value = v & 0x7f
+            while not v & 0x80:
+                v = d[dataStart]
+                dataStart += 1
+                value = (value << 7) | (v & 0x7f)
+            lengths.append(value)
+        tagHashMap = {}
+        nextLength = 0
+        for tag, valueCount in items:
+            values = []
+            if valueCount >= 0:
+                for _ in range(valueCount):
+                    v = d[dataStart]
+                    dataStart += 1
+                    value = v & 0x7f
+                    while not v & 0x80:
+                        v = d[dataStart]
+                        dataStart += 1
+                        value = (value << 7) | (v & 0x7f)
+                    values.append(value)
+            else:
+                valueBytes = lengths[nextLength]
+                nextLength += 1
+                valueEnd = dataStart + valueBytes
+                while dataStart < valueEnd:
+                    v = d[dataStart]
+                    dataStart += 1
+                    value = v & 0x7f
+                    while not v & 0x80:
+                        v = d[dataStart]
+                        dataStart += 1
+                        value = (value << 7) | (v & 0x7f)
+                    values.append(value)
+                if dataStart != valueEnd:
+                    print("Error: Should consume %s bytes, but consumed %s" % (valueBytes, valueBytes + dataStart - valueEnd))
+            tagHashMap[tag] = values
+        # Test that all bytes have been processed if endPos is given.
+        if endPos is not None and dataStart < endPos:
+            # The last entry might have some zero padding bytes, so complain only if non zero bytes are left.
+            if any(d[dataStart:endPos]):
+                print("Warning: There are unprocessed index bytes left: %s" % toHex(bytes(data[dataStart:endPos])))
+        return tagHashMap
+
+
+_tagDecoders = {}
+
+def getTagDecoder(controlByteCount, tagTable):
+    '''
+    Return the compiled decoder for a tag table, decoders are shared between
+    all indexes using the same table.
+
+    @param controlByteCount: The number of control bytes.
+    @param tagTable: The tag table.
+    @return: TagDecoder instance.
+    '''
+    key = (controlByteCount, tuple(tagTable))
+    decoder = _tagDecoders.get(key)
+    if decoder is None:
+        decoder = _tagDecoders[key] = TagDecoder(controlByteCount, tagTable)
+    return decoder
@@ -10,6 +10,8 @@ if PY2:
     range = xrange
 
 import os
+import array
+from bisect import bisect_left, bisect_right
 
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
@@ -19,14 +21,76 @@ import re
 # note: re requites the pattern to be the exact same type as the data to be searched in python3
 # but u"" is not allowed for the pattern itself only b""
 
-from .mobi_index import MobiIndex
+from .mobi_index import MobiIndex, array_format, NO_VALUE
 from .mobi_utils import fromBase32
 from .unipath import pathof
+from .unpack_structure import unpackException
 
 _guide_types = [b'cover',b'title-page',b'toc',b'index',b'glossary',b'acknowledgements',
                 b'bibliography',b'colophon',b'copyright-page',b'dedication',
                 b'epigraph',b'foreword',b'loi',b'lot',b'notes',b'preface',b'text']
 
+def requiredColumn(columns, name, tag, k=0):
+    # the k-th values of a tag that every entry of the index must have, a corrupt
+    # index is an error rather than a table of NO_VALUE positions
+    if len(columns) and not columns.hasColumn(tag, k):
+        raise unpackException('%s index has no value %d of tag %d' % (name, k, tag))
+    col = columns.column(tag, k)
+    if NO_VALUE in col:
+        raise unpackException('%s index entry %d has no value %d of tag %d' % (name, col.index(NO_VALUE), k, tag))
+    return col
+
+
+class SkeletonTable(object):
+    # the skeleton index as columns: skeleton name, number of fragments,
+    # start position and length, the file number is the row number
+
+    def __init__(self, columns=None):
+        self.names = []
+        self.fragcnt = array.array(array_format)
+        self.skelpos = array.array(array_format)
+        self.skellen = array.array(array_format)
+        if columns is not None:
+            self.names = columns.texts
+            self.fragcnt = requiredColumn(columns, 'Skeleton', 1)
+            self.skelpos = requiredColumn(columns, 'Skeleton', 6, 0)
+            self.skellen = requiredColumn(columns, 'Skeleton', 6, 1)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, j):
+        # file number, skeleton name, fragtbl record count, start position, length
+        return [j, self.names[j], self.fragcnt[j], self.skelpos[j], self.skellen[j]]
+
+
+class FragmentTable(object):
+    # the fragment index as columns: insert position, link id text (shared with
+    # the CTOC), file number, sequence number, start position and length
+
+    def __init__(self, columns=None, ctoc_text=None):
+        self.insertpos = array.array(array_format)
+        self.idtext = []
+        self.filenum = array.array(array_format)
+        self.seqnum = array.array(array_format)
+        self.startpos = array.array(array_format)
+        self.length = array.array(array_format)
+        if columns is not None:
+            self.insertpos = array.array(array_format, [int(text) for text in columns.texts])
+            self.idtext = [ctoc_text[offset] for offset in requiredColumn(columns, 'Fragment', 2)]
+            self.filenum = requiredColumn(columns, 'Fragment', 3)
+            self.seqnum = requiredColumn(columns, 'Fragment', 4)
+            self.startpos = requiredColumn(columns, 'Fragment', 6, 0)
+            self.length = requiredColumn(columns, 'Fragment', 6, 1)
+
+    def __len__(self):
+        return len(self.insertpos)
+
+    def __getitem__(self, j):
+        # insert position, link id text, file number, sequence number, start position, length
+        return [self.insertpos[j], self.idtext[j], self.filenum[j], self.seqnum[j], self.startpos[j], self.length[j]]
+
+
 # locate beginning and ending positions of tag with specific aid attribute
 def locate_beg_end_of_tag(ml, aid):
     pattern = utf8_str(r'''<[^>]*\said\s*=\s*['"]%s['"][^>]*>''' % aid)
@@ -52,6 +116,246 @@ def reverse_tag_iter(block):
         end = plt
 
 
+# find id and name attributes only inside of tags
+#    inside any < > pair find "id=" and "name=" attributes return it
+#    [^>]* means match any amount of chars except for  '>' char
+#    [^'"] match any amount of chars except for the quote character
+#    \s* means match any amount of whitespace
+_id_pattern = re.compile(br'''<[^>]*\sid\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
+_name_pattern = re.compile(br'''<[^>]*\sname\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
+_aid_pattern = re.compile(br'''<[^>]+\s(?:aid|AID)\s*=\s*['"]([^'"]+)['"]''')
+# the tags a reverse tag search stops at: a '<' whose next '<' or '>' is a '>'
+_tag_pattern = re.compile(br'''<[^<>]*>''')
+
+
+# classify the tag block[start:end] for getIDTag and getPageIDTag, returns the
+# anchor each of them takes from it or None if they search on past it
+def classify_tag(block, start, end):
+    head = block[start:start+6]
+    # any ids in the body should default to top of file
+    if head == b'<body ':
+        return (b'', None), b''
+    if head == b'<meta ':
+        return None, None
+    m = _id_pattern.match(block, start, end) or _name_pattern.match(block, start, end)
+    if m is not None:
+        return (m.group(1), None), m.group(1)
+    m = _aid_pattern.match(block, start, end)
+    if m is not None:
+        # aid anchors are only used by getIDTag and must become real ids
+        return (b'aid-' + m.group(1), m.group(1)), None
+    return None, None
+
+
+def idSearchPos(textblock, npos):
+    # where the search for the anchor of a link to npos in a part ends:
+    # if npos inside a tag then search all text before the its end of tag marker
+    pgt = textblock.find(b'>',npos)
+    plt = textblock.find(b'<',npos)
+    if plt == npos or pgt < plt:
+        npos = pgt + 1
+    return npos
+
+
+def pageSearchPos(textblock, npos):
+    # where the search for the anchor of a page at npos in a part ends:
+    # page map offsets need to little more leeway so if the offset points
+    # into a tag look for the next ending tag "/>" or "</" and start your search from there.
+    pgt = textblock.find(b'>',npos)
+    plt = textblock.find(b'<',npos)
+    if plt == npos or pgt < plt:
+        # we are in a tag
+        # so find first ending tag
+        pend1 = textblock.find(b'/>', npos)
+        pend2 = textblock.find(b'</', npos)
+        if pend1 != -1 and pend2 != -1:
+            pend = min(pend1, pend2)
+        else:
+            pend = max(pend1, pend2)
+        if pend != -1:
+            npos = pend
+        else:
+            npos = pgt + 1
+    return npos
+
+
+class AnchorIndex(object):
+    # The tags of one part in the order a reverse tag search (reverse_tag_iter)
+    # meets them, each with the nearest anchor at or before it.  The anchor a
+    # search of block[0:npos] would find is then a bisect away instead of a
+    # walk back over every tag in between.
+
+    def __init__(self, block):
+        self.block = block
+        self.starts = array.array(array_format)
+        self.closes = array.array(array_format)
+        self.ends = array.array(array_format)
+        # indexes into idanchors and pageanchors, 0 is no anchor
+        self.lastid = array.array(array_format)
+        self.lastpage = array.array(array_format)
+        self.idanchors = [None]
+        self.pageanchors = [None]
+        starts = []
+        closes = []
+        for m in _tag_pattern.finditer(block):
+            starts.append(m.start())
+            closes.append(m.end() - 1)
+        lastid = lastpage = 0
+        for i in range(len(starts)):
+            start = starts[i]
+            # the reverse search takes everything up to the last '>' before the next tag
+            if i + 1 < len(starts):
+                end = block.rfind(b'>', 0, starts[i+1]) + 1
+            else:
+                end = block.rfind(b'>') + 1
+            idanchor, pageanchor = classify_tag(block, start, end)
+            if idanchor is not None:
+                self.idanchors.append(idanchor)
+                lastid = len(self.idanchors) - 1
+            if pageanchor is not None:
+                self.pageanchors.append(pageanchor)
+                lastpage = len(self.pageanchors) - 1
+            self.starts.append(start)
+            self.closes.append(closes[i])
+            self.ends.append(end)
+            self.lastid.append(lastid)
+            self.lastpage.append(lastpage)
+
+    def find(self, npos, page=False):
+        # returns the anchor a reverse tag search of block[0:npos] stops at or None,
+        # for getIDTag it is a (text, aid) pair with aid None unless it is an aid anchor
+        return self.anchorAt(bisect_left(self.closes, npos) - 1, npos, page)
+
+    def findSorted(self, npositions, page=False):
+        # find for a list of positions in ascending order, each search for the
+        # last tag before a position starts from the one found for the previous
+        anchors = []
+        k = 0
+        for npos in npositions:
+            k = bisect_left(self.closes, npos, k)
+            anchors.append(self.anchorAt(k - 1, npos, page))
+        return anchors
+
+    def anchorAt(self, k, npos, page):
+        # the anchor for npos when tag k is the last tag that closes before it
+        if k < 0:
+            return None
+        if self.ends[k] > npos:
+            # the search sees the last tag cut short at the last '>' before npos
+            end = self.block.rfind(b'>', 0, npos) + 1
+            idanchor, pageanchor = classify_tag(self.block, self.starts[k], end)
+            anchor = pageanchor if page else idanchor
+            if anchor is not None:
+                return anchor
+            k -= 1
+            if k < 0:
+                return None
+        if page:
+            return self.pageanchors[self.lastpage[k]]
+        return self.idanchors[self.lastid[k]]
+
+
+class PartBuilder(object):
+    # A part being assembled from its skeleton and fragments, kept as ranges of
+    # the text flow (start, length) in part order.  Nothing is copied until the
+    # part is joined.  The ranges are split at a cursor, those before it keep
+    # their offset from the start of the part and those after it (in reverse
+    # order) their offset from the end, so inserting at the cursor changes no
+    # offsets.  Fragments are almost always inserted in order, one after the
+    # other, so the cursor only moves over a few ranges per fragment.
+
+    def __init__(self, text, start, length):
+        self.text = text
+        length = self.clip(start, length)
+        self.size = 0
+        self.starts = []
+        self.lengths = []
+        self.offsets = []
+        self.tailstarts = []
+        self.taillengths = []
+        self.tailoffsets = []
+        self.append(start, length)
+
+    def clip(self, start, length):
+        # the length of text[start:start+length]
+        return max(0, min(length, len(self.text) - start))
+
+    def slicePos(self, pos):
+        # where join()[0:pos] ends, negative positions count from the end
+        if pos < 0:
+            pos = max(0, self.size + pos)
+        return min(pos, self.size)
+
+    def append(self, start, length):
+        # add a range at the cursor, empty ones add nothing to the part
+        if length > 0:
+            self.starts.append(start)
+            self.lengths.append(length)
+            self.offsets.append(self.size - self.tailsize())
+            self.size += length
+
+    def tailsize(self):
+        # the length of the ranges after the cursor
+        if self.tailoffsets:
+            return self.tailoffsets[-1]
+        return 0
+
+    def seek(self, pos):
+        # move the cursor to pos, splitting the range that holds it
+        size = self.size
+        while self.offsets and self.offsets[-1] >= pos:
+            self.tailstarts.append(self.starts.pop())
+            self.taillengths.append(self.lengths.pop())
+            self.tailoffsets.append(size - self.offsets.pop())
+        while self.tailoffsets and size - self.tailoffsets[-1] < pos:
+            self.starts.append(self.tailstarts.pop())
+            self.lengths.append(self.taillengths.pop())
+            self.offsets.append(size - self.tailoffsets.pop())
+        if self.offsets:
+            cut = pos - self.offsets[-1]
+            if cut < self.lengths[-1]:
+                self.tailstarts.append(self.starts[-1] + cut)
+                self.taillengths.append(self.lengths[-1] - cut)
+                self.tailoffsets.append(size - pos)
+                self.lengths[-1] = cut
+
+    def insert(self, pos, start, length):
+        # same as join()[0:pos] + text[start:start+length] + join()[pos:]
+        self.seek(self.slicePos(pos))
+        self.append(start, self.clip(start, length))
+
+    def find(self, sub, pos):
+        # same as join().find(sub, pos) for a single character sub
+        pos = self.slicePos(pos)
+        self.seek(pos)
+        text = self.text
+        for k in range(len(self.tailstarts) - 1, -1, -1):
+            start = self.tailstarts[k]
+            i = text.find(sub, start, start + self.taillengths[k])
+            if i != -1:
+                return self.size - self.tailoffsets[k] + i - start
+        return -1
+
+    def rfind(self, sub, pos):
+        # same as join()[:pos].rfind(sub) for a single character sub
+        self.seek(self.slicePos(pos))
+        text = self.text
+        for k in range(len(self.starts) - 1, -1, -1):
+            start = self.starts[k]
+            i = text.rfind(sub, start, start + self.lengths[k])
+            if i != -1:
+                return self.offsets[k] + i - start
+        return -1
+
+    def join(self):
+        text = self.text
+        pieces = [text[start:start+length] for start, length in zip(self.starts, self.lengths)]
+        for k in range(len(self.tailstarts) - 1, -1, -1):
+            start = self.tailstarts[k]
+            pieces.append(text[start:start+self.taillengths[k]])
+        return b''.join(pieces)
+
+
 class K8Processor:
 
     def __init__(self, mh, sect, files, debug=False):
@@ -68,6 +372,12 @@ class K8Processor:
         self.flowinfo = []
         self.parts = None
         self.partinfo = []
+        self.fragends = None
+        self.partstarts = None
+        self.anchorindexes = {}
+        self.rawstarts = None
+        self.rawpositions = None
+        self.rawlengths = None
         self.linked_aids = set()
         self.fdsttbl= [0,0xffffffff]
         self.DEBUG = debug
@@ -77,7 +387,7 @@ class K8Processor:
         # this is needed to split up the final css, svg, etc flow section
         # that can exist at the end of the rawML file
         if self.fdst != 0xffffffff:
-            header = self.sect.loadSection(self.fdst)
+            header = bytes(self.sect.loadSection(self.fdst))
             if header[0:4] == b"FDST":
                 num_sections, = struct.unpack_from(b'>L', header, 0x08)
                 self.fdsttbl = struct.unpack_from(bstr('>%dL' % (num_sections*2)), header, 12)[::2] + (mh.rawSize, )
@@ -89,47 +399,51 @@ class K8Processor:
             else:
                 print("\nError: K8 Mobi with Missing FDST info")
 
+        # the skeleton, fragment and guide tables come from their indexes,
+        # or from the unpack cache when one is in use
+        if mh.cache is not None:
+            tables = mh.cache.getObject('k8tables-%d' % mh.start, sect, self.readIndexTables)
+        else:
+            tables = self.readIndexTables()
+        self.skeltbl, self.fragtbl, self.guidetbl = tables
+        if self.DEBUG:
+            print("\nSkel Table:  %d entries" % len(self.skeltbl))
+            print("table: filenum, skeleton name, frag tbl record count, start position, length")
+            for j in range(len(self.skeltbl)):
+                print(self.skeltbl[j])
+            print("\nFragment Table: %d entries" % len(self.fragtbl))
+            print("table: file position, link id text, file num, sequence number, start position, length")
+            for j in range(len(self.fragtbl)):
+                print(self.fragtbl[j])
+            print("\nGuide Table: %d entries" % len(self.guidetbl))
+            print("table: ref_type, ref_title, fragtbl entry number")
+            for j in range(len(self.guidetbl)):
+                print(self.guidetbl[j])
+
+    def readIndexTables(self):
+        # returns the skeleton, fragment and guide tables read from their indexes
+
         # read/process skeleton index info to create the skeleton table
-        skeltbl = []
+        skeltbl = SkeletonTable()
         if self.skelidx != 0xffffffff:
             # for i in range(2):
             #     fname = 'skel%04d.dat' % i
             #     data = self.sect.loadSection(self.skelidx + i)
             #     with open(pathof(fname), 'wb') as f:
             #         f.write(data)
-            outtbl, ctoc_text = self.mi.getIndexData(self.skelidx, "KF8 Skeleton")
-            fileptr = 0
-            for [text, tagMap] in outtbl:
-                # file number, skeleton name, fragtbl record count, start position, length
-                skeltbl.append([fileptr, text, tagMap[1][0], tagMap[6][0], tagMap[6][1]])
-                fileptr += 1
-        self.skeltbl = skeltbl
-        if self.DEBUG:
-            print("\nSkel Table:  %d entries" % len(self.skeltbl))
-            print("table: filenum, skeleton name, frag tbl record count, start position, length")
-            for j in range(len(self.skeltbl)):
-                print(self.skeltbl[j])
+            columns, ctoc_text = self.mi.getIndexColumns(self.skelidx, "KF8 Skeleton")
+            skeltbl = SkeletonTable(columns)
 
         # read/process the fragment index to create the fragment table
-        fragtbl = []
+        fragtbl = FragmentTable()
         if self.fragidx != 0xffffffff:
             # for i in range(3):
             #     fname = 'frag%04d.dat' % i
             #     data = self.sect.loadSection(self.fragidx + i)
             #     with open(pathof(fname), 'wb') as f:
             #         f.write(data)
-            outtbl, ctoc_text = self.mi.getIndexData(self.fragidx, "KF8 Fragment")
-            for [text, tagMap] in outtbl:
-                # insert position, ctoc offset (aidtext), file number, sequence number, start position, length
-                ctocoffset = tagMap[2][0]
-                ctocdata = ctoc_text[ctocoffset]
-                fragtbl.append([int(text), ctocdata, tagMap[3][0], tagMap[4][0], tagMap[6][0], tagMap[6][1]])
-        self.fragtbl = fragtbl
-        if self.DEBUG:
-            print("\nFragment Table: %d entries" % len(self.fragtbl))
-            print("table: file position, link id text, file num, sequence number, start position, length")
-            for j in range(len(self.fragtbl)):
-                print(self.fragtbl[j])
+            columns, ctoc_text = self.mi.getIndexColumns(self.fragidx, "KF8 Fragment")
+            fragtbl = FragmentTable(columns, ctoc_text)
 
         # read / process guide index for guide elements of opf
         guidetbl = []
@@ -139,8 +453,8 @@ class K8Processor:
             #     data = self.sect.loadSection(self.guideidx + i)
             #     with open(pathof(fname), 'wb') as f:
             #         f.write(data)
-            outtbl, ctoc_text = self.mi.getIndexData(self.guideidx, "KF8 Guide elements)")
-            for [text, tagMap] in outtbl:
+            entries, ctoc_text = self.mi.iterIndexData(self.guideidx, "KF8 Guide elements)")
+            for [text, tagMap] in entries:
                 # ref_type, ref_title, frag number
                 ctocoffset = tagMap[1][0]
                 ref_title = ctoc_text[ctocoffset]
@@ -151,12 +465,7 @@ class K8Processor:
                 if 6 in tagMap:
                     fileno = tagMap[6][0]
                 guidetbl.append([ref_type, ref_title, fileno])
-        self.guidetbl = guidetbl
-        if self.DEBUG:
-            print("\nGuide Table: %d entries" % len(self.guidetbl))
-            print("table: ref_type, ref_title, fragtbl entry number")
-            for j in range(len(self.guidetbl)):
-                print(self.guidetbl[j])
+        return skeltbl, fragtbl, guidetbl
 
     def buildParts(self, rawML):
         # now split the rawML into its flow pieces
@@ -181,40 +490,56 @@ class K8Processor:
         baseptr = 0
         cnt = 0
         filename = 'part%04d.xhtml' % cnt
-        for [skelnum, skelname, fragcnt, skelpos, skellen] in self.skeltbl:
-            baseptr = skelpos + skellen
-            skeleton = text[skelpos: baseptr]
+        skeltbl = self.skeltbl
+        fragtbl = self.fragtbl
+        for skelnum in range(len(skeltbl)):
+            skelname = skeltbl.names[skelnum]
+            skelpos = skeltbl.skelpos[skelnum]
+            baseptr = skelpos + skeltbl.skellen[skelnum]
+            skeleton = PartBuilder(text, skelpos, skeltbl.skellen[skelnum])
             aidtext = "0"
-            for i in range(fragcnt):
-                [insertpos, idtext, filenum, seqnum, startpos, length] = self.fragtbl[fragptr]
+            for i in range(skeltbl.fragcnt[skelnum]):
+                insertpos = fragtbl.insertpos[fragptr]
+                idtext = fragtbl.idtext[fragptr]
+                filenum = fragtbl.filenum[fragptr]
+                startpos = fragtbl.startpos[fragptr]
+                length = fragtbl.length[fragptr]
                 aidtext = idtext[12:-2]
                 if i == 0:
                     filename = 'part%04d.xhtml' % filenum
-                slice = text[baseptr: baseptr + length]
                 insertpos = insertpos - skelpos
-                head = skeleton[:insertpos]
-                tail = skeleton[insertpos:]
                 actual_inspos = insertpos
-                if (tail.find(b'>') < tail.find(b'<') or head.rfind(b'>') < head.rfind(b'<')):
+                # look for an incomplete tag in either the head or tail
+                headend = skeleton.slicePos(insertpos)
+                tailgt = skeleton.find(b'>', headend)
+                taillt = skeleton.find(b'<', headend)
+                if tailgt != -1:
+                    tailgt -= headend
+                if taillt != -1:
+                    taillt -= headend
+                if (tailgt < taillt or skeleton.rfind(b'>', headend) < skeleton.rfind(b'<', headend)):
                     # There is an incomplete tag in either the head or tail.
                     # This can happen for some badly formed KF8 files
                     print('The fragment table for %s has incorrect insert position. Calculating manually.' % skelname)
-                    bp, ep = locate_beg_end_of_tag(skeleton, aidtext)
+                    bp, ep = locate_beg_end_of_tag(skeleton.join(), aidtext)
                     if bp != ep:
                         actual_inspos = ep + 1 + startpos
                 if insertpos != actual_inspos:
                     print("fixed corrupt fragment table insert position", insertpos+skelpos, actual_inspos+skelpos)
                     insertpos = actual_inspos
-                    self.fragtbl[fragptr][0] = actual_inspos + skelpos
-                skeleton = skeleton[0:insertpos] + slice + skeleton[insertpos:]
+                    fragtbl.insertpos[fragptr] = actual_inspos + skelpos
+                skeleton.insert(insertpos, baseptr, length)
                 baseptr = baseptr + length
                 fragptr += 1
             cnt += 1
-            self.parts.append(skeleton)
+            self.parts.append(skeleton.join())
             self.partinfo.append([skelnum, 'Text', filename, skelpos, baseptr, aidtext])
 
-        assembled_text = b''.join(self.parts)
+        # the fragment insert positions are final now so build the lookup tables
+        self.buildPositionIndex()
+
         if self.DEBUG:
+            assembled_text = b''.join(self.parts)
             outassembled = os.path.join(self.files.k8dir, 'assembled_text.dat')
             with open(pathof(outassembled),'wb') as f:
                 f.write(assembled_text)
@@ -306,23 +631,61 @@ class K8Processor:
 
         return
 
+    # build the sorted tables used to look up positions in the original rawML with bisect
+    def buildPositionIndex(self):
+        # A scan of the fragment table stops at the first fragment whose end lies
+        # past pos: either pos is inside it or pos comes before its start.  The
+        # running maximum of the fragment ends never decreases so the first one
+        # past pos can be found with bisect whatever the order of the fragments.
+        fragtbl = self.fragtbl
+        self.fragends = array.array(array_format)
+        maxend = 0
+        for j in range(len(fragtbl)):
+            maxend = max(maxend, fragtbl.insertpos[j] + fragtbl.length[j])
+            self.fragends.append(maxend)
+        # the parts follow each other in the rawML, if they ever do not
+        # fall back to scanning partinfo
+        self.partstarts = array.array(array_format)
+        lastend = 0
+        for [partnum, pdir, filename, start, end, aidtext] in self.partinfo:
+            if start < lastend or end < start:
+                self.partstarts = None
+                break
+            self.partstarts.append(start)
+            lastend = end
+
     # get information fragment table entry by pos
     def getFragTblInfo(self, pos):
-        for j in range(len(self.fragtbl)):
-            [insertpos, idtext, filenum, seqnum, startpos, length] = self.fragtbl[j]
-            if pos >= insertpos and pos < (insertpos + length):
-                # why are these "in: and before: added here
-                return seqnum, b'in: ' + idtext
-            if pos < insertpos:
-                return seqnum, b'before: ' + idtext
-        return None, None
+        fragtbl = self.fragtbl
+        if self.fragends is None:
+            self.buildPositionIndex()
+        j = bisect_right(self.fragends, pos)
+        if j >= len(fragtbl):
+            return None, None
+        if pos >= fragtbl.insertpos[j]:
+            # why are these "in: and before: added here
+            return fragtbl.seqnum[j], b'in: ' + fragtbl.idtext[j]
+        return fragtbl.seqnum[j], b'before: ' + fragtbl.idtext[j]
+
+    # find the partinfo entry of the part (file) that exists at pos in original rawML
+    def findPart(self, pos):
+        if self.partstarts is None:
+            for info in self.partinfo:
+                if pos >= info[3] and pos < info[4]:
+                    return info
+            return None
+        j = bisect_right(self.partstarts, pos) - 1
+        if j >= 0 and pos < self.partinfo[j][4]:
+            return self.partinfo[j]
+        return None
 
     # get information about the part (file) that exists at pos in original rawML
     def getFileInfo(self, pos):
-        for [partnum, pdir, filename, start, end, aidtext] in self.partinfo:
-            if pos >= start and pos < end:
-                return filename, partnum, start, end
-        return None, None, None, None
+        info = self.findPart(pos)
+        if info is None:
+            return None, None, None, None
+        [partnum, pdir, filename, start, end, aidtext] = info
+        return filename, partnum, start, end
 
     # accessor functions to properly protect the internal structure
     def getNumberOfParts(self):
@@ -358,14 +721,15 @@ class K8Processor:
         # (fromBase32 can handle both string types on input)
         row = fromBase32(posfid)
         off = fromBase32(offset)
-        [insertpos, idtext, filenum, seqnm, startpos, length] = self.fragtbl[row]
+        insertpos = self.fragtbl.insertpos[row]
+        filenum = self.fragtbl.filenum[row]
         pos = insertpos + off
         fname, pn, skelpos, skelend = self.getFileInfo(pos)
         if fname is None:
             # pos does not exist
             # default to skeleton pos instead
             print("Link To Position", pos, "does not exist, retargeting to top of target")
-            pos = self.skeltbl[filenum][3]
+            pos = self.skeltbl.skelpos[filenum]
             fname, pn, skelpos, skelend = self.getFileInfo(pos)
         # an existing "id=" or "name=" attribute must exist in original xhtml otherwise it would not have worked for linking.
         # Amazon seems to have added its own additional "aid=" inside tags whose contents seem to represent
@@ -374,47 +738,97 @@ class K8Processor:
         idtext = self.getIDTag(pos)
         return fname, idtext
 
+    def getIDTagsByPosFid(self, posfids):
+        # getIDTagByPosFid for a whole list of (posfid, offset) link targets, returns
+        # the (filename, idtext) of each in the same order.  Links to positions
+        # that do not exist are retargeted as usual and reported together.
+        positions = []
+        infos = []
+        missing = []
+        for posfid, offset in posfids:
+            row = fromBase32(posfid)
+            pos = self.fragtbl.insertpos[row] + fromBase32(offset)
+            info = self.findPart(pos)
+            if info is None:
+                missing.append(pos)
+                pos = self.skeltbl.skelpos[self.fragtbl.filenum[row]]
+                info = self.findPart(pos)
+            positions.append(pos)
+            infos.append(info)
+        if missing:
+            print("Links To %d Positions that do not exist, retargeting to top of target:" % len(missing),
+                  ' '.join([str(pos) for pos in missing]))
+        idtexts = self.findIDTags(positions, infos)
+        return [(info[2] if info is not None else None, idtext) for info, idtext in zip(infos, idtexts)]
+
+    def getIDTags(self, positions, page=False):
+        # getIDTag (getPageIDTag with page) for a whole list of positions, returns
+        # the idtext of each in the same order
+        return self.findIDTags(positions, [self.findPart(pos) for pos in positions], page)
+
+    def findIDTags(self, positions, infos, page=False):
+        # the positions are grouped by part (infos are their partinfo entries) and
+        # each part's anchor index is searched once in increasing order
+        idtexts = [b''] * len(positions)
+        targets = {}
+        for i in range(len(positions)):
+            pos = positions[i]
+            info = infos[i]
+            if info is None:
+                # reported the same way as a single lookup does
+                idtexts[i] = self.getPageIDTag(pos) if page else self.getIDTag(pos)
+                continue
+            [pn, pdir, filename, skelpos, skelend, aidtext] = info
+            if page:
+                npos = pageSearchPos(self.parts[pn], pos - skelpos)
+            else:
+                npos = idSearchPos(self.parts[pn], pos - skelpos)
+            targets.setdefault(pn, []).append((npos, i))
+        for pn in sorted(targets):
+            parttargets = sorted(targets[pn])
+            anchors = self.getAnchorIndex(pn).findSorted([npos for npos, i in parttargets], page)
+            for (npos, i), anchor in zip(parttargets, anchors):
+                if anchor is None:
+                    continue
+                if page:
+                    idtexts[i] = anchor
+                else:
+                    idtext, aid = anchor
+                    if aid is not None:
+                        self.linked_aids.add(aid)
+                    idtexts[i] = idtext
+        return idtexts
+
     def getIDTag(self, pos):
         # find the first tag with a named anchor (name or id attribute) before pos
         fname, pn, skelpos, skelend = self.getFileInfo(pos)
         if pn is None and skelpos is None:
             print("Error: getIDTag - no file contains ", pos)
-        textblock = self.parts[pn]
-        npos = pos - skelpos
-        # if npos inside a tag then search all text before the its end of tag marker
-        pgt = textblock.find(b'>',npos)
-        plt = textblock.find(b'<',npos)
-        if plt == npos or pgt < plt:
-            npos = pgt + 1
-        # find id and name attributes only inside of tags
-        # use a reverse tag search since that is faster
-        #    inside any < > pair find "id=" and "name=" attributes return it
-        #    [^>]* means match any amount of chars except for  '>' char
-        #    [^'"] match any amount of chars except for the quote character
-        #    \s* means match any amount of whitespace
-        textblock = textblock[0:npos]
-        id_pattern = re.compile(br'''<[^>]*\sid\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        name_pattern = re.compile(br'''<[^>]*\sname\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        aid_pattern = re.compile(br'''<[^>]+\s(?:aid|AID)\s*=\s*['"]([^'"]+)['"]''')
-        for tag in reverse_tag_iter(textblock):
-            # any ids in the body should default to top of file
-            if tag[0:6] == b'<body ':
-                return b''
-            if tag[0:6] != b'<meta ':
-                m = id_pattern.match(tag) or name_pattern.match(tag)
-                if m is not None:
-                    return m.group(1)
-                m = aid_pattern.match(tag)
-                if m is not None:
-                    self.linked_aids.add(m.group(1))
-                    return b'aid-' + m.group(1)
-        return b''
+        npos = idSearchPos(self.parts[pn], pos - skelpos)
+        # find the closest id, name or aid attribute in a tag before npos
+        anchor = self.getAnchorIndex(pn).find(npos)
+        if anchor is None:
+            return b''
+        idtext, aid = anchor
+        if aid is not None:
+            self.linked_aids.add(aid)
+        return idtext
+
+    # the anchor index of part pn, built the first time it is needed
+    def getAnchorIndex(self, pn):
+        index = self.anchorindexes.get(pn)
+        if index is None:
+            index = AnchorIndex(self.parts[pn])
+            self.anchorindexes[pn] = index
+        return index
 
     # do we need to do deep copying
     def setParts(self, parts):
         assert(len(parts) == len(self.parts))
         for i in range(len(parts)):
             self.parts[i] = parts[i]
+        # the anchor indexes describe the old parts
+        self.anchorindexes = {}
 
     # do we need to do deep copying
     def setFlows(self, flows):
@@ -424,25 +838,24 @@ class K8Processor:
 
     # get information about the part (file) that exists at pos in original rawML
     def getSkelInfo(self, pos):
-        for [partnum, pdir, filename, start, end, aidtext] in self.partinfo:
-            if pos >= start and pos < end:
-                return [partnum, pdir, filename, start, end, aidtext]
-        return [None, None, None, None, None, None]
+        info = self.findPart(pos)
+        if info is None:
+            return [None, None, None, None, None, None]
+        return list(info)
 
     # fileno is actually a reference into fragtbl (a fragment)
     def getGuideText(self):
         guidetext = b''
-        for [ref_type, ref_title, fileno] in self.guidetbl:
-            if ref_type == b'thumbimagestandard':
-                continue
+        guide = [(ref_type, ref_title, self.fragtbl.insertpos[fileno])
+                 for [ref_type, ref_title, fileno] in self.guidetbl if ref_type != b'thumbimagestandard']
+        idtexts = self.getIDTags([pos for ref_type, ref_title, pos in guide])
+        for [ref_type, ref_title, pos], idtext in zip(guide, idtexts):
             if ref_type not in _guide_types and not ref_type.startswith(b'other.'):
                 if ref_type == b'start':
                     ref_type = b'text'
                 else:
                     ref_type = b'other.' + ref_type
-            [pos, idtext, filenum, seqnm, startpos, length] = self.fragtbl[fileno]
             [pn, pdir, filename, skelpos, skelend, aidtext] = self.getSkelInfo(pos)
-            idtext = self.getIDTag(pos)
             linktgt = filename.encode('utf-8')
             if idtext != b'':
                 linktgt += b'#' + idtext
@@ -458,39 +871,9 @@ class K8Processor:
         fname, pn, skelpos, skelend = self.getFileInfo(pos)
         if pn is None and skelpos is None:
             print("Error: getIDTag - no file contains ", pos)
-        textblock = self.parts[pn]
-        npos = pos - skelpos
-        # if npos inside a tag then search all text before next ending tag
-        pgt = textblock.find(b'>',npos)
-        plt = textblock.find(b'<',npos)
-        if plt == npos or pgt < plt:
-            # we are in a tag
-            # so find first ending tag
-            pend1 = textblock.find(b'/>', npos)
-            pend2 = textblock.find(b'</', npos)
-            if pend1 != -1 and pend2 != -1:
-                pend = min(pend1, pend2)
-            else:
-                pend = max(pend1, pend2)
-            if pend != -1:
-                npos = pend
-            else:
-                npos = pgt + 1
-        # find id and name attributes only inside of tags
-        # use a reverse tag search since that is faster
-        #    inside any < > pair find "id=" and "name=" attributes return it
-        #    [^>]* means match any amount of chars except for  '>' char
-        #    [^'"] match any amount of chars except for the quote character
-        #    \s* means match any amount of whitespace
-        textblock = textblock[0:npos]
-        id_pattern = re.compile(br'''<[^>]*\sid\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        name_pattern = re.compile(br'''<[^>]*\sname\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        for tag in reverse_tag_iter(textblock):
-            # any ids in the body should default to top of file
-            if tag[0:6] == b'<body ':
-                return b''
-            if tag[0:6] != b'<meta ':
-                m = id_pattern.match(tag) or name_pattern.match(tag)
-                if m is not None:
-                    return m.group(1)
-        return b''
+        npos = pageSearchPos(self.parts[pn], pos - skelpos)
+        # find the closest id or name attribute in a tag before npos
+        idtext = self.getAnchorIndex(pn).find(npos, page=True)
+        if idtext is None:
+            return b''
+        return idtext
@@ -32,6 +32,14 @@ class ncxExtract:
         self.indx_data = None
 
     def parseNCX(self):
+        if self.mh.cache is not None:
+            indx_data = self.mh.cache.getObject('ncx-%d' % self.mh.start, self.sect, self.readNCX)
+        else:
+            indx_data = self.readNCX()
+        self.indx_data = indx_data
+        return indx_data
+
+    def readNCX(self):
         indx_data = []
         tag_fieldname_map = {
                 1: ['pos',0],
@@ -96,7 +104,6 @@ class ncxExtract:
                     print("pos_fid is ", tmp['pos_fid'])
                     print("\n\n")
                 num += 1
-        self.indx_data = indx_data
         return indx_data
 
     def buildNCX(self, htmlfile, title, ident, lang):
@@ -4,7 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
-from .compatibility_utils import PY2, unicode_str
+from .compatibility_utils import PY2, unicode_str, bstr
 
 if PY2:
     range = xrange
@@ -99,16 +99,10 @@ class PageMapProcessor:
         # print(pm_1, self.pm_len, self.pm_nn, self.pm_bits)
         self.pmstr = self.data[ptr+8:ptr+8+self.pm_len]
         self.pmoff = self.data[ptr+8+self.pm_len:]
-        offsize = b">L"
-        offwidth = 4
+        offsize = "L"
         if self.pm_bits == 16:
-            offsize = b">H"
-            offwidth = 2
-        ptr = 0
-        for i in range(self.pm_nn):
-            od, = struct.unpack_from(offsize, self.pmoff, ptr)
-            ptr += offwidth
-            self.pageoffsets.append(od)
+            offsize = "H"
+        self.pageoffsets = list(struct.unpack_from(bstr(">%d%s" % (self.pm_nn, offsize)), self.pmoff, 0))
         self.pagenames, self.pageMap = _parseNames(self.pm_nn, self.pmstr)
 
     def getPageMap(self):
@@ -122,19 +116,26 @@ class PageMapProcessor:
 
     # page-map.xml will be unicode but encoded to utf-8 immediately before being written to a file
     def generateKF8PageMapXML(self, k8proc):
-        pagemapxml = '<page-map xmlns="http://www.idpf.org/2007/opf">\n'
+        return ''.join(self.iterKF8PageMapXML(k8proc))
+
+    def iterKF8PageMapXML(self, k8proc):
+        # the lines of page-map.xml, the id tags of all pages are looked up
+        # together in one sweep over the parts (see K8Processor.getIDTags)
+        pages = []
         for i in range(len(self.pagenames)):
-            pos = self.pageoffsets[i]
             name = self.pagenames[i]
             if name is not None and name != "":
-                [pn, dir, filename, skelpos, skelend, aidtext] = k8proc.getSkelInfo(pos)
-                idtext = unicode_str(k8proc.getPageIDTag(pos))
-                linktgt = unicode_str(filename)
-                if idtext != '':
-                    linktgt += '#' + idtext
-                pagemapxml += '<page name="%s" href="%s/%s" />\n' % (name, dir, linktgt)
-        pagemapxml += "</page-map>\n"
-        return pagemapxml
+                pages.append((name, self.pageoffsets[i]))
+        idtexts = k8proc.getIDTags([pos for name, pos in pages], page=True)
+        yield '<page-map xmlns="http://www.idpf.org/2007/opf">\n'
+        for (name, pos), idtext in zip(pages, idtexts):
+            [pn, dir, filename, skelpos, skelend, aidtext] = k8proc.getSkelInfo(pos)
+            idtext = unicode_str(idtext)
+            linktgt = unicode_str(filename)
+            if idtext != '':
+                linktgt += '#' + idtext
+            yield '<page name="%s" href="%s/%s" />\n' % (name, dir, linktgt)
+        yield "</page-map>\n"
 
     def generateAPNX(self, apnx_meta):
         if apnx_meta['format'] == 'MOBI_8':
@@ -144,15 +145,9 @@ class PageMapProcessor:
         content_header = content_header.encode('utf-8')
         page_header = '{"asin":"%(asin)s","pageMap":"%(pageMap)s"}' % apnx_meta
         page_header = page_header.encode('utf-8')
-        apnx = struct.pack(b'>H',1) + struct.pack(b'>H',1)
-        apnx += struct.pack(b'>I', 12 + len(content_header))
-        apnx += struct.pack(b'>I', len(content_header))
-        apnx += content_header
-        apnx += struct.pack(b'>H', 1)
-        apnx += struct.pack(b'>H', len(page_header))
-        apnx += struct.pack(b'>H', self.pm_nn)
-        apnx += struct.pack(b'>H', 32)
-        apnx += page_header
-        for page in self.pageoffsets:
-            apnx += struct.pack(b'>L', page)
-        return apnx
+        apnx = [struct.pack(b'>HHII', 1, 1, 12 + len(content_header), len(content_header))]
+        apnx.append(content_header)
+        apnx.append(struct.pack(b'>HHHH', 1, len(page_header), self.pm_nn, 32))
+        apnx.append(page_header)
+        apnx.append(struct.pack(bstr('>%dL' % len(self.pageoffsets)), *self.pageoffsets))
+        return b''.join(apnx)
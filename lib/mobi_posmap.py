@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+from .compatibility_utils import PY2
+
+if PY2:
+    position_format = b'L'
+    sequence_format = b'l'
+else:
+    position_format = 'L'
+    sequence_format = 'l'
+
+import array
+
+
+class PositionMap(object):
+    # The markup inserted into the text of older mobis at text positions, the
+    # dictionary entries and the link anchors.  The markup is kept in a single
+    # append-only buffer and each insert is a (position, sequence, offset, length)
+    # entry of the arrays.  Markup appended at a position gets the rising positive
+    # sequence numbers and markup prepended the falling negative ones, so sorting
+    # the inserts once by position and sequence gives the order the markup goes
+    # into the text in: what was prepended last, ..., what was appended last.
+
+    def __init__(self):
+        self.positions = array.array(position_format)
+        self.sequences = array.array(sequence_format)
+        self.offsets = array.array(position_format)
+        self.lengths = array.array(position_format)
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def append(self, position, markup):
+        self.add(position, len(self.positions) + 1, markup)
+
+    def prepend(self, position, markup):
+        self.add(position, -len(self.positions) - 1, markup)
+
+    def add(self, position, sequence, markup):
+        self.positions.append(position)
+        self.sequences.append(sequence)
+        self.offsets.append(len(self.buffer))
+        self.lengths.append(len(markup))
+        self.buffer.extend(markup)
+
+    def extend(self, other):
+        # add the inserts of other as if they had been made on this map after its own
+        if not self.positions:
+            self.positions, self.sequences, self.offsets, self.lengths, self.buffer = \
+                other.positions, other.sequences, other.offsets, other.lengths, other.buffer
+            return
+        count = len(self.positions)
+        base = len(self.buffer)
+        self.positions.extend(other.positions)
+        self.sequences.extend(array.array(sequence_format, [sequence + count if sequence > 0 else sequence - count for sequence in other.sequences]))
+        self.offsets.extend(array.array(position_format, [offset + base for offset in other.offsets]))
+        self.lengths.extend(other.lengths)
+        self.buffer.extend(other.buffer)
+
+    def inserts(self):
+        # generator of the (position, markup) of the inserts in text order.  The
+        # sort keys hold the position in the high bits and the sequence number,
+        # which is the index of the insert plus one, in the low 32 bits.
+        keys = [(position << 32) + sequence + 0x80000000 for position, sequence in zip(self.positions, self.sequences)]
+        keys.sort()
+        buffer = self.buffer
+        offsets = self.offsets
+        lengths = self.lengths
+        for key in keys:
+            i = abs((key & 0xFFFFFFFF) - 0x80000000) - 1
+            yield key >> 32, bytes(buffer[offsets[i]:offsets[i]+lengths[i]])
@@ -7,6 +7,10 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 from .compatibility_utils import PY2, hexlify, bstr, bord, bchar
 
 import datetime
+import io
+import mmap
+import os
+from collections import OrderedDict
 
 if PY2:
     range = xrange
@@ -44,12 +48,29 @@ def datetimefrompalmtime(palmtime):
 
 class Sectionizer:
 
-    def __init__(self, filename):
+    def __init__(self, filename, usemmap=False):
+        # When usemmap is set the file is memory mapped instead of read into memory
+        # and loadSection returns zero-copy memoryview slices of the mapping
+        # (plain slices of the mapping under Python 2), so only the pages that are
+        # actually touched are ever resident.  Consumers that need real bytes for a
+        # small record (headers, indexes) should wrap the section with bytes().
         self.data = b''
+        self.view = None
+        self.usemmap = False
         with open(pathof(filename), 'rb') as f:
-            self.data = f.read()
-        self.palmheader = self.data[:78]
-        self.palmname = self.data[:32]
+            if usemmap:
+                try:
+                    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.usemmap = True
+                except (ValueError, EnvironmentError):
+                    # empty files and special files can not be mapped
+                    f.seek(0)
+            if not self.usemmap:
+                self.data = f.read()
+        if self.usemmap and not PY2:
+            self.view = memoryview(self.data)
+        self.palmheader = bytes(self.data[:78])
+        self.palmname = self.palmheader[:32]
         self.ident = self.palmheader[0x3C:0x3C+8]
         self.num_sections, = struct.unpack_from(b'>H', self.palmheader, 76)
         self.filelength = len(self.data)
@@ -117,4 +138,116 @@ class Sectionizer:
 
     def loadSection(self, section):
         before, after = self.sectionoffsets[section:section+2]
+        if self.view is not None:
+            return self.view[before:after]
         return self.data[before:after]
+
+    def close(self):
+        # unmaps the file, a view returned by loadSection that is still in use
+        # keeps the mapping alive until the view itself is gone
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.usemmap:
+            try:
+                self.data.close()
+            except BufferError:
+                pass
+            self.usemmap = False
+        self.data = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def fileDescriptor(f):
+    # the descriptor for positional reads of the file object f or None.  Only
+    # a plain disk file has offsets that are positions in the file, members of
+    # zip and tar archives are read through other objects (some hand out the
+    # descriptor of the whole archive) and pipes can not be read at a position.
+    if not hasattr(os, 'pread'):
+        return None
+    raw = getattr(f, 'raw', f)
+    if not isinstance(raw, io.FileIO) or not raw.seekable():
+        return None
+    return raw.fileno()
+
+
+class LazySectionizer(Sectionizer):
+    # Reads only the 78 byte Palm database header and the record offset table up front,
+    # every record is then fetched on demand.  The source can be a file name or any
+    # seekable binary file object (including members opened from zip or tar archives).
+    # Records read recently are kept in a small least recently used cache, so scanning
+    # record 0 and the EXTH of a large book only costs a few kilobytes of reading.
+
+    def __init__(self, source, cachesize=16):
+        self.data = b''
+        self.view = None
+        self.usemmap = False
+        self.cachesize = cachesize
+        self.cache = OrderedDict()
+        self.ownsfile = not hasattr(source, 'read')
+        if self.ownsfile:
+            self.file = open(pathof(source), 'rb')
+        else:
+            self.file = source
+        # positional reads do not move the file position, so several threads
+        # can read records at once when the source is a plain disk file
+        self.fd = fileDescriptor(self.file)
+        self.file.seek(0, 2)
+        self.filelength = self.file.tell()
+        self.palmheader = self.readAt(0, 78)
+        if len(self.palmheader) != 78:
+            self.close()
+            raise unpackException('file too short to be a palm database')
+        self.palmname = self.palmheader[:32]
+        self.ident = self.palmheader[0x3C:0x3C+8]
+        self.num_sections, = struct.unpack_from(b'>H', self.palmheader, 76)
+        table = self.readAt(78, self.num_sections*8)
+        if len(table) != self.num_sections*8:
+            self.close()
+            raise unpackException('file too short for its table of %d records' % self.num_sections)
+        sectionsdata = struct.unpack_from(bstr('>%dL' % (self.num_sections*2)), table, 0) + (self.filelength, 0)
+        self.sectionoffsets = sectionsdata[::2]
+        self.sectionattributes = sectionsdata[1::2]
+        self.sectiondescriptions = ["" for x in range(self.num_sections+1)]
+        self.sectiondescriptions[-1] = "File Length Only"
+        return
+
+    def readAt(self, offset, length):
+        if self.fd is not None:
+            data = os.pread(self.fd, length, offset)
+            # pread may return short counts, finish the read if it does
+            while len(data) < length:
+                more = os.pread(self.fd, length - len(data), offset + len(data))
+                if not more:
+                    break
+                data += more
+            return data
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def loadSection(self, section):
+        data = self.cache.get(section)
+        if data is not None:
+            # mark as most recently used
+            del self.cache[section]
+            self.cache[section] = data
+            return data
+        before, after = self.sectionoffsets[section:section+2]
+        data = self.readAt(before, after - before)
+        if self.cachesize > 0:
+            self.cache[section] = data
+            while len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+        return data
+
+    def close(self):
+        self.cache.clear()
+        if self.ownsfile and self.file is not None:
+            self.file.close()
+        self.file = None
+        self.fd = None
@@ -4,6 +4,9 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+from .compatibility_utils import PY2
+
+import mmap
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
@@ -292,11 +295,31 @@ def del_exth(rec0,exth_num):
 
 class mobi_split:
 
-    def __init__(self, infile):
+    def __init__(self, infile, usemmap=False):
         datain = b''
+        mapped = None
         with open(pathof(infile), 'rb') as f:
-            datain = f.read()
-        datain_rec0 = readsection(datain,0)
+            if usemmap and not PY2:
+                # all of the section surgery below only slices datain and joins
+                # the pieces, so a view of the mapped file avoids holding a copy
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                datain = memoryview(mapped)
+            else:
+                datain = f.read()
+        try:
+            self.split(datain)
+        finally:
+            if mapped is not None:
+                # the results are joined copies, nothing needs the mapping now
+                # (unless a traceback still holds views of it)
+                datain.release()
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass
+
+    def split(self, datain):
+        datain_rec0 = bytes(readsection(datain,0))
         ver = getint(datain_rec0,mobi_version)
         self.combo = (ver!=8)
         if not self.combo:
@@ -312,7 +335,7 @@ class mobi_split:
             if datain_kf8 == 0xffffffff:
                 self.combo = False
                 return
-        datain_kfrec0 =readsection(datain,datain_kf8)
+        datain_kfrec0 = bytes(readsection(datain,datain_kf8))
 
         # create the standalone mobi7
         num_sec = getint(datain,number_of_pdb_records,b'H')
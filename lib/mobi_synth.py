@@ -0,0 +1,1380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+
+__path__ = ["lib", os.path.dirname(os.path.realpath(__file__)), "kindleunpack"]
+
+import sys
+import getopt
+import heapq
+import random
+import re
+import tempfile
+import zlib
+
+from .compatibility_utils import PY2, bchr, bstr, unicode_argv
+
+if PY2:
+    range = xrange
+
+import struct
+# note:  struct pack, unpack, unpack_from all require bytestring format
+# data all the way up to at least python 2.7.5, python 3 okay with bytestring
+
+from .mobi_utils import toBase32
+from .unipath import pathof
+
+# Synthetic ebook generator.
+#
+# Writes Palm database files in the formats KindleUnpack reads so that the
+# unpacking stages can be benchmarked and load tested without real books:
+#
+#   palmdoc - PalmDOC TEXtREAd book
+#   mobi7   - Mobipocket 7 book with NCX, guide, filepos links and images
+#   kf8     - KF8 only book with skeleton, fragment, NCX and guide indexes,
+#             FDST flows, RESC, fonts, HD images and a page map
+#   combo   - combination Mobi7/KF8 book divided by a BOUNDARY section
+#   dict    - Mobipocket 7 dictionary with orth and inflection indexes
+#
+# The text of each book is made up from a seeded pseudo random word list
+# so the output is reproducible for a given set of parameters.
+
+TEXT_RECORD_SIZE = 4096
+""" The uncompressed size of each text record. """
+
+MAX_TEXT_SIZE = 0xff00 * TEXT_RECORD_SIZE
+""" The largest text a single book part can hold, leaving room for the other records. """
+
+MAX_INDX_RECORD = 0xf000
+""" Approximate upper limit for the size of one INDX or CTOC record. """
+
+HUFF_SAMPLE_SIZE = 1024*1024
+""" Amount of text the Huffman code and phrase dictionary are built from. """
+
+EOF_RECORD = b'\xe9\x8e' + b'\r\n'
+
+_WORDS = (b'the', b'of', b'and', b'to', b'in', b'a', b'is', b'that', b'for', b'it',
+          b'as', b'was', b'with', b'be', b'by', b'on', b'not', b'he', b'this', b'are',
+          b'or', b'his', b'from', b'at', b'which', b'but', b'have', b'an', b'had', b'they',
+          b'kindle', b'book', b'reader', b'chapter', b'river', b'mountain', b'letter',
+          b'garden', b'window', b'silence', b'journey', b'harbour', b'lantern', b'winter',
+          b'morning', b'evening', b'stranger', b'village', b'history', b'question',
+          b'shadow', b'library', b'promise', b'distance', b'feather', b'machine')
+
+_GIF_HEADER = b'GIF89a'
+
+
+class unpackException(Exception):
+    pass
+
+
+def writeVWI(value):
+    # forward encoded variable width integer, the last byte has the high bit set
+    out = [0x80 | (value & 0x7f)]
+    value >>= 7
+    while value:
+        out.append(value & 0x7f)
+        value >>= 7
+    out.reverse()
+    return bstr(bytearray(out))
+
+
+def makeImage(n, width=None, height=None, size=0):
+    # a minimal but well formed single colour gif image, padded out to
+    # about size bytes with comment extension blocks
+    if width is None:
+        width = 16 + (n % 64)
+    if height is None:
+        height = 16 + ((n * 7) % 64)
+    data = _GIF_HEADER + struct.pack(b'<HHBBB', width, height, 0x80, 0, 0)
+    data += bstr(bytearray([n & 0xff, (n >> 3) & 0xff, 0x7f, 0, 0, 0]))
+    data += b'\x2c' + struct.pack(b'<HHHHB', 0, 0, width, height, 0)
+    data += b'\x02\x02\x44\x01\x00'
+    padding = size - len(data) - 4
+    if padding > 0:
+        blocks = (padding + 254) // 256
+        data += b'\x21\xfe' + (b'\xff' + b'\x20' * 255) * blocks + b'\x00'
+    return data + b'\x3b'
+
+
+
+class PalmdocWriter:
+    # Greedy LZ77 compression into PalmDOC byte codes.  Rather than searching the
+    # window at every byte, the text is cut into tokens (a word and its trailing
+    # space, or a short run of other characters) and a token of 3 to 10 bytes is
+    # replaced by a back reference to its last occurrence when that is close
+    # enough.  The generated text is built from a small word list so almost every
+    # word repeats within the window, which keeps compression realistic while
+    # making large books fast enough to generate.
+
+    token_pattern = re.compile(br'''[^ ]{1,9} ?| ''')
+
+    def pack(self, data):
+        out = bytearray()
+        last = {}
+        for m in self.token_pattern.finditer(data):
+            tok = m.group()
+            p = m.start()
+            n = len(tok)
+            if n >= 3:
+                q = last.get(tok)
+                last[tok] = p
+                if q is not None and p - q <= 2047:
+                    out += struct.pack(b'>H', 0x8000 | ((p - q) << 3) | (n - 3))
+                    continue
+            self.literal(out, bytearray(tok))
+        return bytes(out)
+
+    def literal(self, out, ldata):
+        n = len(ldata)
+        p = 0
+        while p < n:
+            c = ldata[p]
+            if c == 0x20 and p + 1 < n and 0x40 <= ldata[p+1] < 0x80:
+                out.append(ldata[p+1] ^ 0x80)
+                p += 2
+            elif c == 0 or 0x09 <= c < 0x80:
+                out.append(c)
+                p += 1
+            else:
+                run = 1
+                while run < 8 and p + run < n and (ldata[p+run] >= 0x80 or 1 <= ldata[p+run] <= 8):
+                    run += 1
+                out.append(run)
+                out += ldata[p:p+run]
+                p += run
+
+
+class HuffcdicWriter:
+    # Builds a canonical Huffman code over all 256 byte values plus the most
+    # common words of a text sample, stored in one HUFF and several CDIC
+    # sections.  Every other phrase is stored in its compressed (unexpanded)
+    # form so that recursive phrase expansion is exercised on decoding.
+
+    token_pattern = re.compile(br'''[A-Za-z]+ ?|[^A-Za-z]''')
+
+    def __init__(self, sample, maxphrases=2048, cdicbits=10):
+        counts = {}
+        for tok in self.token_pattern.findall(sample):
+            if len(tok) > 1:
+                counts[tok] = counts.get(tok, 0) + 1
+        common = sorted(counts.items(), key=lambda kv: (-kv[1] * len(kv[0]), kv[0]))
+        phrases = [tok for tok, cnt in common[:maxphrases] if cnt > 1]
+        self.symbols = [bchr(i) for i in range(256)] + phrases
+        self.phraseid = dict((p, 256 + i) for i, p in enumerate(phrases))
+        self.cdicbits = cdicbits
+
+        freqs = [1] * len(self.symbols)
+        for tok in self.token_pattern.findall(sample):
+            sym = self.phraseid.get(tok)
+            if sym is not None:
+                freqs[sym] += 1
+            else:
+                for c in bytearray(tok):
+                    freqs[c] += 1
+        self.expanded = [True] * len(self.symbols)
+        for i in range(len(phrases)):
+            if i % 2 == 1:
+                sym = 256 + i
+                self.expanded[sym] = False
+                for c in bytearray(self.symbols[sym]):
+                    freqs[c] += 1
+        lengths = self._codeLengths(freqs)
+        self._assignCodes(lengths)
+
+    def _codeLengths(self, freqs):
+        while True:
+            heap = [(f, i, None) for i, f in enumerate(freqs)]
+            heapq.heapify(heap)
+            parent = {}
+            nxt = len(freqs)
+            while len(heap) > 1:
+                f1, i1, _ = heapq.heappop(heap)
+                f2, i2, _ = heapq.heappop(heap)
+                parent[i1] = nxt
+                parent[i2] = nxt
+                heapq.heappush(heap, (f1 + f2, nxt, None))
+                nxt += 1
+            lengths = []
+            for i in range(len(freqs)):
+                depth = 0
+                j = i
+                while j in parent:
+                    j = parent[j]
+                    depth += 1
+                lengths.append(depth)
+            if max(lengths) <= 24:
+                return lengths
+            freqs = [(f >> 1) + 1 for f in freqs]
+
+    def _assignCodes(self, lengths):
+        # standard canonical codes are complemented so that longer codes are
+        # numerically smaller, which is what the mobi huffman tables expect
+        order = sorted(range(len(lengths)), key=lambda i: (lengths[i], i))
+        self.codes = [None] * len(lengths)
+        code = 0
+        prevlen = lengths[order[0]]
+        for i in order:
+            code <<= (lengths[i] - prevlen)
+            prevlen = lengths[i]
+            self.codes[i] = (((1 << lengths[i]) - 1) ^ code, lengths[i])
+            code += 1
+        # dictionary index order is by length, then by descending code
+        self.order = order
+        self.index = [0] * len(lengths)
+        for n, i in enumerate(order):
+            self.index[i] = n
+        self.lo = {}
+        self.hi = {}
+        self.base = {}
+        for n, i in enumerate(order):
+            c, l = self.codes[i]
+            if l not in self.base:
+                self.base[l] = n
+                self.hi[l] = c
+            self.lo[l] = c
+
+    def getHuffRecord(self):
+        maxcode = {}
+        for l in self.base:
+            maxcode[l] = self.hi[l] + self.base[l]
+        dict1 = []
+        for p in range(256):
+            dict1.append(None)
+        minlong = {}
+        for i in range(len(self.codes)):
+            c, l = self.codes[i]
+            if l <= 8:
+                for p in range(c << (8 - l), (c + 1) << (8 - l)):
+                    dict1[p] = l | 0x80 | (maxcode[l] << 8)
+            else:
+                p = c >> (l - 8)
+                minlong[p] = min(minlong.get(p, 32), l)
+        for p in minlong:
+            dict1[p] = minlong[p]
+        dict2 = []
+        shortest = None
+        for l in range(1, 33):
+            if l in self.lo:
+                mincode = self.lo[l]
+                aligned = mincode << (32 - l)
+                if shortest is None or aligned < shortest:
+                    shortest = aligned
+                dict2.append(mincode)
+                dict2.append(maxcode[l])
+            else:
+                if shortest is None:
+                    dict2.append(0)
+                else:
+                    dict2.append(shortest >> (32 - l))
+                dict2.append(0)
+        rec = b'HUFF' + struct.pack(b'>LLL', 24, 24, 24 + 1024)
+        rec += struct.pack(b'>L', 0) * 2
+        rec = rec[:24]
+        rec += struct.pack(b'>256L', *dict1)
+        rec += struct.pack(b'>64L', *dict2)
+        return rec
+
+    def _encodeSymbols(self, syms):
+        acc = 0
+        nbits = 0
+        for s in syms:
+            c, l = self.codes[s]
+            acc = (acc << l) | c
+            nbits += l
+        pad = (-nbits) % 8
+        acc <<= pad
+        nbytes = (nbits + pad) // 8
+        out = bytearray()
+        for k in range(nbytes - 1, -1, -1):
+            out.append((acc >> (8 * k)) & 0xff)
+        return bytes(out)
+
+    def getCdicRecords(self):
+        nphrases = len(self.symbols)
+        perrec = 1 << self.cdicbits
+        records = []
+        for first in range(0, nphrases, perrec):
+            entries = []
+            for n in range(first, min(first + perrec, nphrases)):
+                sym = self.order[n]
+                text = self.symbols[sym]
+                if self.expanded[sym]:
+                    entries.append(struct.pack(b'>H', 0x8000 | len(text)) + text)
+                else:
+                    bits = self._encodeSymbols(bytearray(text))
+                    entries.append(struct.pack(b'>H', len(bits)) + bits)
+            offsets = []
+            off = 2 * len(entries)
+            for e in entries:
+                offsets.append(off)
+                off += len(e)
+            rec = b'CDIC' + struct.pack(b'>LLL', 16, nphrases, self.cdicbits)
+            rec += struct.pack(bstr('>%dH' % len(offsets)), *offsets)
+            rec += b''.join(entries)
+            records.append(rec)
+        return records
+
+    def pack(self, data):
+        syms = []
+        for tok in self.token_pattern.findall(data):
+            sym = self.phraseid.get(tok)
+            if sym is not None:
+                syms.append(sym)
+            else:
+                syms.extend(bytearray(tok))
+        return self._encodeSymbols(syms)
+
+
+# Index (INDX) support
+
+def buildTAGX(tagTable, controlByteCount):
+    data = b'TAGX' + struct.pack(b'>LL', 12 + 4 * len(tagTable), controlByteCount)
+    for tag, valuesPerEntry, mask, endFlag in tagTable:
+        data += bstr(bytearray([tag, valuesPerEntry, mask, endFlag]))
+    return data
+
+
+def encodeTagValues(tagTable, controlByteCount, tagMap):
+    controls = [0] * controlByteCount
+    byteLengths = []
+    values = []
+    cbi = 0
+    for tag, valuesPerEntry, mask, endFlag in tagTable:
+        if endFlag == 0x01:
+            cbi += 1
+            continue
+        if tag not in tagMap:
+            continue
+        vals = tagMap[tag]
+        encoded = b''.join(writeVWI(v) for v in vals)
+        shift = 0
+        while not (mask >> shift) & 1:
+            shift += 1
+        count = len(vals) // valuesPerEntry
+        single = (mask >> shift) == 1
+        if single and count == 1:
+            controls[cbi] |= mask
+        elif not single and count < (mask >> shift):
+            controls[cbi] |= count << shift
+        elif not single:
+            controls[cbi] |= mask
+            byteLengths.append(writeVWI(len(encoded)))
+        else:
+            raise unpackException('tag %d can only hold a single value group' % tag)
+        values.append(encoded)
+    return bstr(bytearray(controls)) + b''.join(byteLengths) + b''.join(values)
+
+
+def _indxHeader(hdrtype, start, count, code=65001, total=0, nctoc=0):
+    words = [0xc0, 0, hdrtype, 0, start, count, code, 0xffffffff, total, 0, 0, 0, nctoc]
+    data = b'INDX' + struct.pack(b'>13L', *words)
+    data += b'\x00' * (0xc0 - len(data))
+    return data
+
+
+def _pad4(data):
+    return data + b'\x00' * ((-len(data)) % 4)
+
+
+def _indxRecord(entries):
+    data = _pad4(b''.join(entries))
+    idxt = b'IDXT'
+    pos = 0xc0
+    for e in entries:
+        idxt += struct.pack(b'>H', pos)
+        pos += len(e)
+    start = 0xc0 + len(data)
+    return _pad4(_indxHeader(1, start, len(entries)) + data + idxt)
+
+
+def buildIndex(entries, tagTable, controlByteCount, ctocrecords=()):
+    # entries is a list of (text, tagMap) tuples
+    # returns the main INDX record, the data records and the CTOC records
+    records = []
+    current = []
+    size = 0
+    lasttexts = []
+    for text, tagMap in entries:
+        entry = bchr(len(text)) + text + encodeTagValues(tagTable, controlByteCount, tagMap)
+        if current and size + len(entry) + 2 * len(current) > MAX_INDX_RECORD:
+            records.append(_indxRecord(current))
+            current = []
+            size = 0
+        current.append(entry)
+        size += len(entry)
+        lasttexts.append((len(records), text))
+    if current:
+        records.append(_indxRecord(current))
+    # the main index record holds the tag table and the last entry of each data record
+    last = {}
+    for recno, text in lasttexts:
+        last[recno] = text
+    geometry = []
+    for recno in range(len(records)):
+        text = last[recno]
+        geometry.append(bchr(len(text)) + text + struct.pack(b'>H', 0))
+    tagx = _pad4(buildTAGX(tagTable, controlByteCount))
+    body = tagx + _pad4(b''.join(geometry))
+    idxt = b'IDXT'
+    pos = 0xc0 + len(tagx)
+    for g in geometry:
+        idxt += struct.pack(b'>H', pos)
+        pos += len(g)
+    main = _indxHeader(0, 0xc0 + len(body), len(records), total=len(entries), nctoc=len(ctocrecords))
+    main = _pad4(main + body + idxt)
+    return [main] + records + list(ctocrecords)
+
+
+class CTOCBuilder:
+
+    def __init__(self):
+        self.records = [b'']
+        self.offsets = {}
+
+    def add(self, text):
+        if text in self.offsets:
+            return self.offsets[text]
+        item = writeVWI(len(text)) + text
+        if len(self.records[-1]) + len(item) > MAX_INDX_RECORD:
+            self.records.append(b'')
+        off = len(self.records[-1]) + 0x10000 * (len(self.records) - 1)
+        self.records[-1] += item
+        self.offsets[text] = off
+        return off
+
+    def getRecords(self):
+        return [_pad4(r) for r in self.records if r]
+
+
+# PDB output
+
+class PDBWriter:
+    # records are spooled to a temporary file so that very large books
+    # never have to be held in memory at once
+
+    def __init__(self, name, ident):
+        self.name = name
+        self.ident = ident
+        self.lengths = []
+        self.spool = tempfile.TemporaryFile()
+
+    def addRecord(self, data):
+        self.spool.write(data)
+        self.lengths.append(len(data))
+        return len(self.lengths) - 1
+
+    def replaceRecord(self, num, data):
+        # only records of the same size may be replaced
+        assert len(data) == self.lengths[num]
+        pos = self.spool.tell()
+        self.spool.seek(sum(self.lengths[:num]))
+        self.spool.write(data)
+        self.spool.seek(pos)
+
+    def count(self):
+        return len(self.lengths)
+
+    def write(self, outfile):
+        n = len(self.lengths)
+        if n > 0xffff:
+            raise unpackException('a palm database can not hold %d records' % n)
+        name = self.name[:31]
+        header = name + b'\x00' * (32 - len(name))
+        header += struct.pack(b'>HHLLLLLL', 0, 0, 0x6a4a8e80, 0x6a4a8e80, 0, 0, 0, 0)
+        header += self.ident
+        header += struct.pack(b'>LLH', 2 * n - 1, 0, n)
+        offset = len(header) + 8 * n + 2
+        table = []
+        for i in range(n):
+            table.append(struct.pack(b'>LL', offset, 2 * i))
+            offset += self.lengths[i]
+        with open(pathof(outfile), 'wb') as f:
+            f.write(header)
+            f.write(b''.join(table))
+            f.write(b'\x00\x00')
+            self.spool.seek(0)
+            while True:
+                chunk = self.spool.read(1 << 20)
+                if not chunk:
+                    break
+                f.write(chunk)
+        self.spool.close()
+
+
+# Text generation
+
+class TextGenerator:
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def sentence(self, nwords=None):
+        rng = self.rng
+        if nwords is None:
+            nwords = rng.randint(6, 18)
+        words = [rng.choice(_WORDS) for _ in range(nwords)]
+        words[0] = words[0][0:1].upper() + words[0][1:]
+        return b' '.join(words) + b'.'
+
+    def paragraph(self):
+        return b' '.join(self.sentence() for _ in range(self.rng.randint(2, 6)))
+
+    def word(self):
+        rng = self.rng
+        return b''.join(rng.choice(_WORDS)[0:rng.randint(2, 4)] for _ in range(rng.randint(2, 3)))
+
+
+def _fixedpos(value, width=10):
+    return ('%0*d' % (width, value)).encode('ascii')
+
+
+# Mobi header (record 0) construction
+
+_EXTH_STRINGS = {100: 'creator', 101: 'publisher', 503: 'title', 524: 'language'}
+
+def buildEXTH(items):
+    data = b''
+    for id, value in items:
+        data += struct.pack(b'>LL', id, len(value) + 8) + value
+    exth = b'EXTH' + struct.pack(b'>LL', len(data) + 12, len(items)) + data
+    return _pad4(exth)
+
+
+def buildRecord0(title, version, compression, textlength, textrecords, fields, exth_items, extraflags=0, headerlen=None):
+    # fields maps a record 0 offset to a (format, value) tuple
+    if headerlen is None:
+        headerlen = 0x108 if version >= 8 else 0xe8
+    hdr = bytearray(16 + headerlen)
+    struct.pack_into(b'>HHLHHHH', hdr, 0, compression, 0, textlength, textrecords, TEXT_RECORD_SIZE, 0, 0)
+    hdr[16:20] = b'MOBI'
+    struct.pack_into(b'>LLLLL', hdr, 20, headerlen, 2, 65001, 0x4b554e50, version)
+    # fill all index pointers with "not present"
+    for off in range(0x28, 0x50, 4):
+        struct.pack_into(b'>L', hdr, off, 0xffffffff)
+    struct.pack_into(b'>L', hdr, 0x5c, 9)
+    struct.pack_into(b'>L', hdr, 0x68, version)
+    struct.pack_into(b'>LLLL', hdr, 0x70, 0, 0, 0, 0)
+    struct.pack_into(b'>L', hdr, 0x80, 0x50)
+    struct.pack_into(b'>L', hdr, 0xc0, 0xffffffff)
+    for off in (0xc8, 0xd0, 0xe0, 0xf4):
+        if off + 4 <= 16 + headerlen:
+            struct.pack_into(b'>L', hdr, off, 0xffffffff)
+    for off in (0xf8, 0xfc, 0x100, 0x104):
+        if off + 4 <= 16 + headerlen:
+            struct.pack_into(b'>L', hdr, off, 0xffffffff)
+    struct.pack_into(b'>H', hdr, 0xf2, extraflags)
+    for off in fields:
+        fmt, value = fields[off]
+        struct.pack_into(fmt, hdr, off, value)
+    exth = buildEXTH(exth_items)
+    titleoff = len(hdr) + len(exth)
+    struct.pack_into(b'>LL', hdr, 0x54, titleoff, len(title))
+    rec = bytes(hdr) + exth + title + b'\x00\x00'
+    rec = _pad4(rec) + b'\x00' * 1024
+    return rec
+
+
+class TextRecordWriter:
+
+    def __init__(self, compression, sample, trailers=True):
+        self.compression = compression
+        self.trailers = trailers
+        self.huff = None
+        if compression == 2:
+            self.packer = PalmdocWriter().pack
+        elif compression == 0x4448:
+            self.huff = HuffcdicWriter(bytes(sample[:HUFF_SAMPLE_SIZE]))
+            self.packer = self.huff.pack
+        else:
+            self.packer = lambda data: data
+
+    def extraFlags(self):
+        # multibyte flag plus one extra trailing data entry
+        if self.trailers:
+            return 0x3
+        return 0
+
+    def records(self, text):
+        for pos in range(0, len(text), TEXT_RECORD_SIZE):
+            data = self.packer(bytes(text[pos:pos+TEXT_RECORD_SIZE]))
+            if self.trailers:
+                # a multibyte byte with no extra bytes then one trailing
+                # entry of size 3 (2 bytes of data plus the size byte)
+                data += b'\x00' + b'\x01\x02' + b'\x83'
+            yield data
+
+
+def _addTextRecords(pdb, writer, text):
+    first = None
+    count = 0
+    for data in writer.records(text):
+        n = pdb.addRecord(data)
+        if first is None:
+            first = n
+        count += 1
+    return first, count
+
+
+def _addHuffRecords(pdb, writer):
+    if writer.huff is None:
+        return 0, 0
+    first = pdb.addRecord(writer.huff.getHuffRecord())
+    cdics = writer.huff.getCdicRecords()
+    for rec in cdics:
+        pdb.addRecord(rec)
+    return first, 1 + len(cdics)
+
+
+# Book content builders
+
+class Mobi7Content:
+
+    def __init__(self, gen, textsize, nimages, nchapters=None, dictentries=0):
+        self.gen = gen
+        if nchapters is None:
+            nchapters = max(1, textsize // 20000)
+        self.nchapters = nchapters
+        self.nimages = nimages
+        self.dictentries = dictentries
+        self.seen = set()
+        self.build(textsize)
+
+    def build(self, textsize):
+        gen = self.gen
+        rng = gen.rng
+        head = b'<html><head><guide><reference title="Start" type="text" filepos=' + _fixedpos(0) + b' /></guide></head><body>'
+        # the text is built in place, very large books would otherwise need
+        # several copies of it in memory at once
+        text = bytearray(head)
+        size = len(head)
+        chapters = []
+        links = []
+        self.entries = []
+        perchapter = max(1, textsize // self.nchapters)
+        imgno = 0
+        for c in range(self.nchapters):
+            chapters.append(size)
+            title = ('Chapter %d' % (c + 1)).encode('ascii')
+            piece = b'<mbp:pagebreak/><h2>' + title + b'</h2>'
+            text += piece
+            size += len(piece)
+            target = size + perchapter
+            while size < target:
+                if self.dictentries and len(self.entries) < self.dictentries:
+                    word = gen.word()
+                    while word in self.seen:
+                        word = gen.word()
+                    self.seen.add(word)
+                    start = size
+                    piece = b'<b>' + word + b'</b> ' + gen.sentence() + b'<hr/>'
+                    self.entries.append((word, start, len(piece)))
+                else:
+                    r = rng.random()
+                    if r < 0.15:
+                        links.append(size)
+                        piece = b'<p>See <a filepos=' + _fixedpos(0) + b'>' + gen.sentence(3) + b'</a></p>'
+                    elif r < 0.25 and self.nimages:
+                        piece = b'<p><img recindex="' + ('%05d' % ((imgno % self.nimages) + 1)).encode('ascii') + b'" /></p>'
+                        imgno += 1
+                    else:
+                        piece = b'<p>' + gen.paragraph() + b'</p>'
+                text += piece
+                size += len(piece)
+        text += b'</body></html>'
+
+        # now resolve the link targets (to chapter starts and random positions)
+        guidepos = head.find(b'filepos=') + 8
+        text[guidepos:guidepos+10] = _fixedpos(chapters[0])
+        for pos in links:
+            off = text.find(b'filepos=', pos) + 8
+            target = rng.choice(chapters) if rng.random() < 0.5 else text.find(b'<p>', rng.randrange(len(text)))
+            if target < 0:
+                target = chapters[0]
+            text[off:off+10] = _fixedpos(target)
+        self.text = text
+        self.chapters = chapters
+
+
+def buildNCX7(chapters, textlen):
+    ctoc = CTOCBuilder()
+    entries = []
+    tagTable = [(1, 1, 0x01, 0), (2, 1, 0x02, 0), (3, 1, 0x04, 0), (4, 1, 0x08, 0), (0, 0, 0, 1)]
+    for i, pos in enumerate(chapters):
+        end = chapters[i+1] if i + 1 < len(chapters) else textlen
+        label = ctoc.add(('Chapter %d' % (i + 1)).encode('ascii'))
+        entries.append((('%03X' % i).encode('ascii'), {1: [pos], 2: [end - pos], 3: [label], 4: [0]}))
+    return buildIndex(entries, tagTable, 1, ctoc.getRecords())
+
+
+class KF8Content:
+
+    def __init__(self, gen, textsize, nparts, nimages, nfonts=0, fragsperpart=None):
+        self.gen = gen
+        self.nparts = max(1, nparts)
+        self.nimages = nimages
+        self.nfonts = nfonts
+        if fragsperpart is None:
+            fragsperpart = max(1, min(50, textsize // (self.nparts * 2000)))
+        self.fragsperpart = fragsperpart
+        self.build(textsize)
+
+    def _fragment(self, aid, size):
+        gen = self.gen
+        rng = gen.rng
+        pieces = [b'<div aid="' + aid + b'">']
+        n = len(pieces[0])
+        while n < size:
+            r = rng.random()
+            self.aidnum += 1
+            eaid = toBase32(self.aidnum)
+            if r < 0.1:
+                self.idnum += 1
+                piece = b'<h3 id="id' + str(self.idnum).encode('ascii') + b'" aid="' + eaid + b'">' + gen.sentence(4) + b'</h3>'
+            elif r < 0.3:
+                piece = b'<p aid="' + eaid + b'">See <a href="kindle:pos:fid:0000:off:0000000000">' + gen.sentence(3) + b'</a>.</p>'
+            elif r < 0.38 and self.nimages:
+                img = toBase32((self.imgno % self.nimages) + 1)
+                self.imgno += 1
+                piece = b'<p aid="' + eaid + b'"><img src="kindle:embed:' + img + b'?mime=image/gif" alt=""/></p>'
+            elif r < 0.41 and self.nimages:
+                img = toBase32((self.imgno % self.nimages) + 1)
+                self.imgno += 1
+                piece = b'<div aid="' + eaid + b'" style="background-image:url(kindle:embed:' + img + b'?mime=image/gif)">' + gen.sentence(3) + b'</div>'
+            elif r < 0.44:
+                piece = b'<ol aid="' + eaid + b'"><li value="1">' + gen.sentence(3) + b'</li><li value="2">' + gen.sentence(2) + b'</li></ol>'
+            elif r < 0.46:
+                piece = b'<div aid="' + eaid + b'" data-AmznPageBreak="always">' + gen.sentence(3) + b'</div>'
+            elif r < 0.47:
+                piece = b'<svg xmlns="http://www.w3.org/2000/svg" viewbox="0 0 10 10" preserveaspectratio="none"><rect width="5" height="5"/></svg>'
+            elif r < 0.48:
+                piece = b'<p aid="' + eaid + b'"><img src="kindle:flow:0002?mime=image/svg+xml" alt=""/></p>'
+            else:
+                piece = b'<p aid="' + eaid + b'">' + gen.paragraph() + b'</p>'
+            pieces.append(piece)
+            n += len(piece)
+        pieces.append(b'</div>')
+        return b''.join(pieces)
+
+    def build(self, textsize):
+        gen = self.gen
+        rng = gen.rng
+        self.aidnum = 0
+        self.idnum = 0
+        self.imgno = 0
+        text = bytearray()
+        rawlen = 0
+        self.skeletons = []  # name, fragcount, start, length
+        self.fragments = []  # insertpos, ctoc text, filenum, seqnum, start, length
+        fragsize = max(200, textsize // (self.nparts * self.fragsperpart))
+        seq = 0
+        for p in range(self.nparts):
+            self.aidnum += 1
+            bodyaid = toBase32(self.aidnum)
+            head = (b'<?xml version="1.0" encoding="utf-8"?>\n'
+                    b'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Part ' + str(p).encode('ascii') +
+                    b'</title><link href="kindle:flow:0001?mime=text/css" rel="stylesheet" type="text/css"/>'
+                    b'</head><body aid="' + bodyaid + b'">')
+            tail = b'</body></html>'
+            skelpos = rawlen
+            text += head + tail
+            rawlen += len(head) + len(tail)
+            insertpos = skelpos + len(head)
+            for f in range(self.fragsperpart):
+                frag = self._fragment(toBase32(self.aidnum + 1000000), fragsize)
+                ctoctext = b"P-//*[@aid='" + bodyaid + b"']"
+                self.fragments.append([insertpos, ctoctext, p, seq, 0, len(frag)])
+                text += frag
+                rawlen += len(frag)
+                insertpos += len(frag)
+                seq += 1
+            self.skeletons.append([('SKEL%010d' % p).encode('ascii'), self.fragsperpart, skelpos, len(head) + len(tail)])
+        # resolve kindle:pos:fid links to random element start tags in other fragments
+        marker = b'kindle:pos:fid:0000:off:0000000000'
+        pos = text.find(marker)
+        while pos >= 0:
+            fid = rng.randrange(len(self.fragments))
+            insertpos, ctoctext, filenum, seqnum, start, length = self.fragments[fid]
+            # locate the raw position of the fragment
+            fragraw = self._fragmentRawStart(fid)
+            off = text.find(b'<', fragraw + rng.randrange(length)) - fragraw
+            if off < 0 or off >= length:
+                off = 0
+            text[pos:pos+len(marker)] = b'kindle:pos:fid:' + toBase32(fid) + b':off:' + toBase32(off, 10)
+            pos = text.find(marker, pos + len(marker))
+        self.text = text
+        self.ncx = []
+        for p in range(self.nparts):
+            fid = p * self.fragsperpart
+            self.ncx.append((('Part %d' % (p + 1)).encode('ascii'), fid, 0))
+        # flows: css then an svg image
+        css = b'body { margin: 0 }\np { text-indent: 1em }\n'
+        if self.nimages:
+            css += b'.pic { background: url(kindle:embed:0001?mime=image/gif) }\n'
+        for i in range(self.nfonts):
+            css += b'@font-face { font-family: "F' + str(i).encode('ascii') + b'"; src: url(kindle:embed:' + toBase32(self.nimages + i + 1) + b') }\n'
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10"><rect width="10" height="10"/></svg>'
+        self.flows = [css, svg]
+
+    def _fragmentRawStart(self, fid):
+        if not hasattr(self, '_rawstarts'):
+            starts = []
+            fragptr = 0
+            for name, fragcnt, skelpos, skellen in self.skeletons:
+                base = skelpos + skellen
+                for i in range(fragcnt):
+                    starts.append(base)
+                    base += self.fragments[fragptr][5]
+                    fragptr += 1
+            self._rawstarts = starts
+        return self._rawstarts[fid]
+
+    def rawML(self):
+        return self.text + b''.join(self.flows)
+
+    def fdst(self):
+        bounds = [0, len(self.text)]
+        for f in self.flows:
+            bounds.append(bounds[-1] + len(f))
+        data = b'FDST' + struct.pack(b'>LL', 12, len(bounds) - 1)
+        for i in range(len(bounds) - 1):
+            data += struct.pack(b'>LL', bounds[i], bounds[i+1])
+        return data
+
+
+def buildSkeletonIndex(skeletons):
+    tagTable = [(1, 1, 0x03, 0), (6, 2, 0x0c, 0), (0, 0, 0, 1)]
+    entries = []
+    for name, fragcnt, start, length in skeletons:
+        entries.append((name, {1: [fragcnt], 6: [start, length]}))
+    return buildIndex(entries, tagTable, 1)
+
+
+def buildFragmentIndex(fragments):
+    tagTable = [(2, 1, 0x01, 0), (3, 1, 0x02, 0), (4, 1, 0x04, 0), (6, 2, 0x08, 0), (0, 0, 0, 1)]
+    ctoc = CTOCBuilder()
+    entries = []
+    for insertpos, ctoctext, filenum, seqnum, start, length in fragments:
+        off = ctoc.add(ctoctext)
+        entries.append((str(insertpos).encode('ascii'), {2: [off], 3: [filenum], 4: [seqnum], 6: [start, length]}))
+    return buildIndex(entries, tagTable, 1, ctoc.getRecords())
+
+
+def buildGuideIndex(guide):
+    tagTable = [(1, 1, 0x01, 0), (6, 1, 0x02, 0), (0, 0, 0, 1)]
+    ctoc = CTOCBuilder()
+    entries = []
+    for reftype, title, fragno in guide:
+        entries.append((reftype, {1: [ctoc.add(title)], 6: [fragno]}))
+    return buildIndex(entries, tagTable, 1, ctoc.getRecords())
+
+
+def buildNCX8(ncx, fragments):
+    tagTable = [(1, 1, 0x01, 0), (2, 1, 0x02, 0), (3, 1, 0x04, 0), (4, 1, 0x08, 0), (6, 2, 0x10, 0), (0, 0, 0, 1)]
+    ctoc = CTOCBuilder()
+    entries = []
+    for i, (label, fid, off) in enumerate(ncx):
+        pos = fragments[fid][0] + off
+        entries.append((('%03X' % i).encode('ascii'), {1: [pos], 2: [0], 3: [ctoc.add(label)], 4: [0], 6: [fid, off]}))
+    return buildIndex(entries, tagTable, 1, ctoc.getRecords())
+
+
+def buildDictionaryIndexes(entries, gen, inflections=True):
+    # orth index entries: headword, start position, entry length, inflection groups
+    ctocnames = CTOCBuilder()
+    rules = []
+    ruleids = {}
+    groups = []
+    groupids = {}
+    names = [b'plural', b'past', b'negative']
+
+    def rule(mode, chars):
+        key = (mode, chars)
+        if key not in ruleids:
+            ruleids[key] = len(rules)
+            rules.append(bchr(mode) + chars)
+        return ruleids[key]
+
+    orth = []
+    for word, start, length in sorted(entries):
+        tagMap = {1: [start], 2: [length]}
+        if inflections:
+            grouprules = []
+            last = word[-1:]
+            if last == b'y':
+                # delete a trailing y then append ies (end inserts are reversed)
+                grouprules.append((0, [rule(0x03, b'y'), rule(0x02, b'sei')]))
+            else:
+                grouprules.append((0, [rule(0x02, b's')]))
+            grouprules.append((1, [rule(0x02, b'de')]))
+            if len(word) > 3:
+                grouprules.append((2, [rule(0x01, b'un')]))
+            key = tuple((n, tuple(r)) for n, r in grouprules)
+            if key not in groupids:
+                groupids[key] = len(groups)
+                groups.append(grouprules)
+            tagMap[0x2a] = [groupids[key]]
+        orth.append((word, tagMap))
+    orthTags = [(1, 1, 0x01, 0), (2, 1, 0x02, 0), (0x2a, 1, 0x0c, 0), (0, 0, 0, 1)]
+    orthrecs = buildIndex(orth, orthTags, 1)
+    if not inflections:
+        return orthrecs, []
+
+    nameoffs = [ctocnames.add(n) for n in names]
+    inflTags = [(5, 1, 0x03, 0), (0x1a, 1, 0x0c, 0), (0, 0, 0, 1)]
+    # inflection data entries are indexed with groups first then rules
+    ngroups = len(groups)
+    inflentries = []
+    for grouprules in groups:
+        nmap = []
+        rmap = []
+        for nameidx, rs in grouprules:
+            for r in rs:
+                nmap.append(nameoffs[nameidx])
+                rmap.append(ngroups + r)
+        inflentries.append(b'\x00' + encodeTagValues(inflTags, 1, {5: nmap, 0x1a: rmap}))
+    for r in rules:
+        inflentries.append(bchr(len(r)) + r)
+    inflrecs = []
+    current = []
+    size = 0
+    for e in inflentries:
+        if current and size + len(e) > MAX_INDX_RECORD:
+            inflrecs.append(_indxRecord(current))
+            current = []
+            size = 0
+        current.append(e)
+        size += len(e)
+    if current:
+        inflrecs.append(_indxRecord(current))
+    main = _pad4(_indxHeader(0, 0xc0, len(inflrecs), total=len(inflentries)) + _pad4(buildTAGX(inflTags, 1)))
+    namerec = ctocnames.getRecords()[0]
+    return orthrecs, [main] + inflrecs + [namerec]
+
+
+# Auxiliary records
+
+FLIS_RECORD = (b'FLIS\x00\x00\x00\x08\x00\x41\x00\x00\x00\x00\x00\x00\xff\xff\xff\xff'
+               b'\x00\x01\x00\x03\x00\x00\x00\x03\x00\x00\x00\x01\xff\xff\xff\xff')
+
+def fcisRecord(textlength):
+    return (b'FCIS\x00\x00\x00\x14\x00\x00\x00\x10\x00\x00\x00\x01\x00\x00\x00\x00' +
+            struct.pack(b'>L', textlength) +
+            b'\x00\x00\x00\x00\x00\x00\x00\x20\x00\x00\x00\x08\x00\x01\x00\x01\x00\x00\x00\x00')
+
+
+def fontRecord(n, obfuscate=True):
+    rng = random.Random(n)
+    font = b'\x00\x01\x00\x00' + bstr(bytearray(rng.randrange(256) for _ in range(2048)))
+    data = zlib.compress(font)
+    flags = 0x0001
+    key = b''
+    if obfuscate:
+        flags |= 0x0002
+        key = bstr(bytearray(rng.randrange(256) for _ in range(16)))
+        buf = bytearray(data)
+        kb = bytearray(key)
+        for i in range(min(len(buf), 1040)):
+            buf[i] ^= kb[i % len(kb)]
+        data = bytes(buf)
+    return b'FONT' + struct.pack(b'>LLLLL', len(font), flags, 24 + len(key), len(key), 24) + key + data
+
+
+def rescRecord(nparts):
+    spine = b''.join(b'<itemref idref="part' + str(i).encode('ascii') + b'" skelid="' + str(i).encode('ascii') + b'"/>'
+                     for i in range(nparts))
+    xml = (b'<?xml version="1.0" encoding="utf-8"?><package version="2.0" xmlns="http://www.idpf.org/2007/opf">'
+           b'<metadata><meta name="cover" content="cover"/></metadata><spine toc="ncx">' + spine + b'</spine></package>')
+    return b'RESC' + struct.pack(b'>LLL', 0, 1, 1) + b'size=' + toBase32(len(xml)) + b'&version=1&type=1' + xml + b'\x00'
+
+
+def pageRecord(offsets):
+    pmstr = b'(1,a,1)'
+    rev = b'1'
+    data = b'PAGE' + struct.pack(b'>LLL', 0, 0, 0) + struct.pack(b'>L', len(rev)) + rev
+    data += struct.pack(b'>4H', 1, len(pmstr), len(offsets), 32) + pmstr
+    data += struct.pack(bstr('>%dL' % len(offsets)), *offsets)
+    return data
+
+
+# Book writers
+
+FORMATS = ['palmdoc', 'mobi7', 'kf8', 'combo', 'dict']
+COMPRESSIONS = {'none': 1, 'palmdoc': 2, 'huff': 0x4448}
+
+
+def _title(fmt, seed):
+    return ('Synthetic %s %d' % (fmt, seed)).encode('ascii')
+
+
+def _exth(title, extra=()):
+    items = [(100, b'KindleUnpack'), (101, b'Synthetic Press'), (503, title), (524, b'en')]
+    items.extend(extra)
+    return items
+
+
+def _writeMobi7Part(pdb, content, compression, title, nimages, trailers, dictionary=None, start=0, extra_exth=(), imagesize=0):
+    rec0 = pdb.addRecord(b'')  # placeholder, rewritten below
+    writer = TextRecordWriter(compression, content.text, trailers)
+    first, ntext = _addTextRecords(pdb, writer, content.text)
+    huffoff, huffnum = _addHuffRecords(pdb, writer)
+    firstnontext = pdb.count()
+    ncxidx = pdb.count()
+    for rec in buildNCX7(content.chapters, len(content.text)):
+        pdb.addRecord(rec)
+    orthidx = inflidx = None
+    if dictionary is not None:
+        orthrecs, inflrecs = dictionary
+        orthidx = pdb.count()
+        for rec in orthrecs:
+            pdb.addRecord(rec)
+        if inflrecs:
+            inflidx = pdb.count()
+            for rec in inflrecs:
+                pdb.addRecord(rec)
+    firstimage = pdb.count()
+    for i in range(nimages):
+        pdb.addRecord(makeImage(i + 1, size=imagesize))
+    lastimage = pdb.count() - 1
+    fields = {
+        0x50: (b'>L', firstnontext - rec0),
+        0x6c: (b'>L', firstimage - rec0),
+        0xc0: (b'>H', 1),
+        0xc2: (b'>H', lastimage - rec0),
+        0xf4: (b'>L', ncxidx - rec0),
+    }
+    if huffnum:
+        fields[0x70] = (b'>L', huffoff - rec0)
+        fields[0x74] = (b'>L', huffnum)
+    if orthidx is not None:
+        fields[0x28] = (b'>L', orthidx - rec0)
+        fields[0x60] = (b'>L', 9)
+        fields[0x64] = (b'>L', 9)
+    if inflidx is not None:
+        fields[0x2c] = (b'>L', inflidx - rec0)
+    exth = _exth(title, extra_exth)
+    if nimages:
+        exth.append((201, struct.pack(b'>L', 0)))
+    exth.append((116, struct.pack(b'>L', content.chapters[0])))
+    return rec0, fields, writer, exth, (firstimage, lastimage)
+
+
+def writeMobi7(outfile, textsize, nimages, compression, seed, trailers=True, dictentries=0, imagesize=0):
+    fmt = 'dict' if dictentries else 'mobi7'
+    title = _title(fmt, seed)
+    gen = TextGenerator(seed)
+    content = Mobi7Content(gen, textsize, nimages, dictentries=dictentries)
+    dictionary = None
+    if dictentries:
+        dictionary = buildDictionaryIndexes(content.entries, gen)
+    pdb = PDBWriter(title, b'BOOKMOBI')
+    rec0, fields, writer, exth, images = _writeMobi7Part(pdb, content, compression, title, nimages, trailers, dictionary,
+                                                         imagesize=imagesize)
+    fields[0xc8] = (b'>L', pdb.addRecord(fcisRecord(len(content.text))))
+    fields[0xd0] = (b'>L', pdb.addRecord(FLIS_RECORD))
+    pdb.addRecord(EOF_RECORD)
+    pdb.replaceRecord(rec0, b'')
+    data = buildRecord0(title, 6, compression, len(content.text), (len(content.text) + TEXT_RECORD_SIZE - 1) // TEXT_RECORD_SIZE,
+                        fields, exth, writer.extraFlags())
+    _finish(pdb, rec0, data, outfile)
+    return content
+
+
+def _finish(pdb, rec0, data, outfile):
+    # record 0 was added as an empty placeholder, splice in the real one
+    pdb.lengths[rec0] = len(data)
+    spool = tempfile.TemporaryFile()
+    pdb.spool.seek(0)
+    before = sum(pdb.lengths[:rec0])
+    spool.write(pdb.spool.read(before))
+    spool.write(data)
+    while True:
+        chunk = pdb.spool.read(1 << 20)
+        if not chunk:
+            break
+        spool.write(chunk)
+    pdb.spool.close()
+    pdb.spool = spool
+    pdb.write(outfile)
+
+
+def _writeKF8Part(pdb, content, compression, title, trailers, nimages, nfonts, hdimages, pages, resources=True, extra_exth=(),
+                  imagesize=0):
+    rec0 = pdb.addRecord(b'')
+    raw = content.rawML()
+    writer = TextRecordWriter(compression, raw, trailers)
+    first, ntext = _addTextRecords(pdb, writer, raw)
+    huffoff, huffnum = _addHuffRecords(pdb, writer)
+    firstnontext = pdb.count()
+    ncxidx = pdb.count()
+    for rec in buildNCX8(content.ncx, content.fragments):
+        pdb.addRecord(rec)
+    skelidx = pdb.count()
+    for rec in buildSkeletonIndex(content.skeletons):
+        pdb.addRecord(rec)
+    fragidx = pdb.count()
+    for rec in buildFragmentIndex(content.fragments):
+        pdb.addRecord(rec)
+    guideidx = pdb.count()
+    guide = [(b'toc', b'Table of Contents', 0), (b'start', b'Start', min(1, len(content.fragments) - 1))]
+    for rec in buildGuideIndex(guide):
+        pdb.addRecord(rec)
+    firstresource = pdb.count()
+    if resources:
+        _addResources(pdb, content, nimages, nfonts, hdimages, pages, imagesize)
+    fdst = pdb.addRecord(content.fdst())
+    fields = {
+        0x50: (b'>L', firstnontext - rec0),
+        0x6c: (b'>L', firstresource - rec0),
+        0xc0: (b'>L', fdst - rec0),
+        0xc4: (b'>L', len(content.flows) + 1),
+        0xf4: (b'>L', ncxidx - rec0),
+        0xf8: (b'>L', fragidx - rec0),
+        0xfc: (b'>L', skelidx - rec0),
+        0x104: (b'>L', guideidx - rec0),
+    }
+    if huffnum:
+        fields[0x70] = (b'>L', huffoff - rec0)
+        fields[0x74] = (b'>L', huffnum)
+    exth = _exth(title, extra_exth)
+    exth.append((125, struct.pack(b'>L', nimages + nfonts)))
+    if nimages:
+        exth.append((201, struct.pack(b'>L', 0)))
+    return rec0, fields, writer, exth, raw
+
+
+def _addResources(pdb, content, nimages, nfonts, hdimages, pages, imagesize=0):
+    for i in range(nimages):
+        pdb.addRecord(makeImage(i + 1, size=imagesize))
+    for i in range(nfonts):
+        pdb.addRecord(fontRecord(i))
+    pdb.addRecord(rescRecord(content.nparts))
+    if pages:
+        step = max(1, len(content.text) // pages)
+        pdb.addRecord(pageRecord(list(range(0, len(content.text), step))[:pages]))
+    if hdimages and nimages:
+        pdb.addRecord(b'CONT' + struct.pack(b'>LL', 0, 65001) + b'\x00' * 36)
+        for i in range(nimages):
+            if i < hdimages:
+                pdb.addRecord(b'CRES' + struct.pack(b'>LL', 0, 0) + makeImage(i + 1, 640, 480, imagesize))
+            else:
+                pdb.addRecord(b'\xa0\xa0\xa0\xa0')
+        pdb.addRecord(b'kindle:embed:0001')
+        pdb.addRecord(b'CONTBOUNDARY')
+
+
+def _fragsPerPart(nparts, nfragments):
+    # nfragments is the total number of fragments wanted, 0 picks one from the text size
+    if not nfragments:
+        return None
+    return max(1, nfragments // max(1, nparts))
+
+
+def writeKF8(outfile, textsize, nparts, nimages, compression, seed, trailers=True, nfonts=1, hdimages=0, pages=0, imagesize=0,
+             nfragments=0):
+    title = _title('kf8', seed)
+    gen = TextGenerator(seed)
+    content = KF8Content(gen, textsize, nparts, nimages, nfonts, _fragsPerPart(nparts, nfragments))
+    pdb = PDBWriter(title, b'BOOKMOBI')
+    rec0, fields, writer, exth, raw = _writeKF8Part(pdb, content, compression, title, trailers, nimages, nfonts, hdimages, pages,
+                                                    imagesize=imagesize)
+    fields[0xc8] = (b'>L', pdb.addRecord(fcisRecord(len(raw))))
+    fields[0xd0] = (b'>L', pdb.addRecord(FLIS_RECORD))
+    pdb.addRecord(EOF_RECORD)
+    data = buildRecord0(title, 8, compression, len(raw), (len(raw) + TEXT_RECORD_SIZE - 1) // TEXT_RECORD_SIZE,
+                        fields, exth, writer.extraFlags())
+    _finish(pdb, rec0, data, outfile)
+    return content
+
+
+def writeCombo(outfile, textsize, nparts, nimages, compression, seed, trailers=True, nfonts=1, imagesize=0, nfragments=0):
+    # The mobi7 part holds the shared images, fonts and RESC and is followed by
+    # the BOUNDARY section and the KF8 part with its own text and indexes.
+    title = _title('combo', seed)
+    gen = TextGenerator(seed)
+    content7 = Mobi7Content(gen, textsize, nimages)
+    content8 = KF8Content(gen, textsize, nparts, nimages, nfonts, _fragsPerPart(nparts, nfragments))
+    pdb = PDBWriter(title, b'BOOKMOBI')
+    rec0, fields7, writer7, exth7, images = _writeMobi7Part(pdb, content7, compression, title, nimages, trailers,
+                                                            imagesize=imagesize)
+    for i in range(nfonts):
+        pdb.addRecord(fontRecord(i))
+    pdb.addRecord(rescRecord(content8.nparts))
+    fields7[0xc2] = (b'>H', pdb.count() - 1 - rec0)
+    fields7[0xc8] = (b'>L', pdb.addRecord(fcisRecord(len(content7.text))))
+    fields7[0xd0] = (b'>L', pdb.addRecord(FLIS_RECORD))
+    pdb.addRecord(b'BOUNDARY')
+    kf8rec0 = pdb.count()
+    exth7.append((121, struct.pack(b'>L', kf8rec0)))
+    rec8, fields8, writer8, exth8, raw = _writeKF8Part(pdb, content8, compression, title, trailers, nimages, nfonts, 0, 0, False)
+    fields8[0xc8] = (b'>L', pdb.addRecord(fcisRecord(len(raw))) - rec8)
+    fields8[0xd0] = (b'>L', pdb.addRecord(FLIS_RECORD) - rec8)
+    pdb.addRecord(EOF_RECORD)
+    data8 = buildRecord0(title, 8, compression, len(raw), (len(raw) + TEXT_RECORD_SIZE - 1) // TEXT_RECORD_SIZE,
+                         fields8, exth8, writer8.extraFlags())
+    data7 = buildRecord0(title, 6, compression, len(content7.text), (len(content7.text) + TEXT_RECORD_SIZE - 1) // TEXT_RECORD_SIZE,
+                         fields7, exth7, writer7.extraFlags())
+    # both record 0 placeholders are spliced in, the later one first
+    pdb.lengths[rec8] = 0
+    _splice(pdb, rec8, data8)
+    _finish(pdb, rec0, data7, outfile)
+    return content7, content8
+
+
+def _splice(pdb, num, data):
+    pdb.lengths[num] = 0
+    spool = tempfile.TemporaryFile()
+    pdb.spool.seek(0)
+    spool.write(pdb.spool.read(sum(pdb.lengths[:num])))
+    spool.write(data)
+    while True:
+        chunk = pdb.spool.read(1 << 20)
+        if not chunk:
+            break
+        spool.write(chunk)
+    pdb.spool.close()
+    pdb.spool = spool
+    pdb.lengths[num] = len(data)
+
+
+def writePalmDoc(outfile, textsize, compression, seed):
+    if compression == 0x4448:
+        raise unpackException('TEXtREAd books do not support HUFF/CDIC')
+    title = _title('palmdoc', seed)
+    gen = TextGenerator(seed)
+    text = bytearray()
+    while len(text) < textsize:
+        text += gen.paragraph() + b'\n\n'
+    pdb = PDBWriter(title, b'TEXtREAd')
+    writer = TextRecordWriter(compression, text, False)
+    nrec = (len(text) + TEXT_RECORD_SIZE - 1) // TEXT_RECORD_SIZE
+    pdb.addRecord(struct.pack(b'>HHLHHHH', writer.compression, 0, len(text), nrec, TEXT_RECORD_SIZE, 0, 0))
+    _addTextRecords(pdb, writer, text)
+    pdb.write(outfile)
+    return text
+
+
+def generateBook(outfile, fmt='kf8', textsize=100000, parts=10, images=5, entries=1000, compression='palmdoc',
+                 seed=0, fonts=1, hdimages=0, pages=0, trailers=True, imagesize=0, fragments=0):
+    # The same parameters always produce the same file.  The text of one part is
+    # limited to MAX_TEXT_SIZE by the 16 bit record count of the mobi header,
+    # larger files can be made with more or bigger (imagesize) images.
+    if fmt not in FORMATS:
+        raise unpackException('unknown format: %s' % fmt)
+    if compression not in COMPRESSIONS:
+        raise unpackException('unknown compression: %s' % compression)
+    if textsize > MAX_TEXT_SIZE:
+        raise unpackException('text size %d is larger than the format allows (%d)' % (textsize, MAX_TEXT_SIZE))
+    comp = COMPRESSIONS[compression]
+    if fmt == 'palmdoc':
+        return writePalmDoc(outfile, textsize, comp, seed)
+    if fmt == 'mobi7':
+        return writeMobi7(outfile, textsize, images, comp, seed, trailers, imagesize=imagesize)
+    if fmt == 'dict':
+        return writeMobi7(outfile, textsize, images, comp, seed, trailers, dictentries=entries, imagesize=imagesize)
+    if fmt == 'kf8':
+        return writeKF8(outfile, textsize, parts, images, comp, seed, trailers, fonts, hdimages, pages, imagesize, fragments)
+    return writeCombo(outfile, textsize, parts, images, comp, seed, trailers, fonts, imagesize, fragments)
+
+
+def parseSize(value):
+    # a byte count with an optional K, M or G suffix
+    value = value.strip().upper()
+    scale = 1
+    if value[-1:] in ('K', 'M', 'G'):
+        scale = 1024 ** ('KMG'.index(value[-1]) + 1)
+        value = value[:-1]
+    return int(float(value) * scale)
+
+
+def usage(progname):
+    print("")
+    print("Description:")
+    print("  Writes a synthetic ebook in any of the formats KindleUnpack reads, for")
+    print("  benchmarks and load tests.  The same options always give the same file.")
+    print("Usage:")
+    print("  %s -h -f format -s size -c compression [options] outfile" % progname)
+    print("Options:")
+    print("    -h                 print this help message")
+    print("    -f FORMAT          %s, default is kf8" % ', '.join(FORMATS))
+    print("    -s SIZE            bytes of text (K, M and G suffixes allowed), default is 100K")
+    print("    -c COMPRESSION     %s, default is palmdoc" % ', '.join(sorted(COMPRESSIONS)))
+    print("    --parts=           number of KF8 parts (skeletons), default is 10")
+    print("    --fragments=       total number of KF8 fragments, default depends on the size")
+    print("    --images=          number of images, default is 5")
+    print("    --image-size=      pad every image to about this size, default is no padding")
+    print("    --entries=         number of dictionary entries, default is 1000")
+    print("    --fonts=           number of KF8 fonts, default is 1")
+    print("    --hdimages=        number of KF8 HD (CRES) images, default is 0")
+    print("    --pages=           number of KF8 page map (PAGE) entries, default is 0")
+    print("    --seed=            seed for the generated text, default is 0")
+    print("    --no-trailers      do not append trailing entries to the text records")
+
+
+def main(argv=unicode_argv()):
+    progname = os.path.basename(argv[0])
+    try:
+        opts, args = getopt.getopt(argv[1:], "hf:s:c:", ['parts=', 'fragments=', 'images=', 'image-size=', 'entries=',
+                                                        'fonts=', 'hdimages=', 'pages=', 'seed=', 'no-trailers'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(progname)
+        return 2
+
+    if len(args) != 1:
+        usage(progname)
+        return 2
+
+    params = {'fmt': 'kf8', 'textsize': 100*1024, 'compression': 'palmdoc'}
+    try:
+        for o, a in opts:
+            if o == "-h":
+                usage(progname)
+                return 0
+            if o == "-f":
+                params['fmt'] = a
+            if o == "-s":
+                params['textsize'] = parseSize(a)
+            if o == "-c":
+                params['compression'] = a
+            if o == "--parts":
+                params['parts'] = int(a)
+            if o == "--fragments":
+                params['fragments'] = int(a)
+            if o == "--images":
+                params['images'] = int(a)
+            if o == "--image-size":
+                params['imagesize'] = parseSize(a)
+            if o == "--entries":
+                params['entries'] = int(a)
+            if o == "--fonts":
+                params['fonts'] = int(a)
+            if o == "--hdimages":
+                params['hdimages'] = int(a)
+            if o == "--pages":
+                params['pages'] = int(a)
+            if o == "--seed":
+                params['seed'] = int(a)
+            if o == "--no-trailers":
+                params['trailers'] = False
+    except ValueError:
+        print("Error: option needs a number")
+        usage(progname)
+        return 2
+
+    outfile = args[0]
+    try:
+        generateBook(outfile, **params)
+    except unpackException as e:
+        print("Error: %s" % e)
+        return 1
+    print("Wrote %s (%d bytes)" % (outfile, os.path.getsize(pathof(outfile))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,7 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
-from .compatibility_utils import PY2, bchr, lmap, bstr
+from .compatibility_utils import PY2, lmap, bstr
 
 if PY2:
     range = xrange
@@ -25,38 +25,50 @@ class UncompressedReader:
 class PalmdocReader:
 
     def unpack(self, i):
-        o, p = b'', 0
-        while p < len(i):
-            # for python 3 must use slice since i[p] returns int while slice returns character
-            c = ord(i[p:p+1])
+        # bytearray indexing gives ints under both python 2 and 3, and lets the
+        # output grow in place instead of building a new bytes object per token
+        # (records may also arrive as memoryview slices of a memory mapped book)
+        i = bytearray(i)
+        o = bytearray()
+        p = 0
+        ilen = len(i)
+        while p < ilen:
+            c = i[p]
             p += 1
             if (c >= 1 and c <= 8):
                 o += i[p:p+c]
                 p += c
             elif (c < 128):
-                o += bchr(c)
+                o.append(c)
             elif (c >= 192):
-                o += b' ' + bchr(c ^ 128)
-            else:
-                if p < len(i):
-                    c = (c << 8) | ord(i[p:p+1])
-                    p += 1
-                    m = (c >> 3) & 0x07ff
-                    n = (c & 7) + 3
-                    if (m > n):
-                        o += o[-m:n-m]
-                    else:
-                        for _ in range(n):
-                            # because of completely ass-backwards decision by python mainters for python 3
-                            # we must use slice for bytes as i[p] returns int while slice returns character
-                            if m == 1:
-                                o += o[-m:]
-                            else:
-                                o += o[-m:-m+1]
-        return o
+                o.append(32)
+                o.append(c ^ 128)
+            elif p < ilen:
+                c = (c << 8) | i[p]
+                p += 1
+                m = (c >> 3) & 0x07ff
+                n = (c & 7) + 3
+                olen = len(o)
+                if m > olen or m == 0:
+                    # corrupt distance, reproduce what the slicing in the original
+                    # byte at a time decoder produced for these
+                    if m > n:
+                        if olen + n - m > 0:
+                            o += o[:olen + n - m]
+                    elif m == 0 and olen:
+                        o += o[0:1] * n
+                elif m >= n:
+                    # source and destination do not overlap
+                    o += o[olen-m:olen-m+n]
+                elif m == 1:
+                    # run of a single repeated byte
+                    o += o[-1:] * n
+                else:
+                    # overlapping copy repeats the last m bytes
+                    o += (o[olen-m:] * (n // m + 1))[:n]
+        return bytes(o)
 
 class HuffcdicReader:
-    q = struct.Struct(b'>Q').unpack_from
 
     def loadHuff(self, huff):
         if huff[0:8] != b'HUFF\x00\x00\x00\x18':
@@ -79,7 +91,40 @@ class HuffcdicReader:
         for codelen, maxcode in enumerate((0,) + dict2[1::2]):
             self.maxcode += (((maxcode + 1) << (32 - codelen)) - 1, )
 
+        self.buildLookup()
         self.dictionary = []
+        self.phrases = None
+        self.multi = None
+
+    def buildLookup(self):
+        # Build a table indexed by the next 16 bits of input that gives the
+        # symbol index and code length in one step, packed as (r << 5) | codelen.
+        # Only codes of at most 16 bits can be resolved from the prefix alone,
+        # entries for longer codes are -1 and are decoded the slow way.
+        # The symbol index only depends on the top codelen bits of the code:
+        # r = (maxcode - code) >> (32 - codelen) = (maxcode >> (32 - codelen)) - (code >> (32 - codelen))
+        lookup = []
+        for hi in range(256):
+            codelen, term, maxcode = self.dict1[hi]
+            if term:
+                if codelen > 16:
+                    lookup.extend([-1] * 256)
+                    continue
+                top = maxcode >> (32 - codelen)
+                shift = 16 - codelen
+                lookup.extend([((top - (v >> shift)) << 5) | codelen for v in range(hi << 8, (hi + 1) << 8)])
+                continue
+            for v in range(hi << 8, (hi + 1) << 8):
+                # code < mincode only depends on the top codelen bits as long as codelen <= 16
+                code = v << 16
+                cl = codelen
+                while cl <= 16 and code < self.mincode[cl]:
+                    cl += 1
+                if cl > 16:
+                    lookup.append(-1)
+                else:
+                    lookup.append((((self.maxcode[cl] >> (32 - cl)) - (v >> (16 - cl))) << 5) | cl)
+        self.lookup = lookup
 
     def loadCdic(self, cdic):
         if cdic[0:8] != b'CDIC\x00\x00\x00\x10':
@@ -92,40 +137,174 @@ class HuffcdicReader:
             slice = cdic[18+off:18+off+(blen&0x7fff)]
             return (slice, blen&0x8000)
         self.dictionary += lmap(getslice, struct.unpack_from(bstr('>%dH' % n), cdic, 16))
+        self.phrases = None
+        if len(self.dictionary) >= phrases:
+            # all CDIC records are in, expand every phrase up front
+            self.expandDictionary()
 
-    def unpack(self, data):
-        q = HuffcdicReader.q
+    def expandDictionary(self):
+        # Phrases without the literal flag are themselves huffman coded strings of
+        # other phrases.  Decode each of them to its symbol list and then expand
+        # them in dependency order with an explicit stack instead of recursion.
+        dictionary = self.dictionary
+        count = len(dictionary)
+        phrases = [None] * count
+        symbols = [None] * count
+        for r in range(count):
+            slice, flag = dictionary[r]
+            if flag:
+                phrases[r] = slice
+            else:
+                symbols[r] = self.decode(slice)
+                if symbols[r] and max(symbols[r]) >= count:
+                    print("Warning: huffman dictionary entry %d refers to a missing entry" % r)
+                    phrases[r] = b''
+        for r in range(count):
+            if phrases[r] is not None:
+                continue
+            # depth first, each stack entry keeps its place in its symbol list
+            stack = [(r, iter(symbols[r]))]
+            onpath = set([r])
+            while stack:
+                top, pending = stack[-1]
+                for s in pending:
+                    if phrases[s] is None:
+                        if s in onpath:
+                            # a corrupt entry that (indirectly) contains itself
+                            print("Warning: huffman dictionary entry %d refers to itself" % s)
+                            phrases[s] = b''
+                            continue
+                        onpath.add(s)
+                        stack.append((s, iter(symbols[s])))
+                        break
+                else:
+                    phrases[top] = b''.join([phrases[s] for s in symbols[top]])
+                    onpath.discard(top)
+                    stack.pop()
+        self.phrases = phrases
+        self.multi = [None] * 0x10000
+
+    def decode(self, data):
+        # decode a huffman coded string into the list of its dictionary indices
+        lookup = self.lookup
+        dict1 = self.dict1
+        mincodes = self.mincode
+        maxcodes = self.maxcode
 
         bitsleft = len(data) * 8
-        data += b"\x00\x00\x00\x00\x00\x00\x00\x00"
+        # read the input as 32 bit words, only the final partial word needs padding
+        nwords = len(data) >> 2
+        words = list(struct.unpack_from(bstr('>%dL' % nwords), data, 0))
+        words.append(struct.unpack(b'>L', (bytes(data[nwords * 4:]) + b'\x00\x00\x00\x00')[:4])[0])
+        words.append(0)
         pos = 0
-        x, = q(data, pos)
+        x = (words[0] << 32) | words[1]
         n = 32
 
-        s = b''
+        symbols = []
+        append = symbols.append
         while True:
             if n <= 0:
-                pos += 4
-                x, = q(data, pos)
+                pos += 1
+                x = (words[pos] << 32) | words[pos + 1]
                 n += 32
-            code = (x >> n) & ((1 << 32) - 1)
+            code = (x >> n) & 0xffffffff
 
-            codelen, term, maxcode = self.dict1[code >> 24]
-            if not term:
-                while code < self.mincode[codelen]:
-                    codelen += 1
-                maxcode = self.maxcode[codelen]
+            v = lookup[code >> 16]
+            if v >= 0:
+                codelen = v & 0x1f
+                r = v >> 5
+            else:
+                codelen, term, maxcode = dict1[code >> 24]
+                if not term:
+                    while code < mincodes[codelen]:
+                        codelen += 1
+                    maxcode = maxcodes[codelen]
+                r = (maxcode - code) >> (32 - codelen)
 
             n -= codelen
             bitsleft -= codelen
             if bitsleft < 0:
                 break
+            append(r)
+        return symbols
+
+    def getMultiEntry(self, w):
+        # Work out every complete code that fits in the 16 bits w and return the
+        # concatenation of their phrases and the number of bits they use, or False
+        # if not even the first code can be resolved from these 16 bits.  The table
+        # entries are only built the first time a prefix is seen.
+        lookup = self.lookup
+        phrases = self.phrases
+        k = 0
+        parts = []
+        while k < 16:
+            v = lookup[(w << k) & 0xffff]
+            if v < 0:
+                break
+            codelen = v & 0x1f
+            if codelen > 16 - k:
+                break
+            parts.append(phrases[v >> 5])
+            k += codelen
+        if not k:
+            return False
+        return (b''.join(parts), k)
+
+    def unpack(self, data):
+        if self.phrases is None:
+            self.expandDictionary()
+        phrases = self.phrases
+        multi = self.multi
+        lookup = self.lookup
+        dict1 = self.dict1
+        mincodes = self.mincode
+        maxcodes = self.maxcode
+
+        bitsleft = len(data) * 8
+        nwords = len(data) >> 2
+        words = list(struct.unpack_from(bstr('>%dL' % nwords), data, 0))
+        words.append(struct.unpack(b'>L', (bytes(data[nwords * 4:]) + b'\x00\x00\x00\x00')[:4])[0])
+        words.append(0)
+        pos = 0
+        x = (words[0] << 32) | words[1]
+        n = 32
+
+        out = bytearray()
+        while True:
+            if n <= 0:
+                pos += 1
+                x = (words[pos] << 32) | words[pos + 1]
+                n += 32
+
+            # fast path, emit all the codes held in the next 16 bits at once
+            w = (x >> (n + 16)) & 0xffff
+            entry = multi[w]
+            if entry is None:
+                entry = multi[w] = self.getMultiEntry(w)
+            if entry and entry[1] <= bitsleft:
+                out += entry[0]
+                n -= entry[1]
+                bitsleft -= entry[1]
+                continue
 
-            r = (maxcode - code) >> (32 - codelen)
-            slice, flag = self.dictionary[r]
-            if not flag:
-                self.dictionary[r] = None
-                slice = self.unpack(slice)
-                self.dictionary[r] = (slice, 1)
-            s += slice
-        return s
+            # one code at a time for long codes and the end of the data
+            code = (x >> n) & 0xffffffff
+            v = lookup[code >> 16]
+            if v >= 0:
+                codelen = v & 0x1f
+                r = v >> 5
+            else:
+                codelen, term, maxcode = dict1[code >> 24]
+                if not term:
+                    while code < mincodes[codelen]:
+                        codelen += 1
+                    maxcode = maxcodes[codelen]
+                r = (maxcode - code) >> (32 - codelen)
+
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+            out += phrases[r]
+        return bytes(out)
@@ -8,6 +8,8 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 from .compatibility_utils import PY2, text_type, bchr, bord
 
 import binascii
+import multiprocessing
+import re
 
 if PY2:
     range = xrange
@@ -152,10 +154,15 @@ def toBase32(value, npad=4):
     return num_string
 
 
+_base32_pattern = re.compile(br'''[0-9A-V]+\Z''')
+
 # converts base32 string to value
 def fromBase32(str_num):
     if isinstance(str_num, text_type):
         str_num = str_num.encode('latin-1')
+    if _base32_pattern.match(str_num):
+        # the usual digits are the same as int's base 32 ones
+        return int(str_num, 32)
     scalelst = [1,32,1024,32768,1048576,33554432,1073741824,34359738368]
     value = 0
     j = 0
@@ -189,3 +196,35 @@ def mangle_fonts(encryption_key, data):
     # encrypt = ''.join([chr(ord(x)^key.next()) for x in crypt])
     encrypt = b''.join([bchr(bord(x)^next(key)) for x in crypt])
     return encrypt + data[1024:]
+
+
+class WorkerPool(object):
+    # A pool of worker processes for use in a with block by the code consuming
+    # its results.  The pool is closed when the block completes and terminated
+    # when anything (even KeyboardInterrupt or GeneratorExit) leaves it early,
+    # either way the workers are waited for before the block is left.
+
+    def __init__(self, processes, initializer, initargs):
+        self.pool = multiprocessing.Pool(processes, initializer, initargs)
+
+    def __enter__(self):
+        return self.pool
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.pool.close()
+            else:
+                self.pool.terminate()
+        finally:
+            self.pool.join()
+        return False
+
+
+def startWorkerPool(processes, initializer, initargs, task):
+    # a WorkerPool or None if worker processes can not be used on this system
+    try:
+        return WorkerPool(processes, initializer, initargs)
+    except (OSError, ImportError) as e:
+        print("Warning: unable to start worker processes, %s in a single process: %s" % (task, e))
+        return None